@@ -0,0 +1,205 @@
+"""
+Long running local process keeping logged on ActSessions warm, running commands from short lived scripts sent over a Unix domain socket
+
+The protocol is one JSON object per line each way, see brokerclient.BrokerClient.
+"""
+import asyncio
+import json
+import logging
+import os
+import typing as ty
+
+from . import connection
+from . import dex
+from . import session
+from .brokerclient import ActAddress, BrokerError, JsonDict, MAX_LINE_BYTES, check_socket, make_socket_dir
+
+CommandHandler = ty.Callable[[session.ActSession, JsonDict, float], ty.Awaitable[JsonDict]]
+
+
+class ActSessionBroker(object):
+    """ Serves commands on socket_path, each on a session logged on to the command's ActAddress, made on first use and kept afterwards
+
+    The socket is only accessible to the user running the broker, as commands carry passwords: it is created owner only,
+    in a directory that must belong to that user and that no one else can write to.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, socket_path: str, appname: str, default_timeout: float = 30.0):
+        self.loop = loop
+        self.socket_path = socket_path
+        self.appname = appname
+        self.default_timeout = default_timeout
+        self._logger = logging.getLogger(__name__)
+        self._sessions: ty.Dict[ActAddress, session.ActSession] = dict()
+        self._session_locks: ty.Dict[ActAddress, asyncio.Lock] = dict()
+        self._server: ty.Optional[asyncio.AbstractServer] = None
+        self.on_stopped: asyncio.Future = loop.create_future()
+        self.num_commands = 0
+        self.num_failed_commands = 0
+        self._command_handlers: ty.Dict[str, CommandHandler] = {
+            'snapshot': self._on_snapshot,
+            'table_update': self._on_table_update,
+            'automation_update': self._on_automation_update,
+            'direct_action': self._on_direct_action,
+        }
+
+    async def start(self):
+        """ Raises BrokerError if the socket directory isn't private, or another broker is listening on socket_path """
+        make_socket_dir(socket_path=self.socket_path)
+        if os.path.lexists(self.socket_path):
+            await self._remove_stale_socket()
+        # commands carry passwords, the socket is created owner only rather than chmod-ed once it is already listening
+        old_umask = os.umask(0o177)
+        try:
+            self._server = await asyncio.start_unix_server(self._on_client, path=self.socket_path, limit=MAX_LINE_BYTES)
+        finally:
+            os.umask(old_umask)
+        self._logger.info(f'Broker listening on {self.socket_path}')
+
+    async def _remove_stale_socket(self):
+        """ Unlink socket_path if it is left over from a broker that did not shut down cleanly, i.e. nothing answers on it """
+        check_socket(socket_path=self.socket_path)
+        try:
+            _, writer = await asyncio.open_unix_connection(path=self.socket_path)
+        except ConnectionRefusedError:
+            self._logger.info(f'Removing {self.socket_path} left over from a broker that did not shut down cleanly')
+            os.unlink(self.socket_path)
+            return
+        writer.close()
+        await writer.wait_closed()
+        raise BrokerError(f'Another broker is listening on {self.socket_path}, stop it first (act_broker.py --shutdown)')
+
+    def stop(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        for act_session in self._sessions.values():
+            if act_session.act_connection.is_connected():
+                act_session.logout()
+                act_session.act_connection.disconnect()
+        self._sessions.clear()
+        if not self.on_stopped.done():
+            self.on_stopped.set_result(True)
+
+    async def wait_stopped(self):
+        await self.on_stopped
+
+    async def _on_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                reply = await self._run_command(line=line)
+                writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as exc:
+            self._logger.warning(f'Dropping broker client: {exc}')
+        finally:
+            writer.close()
+
+    async def _run_command(self, line: bytes) -> JsonDict:
+        self.num_commands += 1
+        command = '?'
+        try:
+            message = json.loads(line)
+            command = message.get('command')
+            if command == 'ping':
+                return dict(ok=True, num_sessions=len(self._sessions), num_commands=self.num_commands)
+            if command == 'shutdown':
+                self.loop.call_soon(self.stop)
+                return dict(ok=True)
+            command_handler = self._command_handlers.get(command)
+            if command_handler is None:
+                raise BrokerError(f'Unknown command {command}')
+            timeout = message.get('timeout') or self.default_timeout
+            act_session = await self._get_session(act_address=ActAddress.from_json(message['act']), timeout=timeout)
+            reply = await command_handler(act_session, message.get('args') or dict(), timeout)
+            reply['ok'] = True
+            return reply
+        except BrokerError as exc:
+            self.num_failed_commands += 1
+            self._logger.info(f'Command {command} failed: {exc}')
+            return dict(ok=False, error=str(exc))
+        except Exception as exc:
+            self.num_failed_commands += 1
+            self._logger.exception(f'Command {command} failed')
+            return dict(ok=False, error=f'{type(exc).__name__}: {exc}')
+
+    async def _get_session(self, act_address: ActAddress, timeout: float) -> session.ActSession:
+        """ The logged on session for act_address, connecting and logging on if there is none or it dropped """
+        lock = self._session_locks.setdefault(act_address, asyncio.Lock())
+        async with lock:
+            act_session = self._sessions.get(act_address)
+            if act_session is not None and act_session.act_connection.is_connected():
+                return act_session
+            act_connection = connection.ActConnection(ip=act_address.ip, port=act_address.port, loop=self.loop)
+            await act_connection.connect()
+            if not act_connection.is_connected():
+                raise BrokerError(f'Could not connect to {act_connection}')
+            act_session = session.ActSession(act_connection=act_connection, user=act_address.user, password=act_address.password,
+                                             appname=self.appname, request_timeout=self.default_timeout)
+            try:
+                logon_response = await asyncio.wait_for(act_session.logon(), timeout=timeout)
+            except asyncio.TimeoutError:
+                act_connection.disconnect()
+                raise BrokerError(f'No logon response from {act_connection}') from None
+            if not logon_response.Success:
+                act_connection.disconnect()
+                raise BrokerError(f'Failed to log on to {act_connection}: {logon_response.ErrorMsg}')
+            self._logger.info(f'Logged on to {act_connection} as {act_address.user}')
+            self._sessions[act_address] = act_session
+            return act_session
+
+    async def _run_snapshot(self, act_session: session.ActSession, query_data: dex.DexQueryData, timeout: float) -> dex.DexQuery:
+        try:
+            return await dex.run_snapshot(act_session=act_session, query_data=query_data, timeout=timeout)
+        except dex.DexQueryError as exc:
+            raise BrokerError(str(exc)) from None
+        except asyncio.TimeoutError:
+            raise BrokerError(f'No snapshot within {timeout}s') from None
+
+    async def _on_snapshot(self, act_session: session.ActSession, args: JsonDict, timeout: float) -> JsonDict:
+        query_data = dex.DexQueryData(scope_keys=args['scope_keys'], fields=args['fields'], is_snapshot=True,
+                                      no_triggers=args.get('no_triggers'), contexts=args.get('contexts'))
+        dex_query = await self._run_snapshot(act_session=act_session, query_data=query_data, timeout=timeout)
+        return dict(csv=dex_query.as_csv(), num_rows=len(dex_query.rows))
+
+    async def _on_table_update(self, act_session: session.ActSession, args: JsonDict, timeout: float) -> JsonDict:
+        dex_table_update = dex.from_csv(csv_str=args['csv'])
+        if dex_table_update is None:
+            raise BrokerError(f'Failed to parse the table update csv')
+        result = await act_session.dex_sub_session.update_table_async(table_update=dex_table_update.to_table_update(), timeout=timeout)
+        if not result.is_ok():
+            raise BrokerError(f'Error applying table update: {result.err_msg}')
+        return dict(num_rows=len(dex_table_update.rows))
+
+    async def _on_automation_update(self, act_session: session.ActSession, args: JsonDict, timeout: float) -> JsonDict:
+        product = args['product']
+        query_data = dex.DexQueryData(scope_keys=[product], fields=['AUTO.IID'], is_snapshot=True)
+        dex_query = await self._run_snapshot(act_session=act_session, query_data=query_data, timeout=timeout)
+        if len(dex_query.rows) != 1:
+            raise BrokerError(f'Expected one AUTO.IID row for {product}, got {len(dex_query.rows)}')
+        iid = dex_query.rows[0].get_cell_by_name('AUTO.IID').value_str()
+        automation_update = session.AutomationUpdate(auto_control_type=args['automation_type'], automation_status=args['new_status'])
+        product_update = session.ProductAutomationUpdate(product=product, iid=iid, automation_updates=[automation_update])
+        result = await act_session.autocontrol_sub_session.send_automation_updates_async(product_updates=[product_update], timeout=timeout)
+        if not result.is_ok():
+            raise BrokerError(f'Error applying automation update: {result.err_msg}')
+        return dict(iid=iid)
+
+    async def _on_direct_action(self, act_session: session.ActSession, args: JsonDict, timeout: float) -> JsonDict:
+        additional_instruments = args.get('additional_instruments')
+        input_parameters = args.get('input_parameters')
+        direct_action = session.DirectActionData(
+            name=args['name'], base_instrument=args['base_instrument'],
+            additional_instruments=[session.NamedInstrument(name=name, instrument=instrument) for name, instrument in additional_instruments.items()]
+            if additional_instruments else None,
+            input_parameters=[session.StrProperty(name=name, value=value) for name, value in input_parameters.items()] if input_parameters else None,
+            action_status=args.get('action_status'))
+        result = await act_session.algo_sub_session.create_direct_action_async(direct_action=direct_action, timeout=timeout)
+        if not result.is_ok():
+            raise BrokerError(f'Failed to create direct action: {result.err_msg}')
+        return dict(action_name=result.action_name, automation_status=result.automation_status)
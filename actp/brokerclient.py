@@ -0,0 +1,161 @@
+"""
+Client side of the session broker (see broker.py), kept free of protobuf so a script routing through the broker starts fast
+"""
+import argparse
+import asyncio
+import dataclasses
+import getpass
+import json
+import os
+import stat
+import tempfile
+import typing as ty
+
+# commands carry passwords, so the socket goes in a directory only its user can get at: under XDG_RUNTIME_DIR (0700 by
+# design) if there is one, else a 0700 directory of its own in the shared temp dir, whose owner is checked before use
+DEFAULT_SOCKET_DIR = (os.path.join(os.environ['XDG_RUNTIME_DIR'], 'actp') if os.environ.get('XDG_RUNTIME_DIR')
+                      else os.path.join(tempfile.gettempdir(), f'actp-broker-{getpass.getuser()}'))
+DEFAULT_SOCKET_PATH = os.path.join(DEFAULT_SOCKET_DIR, 'broker.sock')
+# one command or reply per line, big enough for a large snapshot csv
+MAX_LINE_BYTES = 256 * 1024 * 1024
+
+JsonDict = ty.Dict[str, ty.Any]
+
+
+def add_broker_args(parser: argparse.ArgumentParser):
+    parser.add_argument('-b', '--broker', help=f'Run through the session broker (see act_broker.py) listening on this socket path, {DEFAULT_SOCKET_PATH} if no path is given',
+                        nargs='?', const=DEFAULT_SOCKET_PATH)
+
+
+class BrokerError(Exception):
+    """ The broker could not run a command, or could not be reached """
+    pass
+
+
+def check_socket_dir(socket_dir: str):
+    """ Raises BrokerError unless socket_dir belongs to the current user and no one else can write to it, i.e. swap the socket """
+    try:
+        dir_stat = os.stat(socket_dir)
+    except OSError as exc:
+        raise BrokerError(f'No broker socket directory {socket_dir}: {exc}') from exc
+    if dir_stat.st_uid != os.getuid():
+        raise BrokerError(f'Refusing broker socket directory {socket_dir}, it belongs to uid {dir_stat.st_uid} rather than {getpass.getuser()}')
+    if dir_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise BrokerError(f'Refusing broker socket directory {socket_dir}, other users can write to it')
+
+
+def make_socket_dir(socket_path: str):
+    """ Create the directory of socket_path owner only if it isn't there, raises BrokerError if it is there but not private """
+    socket_dir = os.path.dirname(os.path.abspath(socket_path))
+    os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+    check_socket_dir(socket_dir=socket_dir)
+
+
+def check_socket(socket_path: str):
+    """ Raises BrokerError unless socket_path is a socket of the current user in a directory check_socket_dir accepts
+
+    Whoever listens on the socket gets the passwords, it must not be another user's.
+    """
+    check_socket_dir(socket_dir=os.path.dirname(os.path.abspath(socket_path)))
+    try:
+        socket_stat = os.lstat(socket_path)
+    except OSError as exc:
+        raise BrokerError(f'No broker at {socket_path}: {exc}') from exc
+    if not stat.S_ISSOCK(socket_stat.st_mode):
+        raise BrokerError(f'{socket_path} is not a socket')
+    if socket_stat.st_uid != os.getuid():
+        raise BrokerError(f'Refusing broker socket {socket_path}, it belongs to uid {socket_stat.st_uid} rather than {getpass.getuser()}')
+
+
+@dataclasses.dataclass(unsafe_hash=True)
+class ActAddress:
+    """ Which Actant to run a command on and as whom, the broker keeps one logged on session per ActAddress """
+    ip: str
+    port: int
+    user: str
+    password: str
+
+    def to_json(self) -> JsonDict:
+        return dataclasses.asdict(self)
+
+    @classmethod
+    def from_json(cls, inp: JsonDict) -> 'ActAddress':
+        return ActAddress(ip=str(inp['ip']), port=int(inp['port']), user=str(inp['user']), password=str(inp['password']))
+
+
+class BrokerClient(object):
+    """ Sends commands to a running broker, one at a time, over a single connection """
+
+    def __init__(self, act_address: ActAddress, socket_path: str = DEFAULT_SOCKET_PATH):
+        self.act_address = act_address
+        self.socket_path = socket_path
+        self._reader: ty.Optional[asyncio.StreamReader] = None
+        self._writer: ty.Optional[asyncio.StreamWriter] = None
+
+    async def connect(self):
+        check_socket(socket_path=self.socket_path)
+        try:
+            self._reader, self._writer = await asyncio.open_unix_connection(path=self.socket_path, limit=MAX_LINE_BYTES)
+        except OSError as exc:
+            raise BrokerError(f'No broker at {self.socket_path}: {exc}') from exc
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
+            self._reader = None
+
+    async def __aenter__(self) -> 'BrokerClient':
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def send_command(self, command: str, timeout: ty.Optional[float] = None, **args) -> JsonDict:
+        """ Run command on the broker and return its reply, raises BrokerError if it failed """
+        if self._writer is None:
+            await self.connect()
+        message = dict(command=command, act=self.act_address.to_json(), timeout=timeout, args=args)
+        self._writer.write(json.dumps(message).encode('utf-8') + b'\n')
+        await self._writer.drain()
+        line = await self._reader.readline()
+        if not line:
+            raise BrokerError(f'Broker at {self.socket_path} closed the connection')
+        reply = json.loads(line)
+        if not reply.get('ok'):
+            raise BrokerError(reply.get('error') or f'{command} failed')
+        return reply
+
+    async def ping(self) -> JsonDict:
+        return await self.send_command('ping')
+
+    async def shutdown(self):
+        """ Have the broker log out its sessions and exit """
+        await self.send_command('shutdown')
+
+    async def snapshot(self, scope_keys: ty.List[str], fields: ty.List[str], no_triggers: ty.Optional[ty.List[str]] = None,
+                       contexts: ty.Optional[ty.List[str]] = None, timeout: ty.Optional[float] = None) -> str:
+        """ Run a snapshot DEX query and return it as csv, like DexQuery.as_csv """
+        reply = await self.send_command('snapshot', timeout=timeout, scope_keys=scope_keys, fields=fields, no_triggers=no_triggers, contexts=contexts)
+        return reply['csv']
+
+    async def update_table(self, csv: str, timeout: ty.Optional[float] = None):
+        """ Send a DEX table update in the csv format of dex.from_csv """
+        await self.send_command('table_update', timeout=timeout, csv=csv)
+
+    async def change_automation_status(self, product: str, automation_type: str, new_status: str, timeout: ty.Optional[float] = None) -> str:
+        """ Set the automation status of one of product's automation types, returns the iid the change was based on """
+        reply = await self.send_command('automation_update', timeout=timeout, product=product, automation_type=automation_type, new_status=new_status)
+        return reply['iid']
+
+    async def create_direct_action(self, name: str, base_instrument: str,
+                                   additional_instruments: ty.Optional[ty.Dict[str, str]] = None,
+                                   input_parameters: ty.Optional[ty.Dict[str, str]] = None,
+                                   action_status: ty.Optional[str] = None,
+                                   timeout: ty.Optional[float] = None) -> ty.Tuple[str, str]:
+        """ additional_instruments and input_parameters map names to instruments and values, returns (action name, automation status) """
+        reply = await self.send_command('direct_action', timeout=timeout, name=name, base_instrument=base_instrument,
+                                        additional_instruments=additional_instruments, input_parameters=input_parameters, action_status=action_status)
+        return reply['action_name'], reply['automation_status']
@@ -1,16 +1,27 @@
 import asyncio
+import collections
 import contextlib
+import dataclasses
 import enum
 import logging
 import struct
+import time
 import typing as ty
 
 import google.protobuf.message
 
+from . import wire
+from . import wiretap
 from .proto import Act_pb2 as act_pb
 
 ResponseHandler = ty.Callable[[act_pb.Response], None]
 
+ClientId = int
+# Decides from the frame envelope alone whether a response frame is decoded and delivered or dropped
+ResponseFilter = ty.Callable[[act_pb.SubProtocolType, ty.Optional[ClientId]], bool]
+# Gets the undecoded frame, returns True if it consumed it, False to have it decoded and passed to the response handler
+RawResponseHandler = ty.Callable[[memoryview, 'wire.ResponseEnvelope'], bool]
+
 ActConnectionToStrFunc = ty.Callable[['ActConnection'], str]
 
 
@@ -25,17 +36,75 @@ ErrMsg = str
 NewState = ActConnectionState
 OldState = ActConnectionState
 StateChangeHandler = ty.Callable[['ActConnection', NewState, ErrMsg, OldState], None]
+ResumeWritingHandler = ty.Callable[['ActConnection'], None]
 
 IncomingDataInspector = ty.Callable[[bytes], None]
 OutgoingDataInspector = ty.Callable[[bytes], None]
 
 
+@dataclasses.dataclass
+class WriteFlushStats:
+    """ Counters for coalesced writes, one flush is one transport.writelines call """
+    num_flushes: int = 0
+    num_frames: int = 0
+    num_bytes: int = 0
+    last_flush_frames: int = 0
+    last_flush_bytes: int = 0
+    max_flush_frames: int = 0
+    max_flush_bytes: int = 0
+
+    def on_flush(self, num_frames: int, num_bytes: int):
+        self.num_flushes += 1
+        self.num_frames += num_frames
+        self.num_bytes += num_bytes
+        self.last_flush_frames = num_frames
+        self.last_flush_bytes = num_bytes
+        self.max_flush_frames = max(self.max_flush_frames, num_frames)
+        self.max_flush_bytes = max(self.max_flush_bytes, num_bytes)
+
+
+@dataclasses.dataclass
+class FlowControlStats:
+    """ Counters for transport write flow control (pause_writing/resume_writing) """
+    num_pauses: int = 0
+    paused_secs: float = 0.0
+    max_pause_secs: float = 0.0
+    peak_buffered_bytes: int = 0
+
+    def on_resume(self, pause_secs: float):
+        self.paused_secs += pause_secs
+        self.max_pause_secs = max(self.max_pause_secs, pause_secs)
+
+
+@dataclasses.dataclass
+class _QueuedFrame:
+    """ A response being decoded a slice at a time, delivered once merges is exhausted """
+    response: act_pb.Response
+    merges: ty.Iterator[int]
+
+
+DEFAULT_DECODE_SLICE_BYTES = 256 * 1024
+
+DEFAULT_WRITE_HIGH_WATERMARK = 64 * 1024
+DEFAULT_WRITE_LOW_WATERMARK = 16 * 1024
+
+_FRAME_HEADER = struct.Struct('<L')  # little-endian, long
+_FRAME_HEADER_LEN = _FRAME_HEADER.size
+
+
 class ActConnection(asyncio.Protocol):
-    def __init__(self, ip: str, port: int, loop: asyncio.AbstractEventLoop):
+    def __init__(self, ip: str, port: int, loop: asyncio.AbstractEventLoop, coalesce_writes: bool = False,
+                 write_high_watermark: int = DEFAULT_WRITE_HIGH_WATERMARK,
+                 write_low_watermark: int = DEFAULT_WRITE_LOW_WATERMARK,
+                 sliced_decode_threshold: ty.Optional[int] = None,
+                 decode_slice_bytes: int = DEFAULT_DECODE_SLICE_BYTES):
         self.ip = ip
         self.port = port
         self.loop = loop
         self.on_response: ty.Optional[ResponseHandler] = None
+        self._response_filter: ty.Optional[ResponseFilter] = None
+        self._raw_response_handler: ty.Optional[RawResponseHandler] = None
+        self.num_filtered_frames: int = 0
         self.on_connected: asyncio.Future = loop.create_future()
         self.on_connection_lost: asyncio.Future = loop.create_future()
         self.transport: ty.Optional[asyncio.Transport] = None
@@ -43,11 +112,31 @@ class ActConnection(asyncio.Protocol):
         self.received_data: bytearray = bytearray()
         self.state = ActConnectionState.Unknown
         self.err_msg: ty.Optional[str] = None
+        self.disconnect_requested = False
         self._state_change_handlers: ty.List[StateChangeHandler] = []
+        self._resume_writing_handlers: ty.List[ResumeWritingHandler] = []
         self.to_str_func: ty.Optional[ActConnectionToStrFunc] = None
         self._pending_futures: ty.Optional[ty.Set[asyncio.Future]] = None
         self._outgoing_data_inspectors: ty.List[OutgoingDataInspector] = []
         self._incoming_data_inspectors: ty.List[IncomingDataInspector] = []
+        self.wire_tap: ty.Optional[wiretap.WireTap] = None
+        self.coalesce_writes = coalesce_writes
+        self.write_flush_stats = WriteFlushStats()
+        self._pending_writes: ty.List[bytes] = []
+        self._pending_write_frames: int = 0
+        self._pending_write_bytes: int = 0
+        self._flush_scheduled = False
+        self.write_high_watermark = write_high_watermark
+        self.write_low_watermark = write_low_watermark
+        self.flow_control_stats = FlowControlStats()
+        self._can_write = asyncio.Event()
+        self._can_write.set()
+        self._paused_at: ty.Optional[float] = None
+        # frames of at least sliced_decode_threshold bytes are decoded decode_slice_bytes at a time between other loop callbacks
+        self.sliced_decode_threshold = sliced_decode_threshold
+        self.decode_slice_bytes = decode_slice_bytes
+        self._decode_queue: ty.Deque[_QueuedFrame] = collections.deque()
+        self._decode_scheduled = False
 
     def set_to_str_func(self, to_str_func: ty.Optional[ActConnectionToStrFunc] = None):
         self.to_str_func = to_str_func
@@ -63,6 +152,10 @@ class ActConnection(asyncio.Protocol):
     def add_state_change_handler(self, state_change_handler: StateChangeHandler):
         self._state_change_handlers.append(state_change_handler)
 
+    def add_resume_writing_handler(self, resume_writing_handler: ResumeWritingHandler):
+        """ resume_writing_handler is called whenever writing may go on, e.g. to send requests held back while paused """
+        self._resume_writing_handlers.append(resume_writing_handler)
+
     async def connect(self):
         self._set_state(new_state=ActConnectionState.Connecting)
         try:
@@ -73,11 +166,30 @@ class ActConnection(asyncio.Protocol):
             self._logger.error(f'Failed to connect: {err}')
             self.on_connection_lost.set_result(False)
 
+    async def reconnect(self):
+        """ Connect again after the connection was lost, starting from clean receive and send state """
+        self._reset_connection_state()
+        await self.connect()
+
+    def _reset_connection_state(self):
+        self.transport = None
+        self.disconnect_requested = False
+        self.received_data = bytearray()
+        self._decode_queue.clear()
+        self._pending_writes = []
+        self._pending_write_frames = 0
+        self._pending_write_bytes = 0
+        self.resume_writing()
+        self.on_connected = self.loop.create_future()
+        self.on_connection_lost = self.loop.create_future()
+
     async def wait_on_disconnect(self):
         with contextlib.suppress(asyncio.exceptions.CancelledError):
             await self.on_connection_lost
 
     def disconnect(self):
+        self.disconnect_requested = True
+        self.flush_writes()
         self._set_state(new_state=ActConnectionState.Disconnected)
         if self.transport is not None:
             self._logger.info(f'Disconnecting from {self}')
@@ -91,51 +203,207 @@ class ActConnection(asyncio.Protocol):
     def set_response_handler(self, on_response: ResponseHandler):
         self.on_response = on_response
 
+    def set_response_filter(self, response_filter: ty.Optional[ResponseFilter]):
+        """ With a filter set, frames are routed on their wire envelope and only the wanted sub-response is decoded """
+        self._response_filter = response_filter
+
+    def set_raw_response_handler(self, raw_response_handler: ty.Optional[RawResponseHandler]):
+        """ Lets frames be consumed straight from the receive buffer, the frame is only valid during the call """
+        self._raw_response_handler = raw_response_handler
+
     def connection_made(self, transport: asyncio.Transport):
         self._logger.info(f'Connected to {self}')
         self.transport = transport
+        self.transport.set_write_buffer_limits(high=self.write_high_watermark, low=self.write_low_watermark)
         self._set_state(new_state=ActConnectionState.Connected)
         self.on_connected.set_result(True)
 
     def connection_lost(self, exc):
         self._logger.info(f'Disconnected from {self}')
-        self._set_state(new_state=ActConnectionState.Disconnected)
-        self.on_connection_lost.set_result(True)
+        self.transport = None
+        self._set_state(new_state=ActConnectionState.Disconnected, err_msg=str(exc) if exc is not None else None)
+        # release anyone waiting in send_request_async, their send will then fail as not connected
+        self.resume_writing()
+        if not self.on_connection_lost.done():
+            self.on_connection_lost.set_result(True)
+
+    def pause_writing(self):
+        self._logger.debug(f'Pausing writing to {self}, buffered:{self._get_write_buffer_size()}')
+        self._can_write.clear()
+        self._paused_at = time.perf_counter()
+        self.flow_control_stats.num_pauses += 1
+
+    def resume_writing(self):
+        if self._paused_at is not None:
+            self.flow_control_stats.on_resume(pause_secs=time.perf_counter() - self._paused_at)
+            self._paused_at = None
+            self._logger.debug(f'Resuming writing to {self}')
+        self._can_write.set()
+        for resume_writing_handler in self._resume_writing_handlers:
+            resume_writing_handler(self)
+
+    def is_writing_paused(self) -> bool:
+        return not self._can_write.is_set()
+
+    async def wait_writable(self):
+        """ Wait while the transport has paused writing """
+        if not self._can_write.is_set():
+            await self._can_write.wait()
 
     def send_request(self, request: act_pb.Request) -> bool:
+        return self.send_serialized_request(msg_data=request.SerializeToString())
+
+    def send_serialized_request(self, msg_data: bytes) -> bool:
+        """ Send an already serialized act_pb.Request """
         if self.transport is None:
             logging.warning(f'Not connected, no transport')
             return False
         if self.on_response is None:
             logging.warning(f'No response handler set, ignoring send request')
             return False
-        msg_data = request.SerializeToString()
-        packed_len = struct.pack('<L', len(msg_data))  # little-endian, long
-        data = packed_len + msg_data
-        for outgoing_data_inspector in self._outgoing_data_inspectors:
-            outgoing_data_inspector(data)
-        self.transport.write(data)
+        if self.wire_tap is not None:
+            self.wire_tap.on_outgoing(msg_data)
+        packed_len = _FRAME_HEADER.pack(len(msg_data))
+        if self._outgoing_data_inspectors:
+            data = packed_len + msg_data
+            for outgoing_data_inspector in self._outgoing_data_inspectors:
+                outgoing_data_inspector(data)
+        if self.coalesce_writes:
+            self._pending_writes.append(packed_len)
+            self._pending_writes.append(msg_data)
+            self._pending_write_frames += 1
+            self._pending_write_bytes += len(packed_len) + len(msg_data)
+            if self._pending_write_bytes >= self.write_high_watermark:
+                # keep the queue bounded, the transport will pause us if it can't keep up
+                self.flush_writes()
+            elif not self._flush_scheduled:
+                self._flush_scheduled = True
+                self.loop.call_soon(self.flush_writes)
+            return True
+        self.transport.write(packed_len + msg_data)
+        self._update_peak_buffered()
         return True
 
+    async def send_request_async(self, request: act_pb.Request) -> bool:
+        """ Like send_request, but waits while the transport has paused writing so the write buffer stays bounded """
+        await self.wait_writable()
+        return self.send_request(request=request)
+
+    async def send_serialized_request_async(self, msg_data: bytes) -> bool:
+        await self.wait_writable()
+        return self.send_serialized_request(msg_data=msg_data)
+
+    def flush_writes(self):
+        """ Hand all frames queued by send_request in coalescing mode to the transport in a single writelines """
+        self._flush_scheduled = False
+        if not self._pending_writes:
+            return
+        pending_writes = self._pending_writes
+        num_frames = self._pending_write_frames
+        num_bytes = self._pending_write_bytes
+        self._pending_writes = []
+        self._pending_write_frames = 0
+        self._pending_write_bytes = 0
+        if self.transport is None:
+            self._logger.warning(f'Not connected, dropping {num_frames} queued requests')
+            return
+        self.transport.writelines(pending_writes)
+        self.write_flush_stats.on_flush(num_frames=num_frames, num_bytes=num_bytes)
+        self._update_peak_buffered()
+
+    def _get_write_buffer_size(self) -> int:
+        if self.transport is None:
+            return 0
+        return self.transport.get_write_buffer_size()
+
+    def _update_peak_buffered(self):
+        buffered = self._get_write_buffer_size()
+        if buffered > self.flow_control_stats.peak_buffered_bytes:
+            self.flow_control_stats.peak_buffered_bytes = buffered
+
     def data_received(self, data: bytes):
         for incoming_data_inspector in self._incoming_data_inspectors:
             incoming_data_inspector(data)
-        self.received_data += bytearray(data)
-        while True:
-            received_len = len(self.received_data)
-            if received_len < 4:
+        self.received_data += data
+        consumed = self._decode_frames(buffer=self.received_data, end=len(self.received_data))
+        if consumed > 0:
+            # compact once per call rather than once per frame
+            del self.received_data[:consumed]
+
+    def _decode_frames(self, buffer: bytearray, end: int) -> int:
+        """ Decode every complete frame in buffer[0:end], return the number of bytes consumed """
+        offset = 0
+        with memoryview(buffer) as view:
+            while end - offset >= _FRAME_HEADER_LEN:
+                msg_len: int = _FRAME_HEADER.unpack_from(buffer, offset)[0]
+                frame_start = offset + _FRAME_HEADER_LEN
+                frame_end = frame_start + msg_len
+                if frame_end > end:
+                    break
+                offset = frame_end
+                with view[frame_start:frame_end] as frame:
+                    self._on_frame(frame=frame)
+        return offset
+
+    def _on_frame(self, frame: memoryview):
+        if self.wire_tap is not None:
+            self.wire_tap.on_incoming(frame)
+        try:
+            envelope = None
+            if self._response_filter is not None or self._raw_response_handler is not None:
+                envelope = wire.peek_response_envelope(frame=frame)
+            if self._response_filter is not None and not self._response_filter(envelope.sub_protocol_type, envelope.client_id):
+                self.num_filtered_frames += 1
+                return
+            if self._raw_response_handler is not None and not self._decode_queue and self._raw_response_handler(frame, envelope):
                 return
-            msg_len: int = struct.unpack('<L', self.received_data[0:4])[0]
-            if received_len < msg_len + 4:
+            if self.sliced_decode_threshold is not None and (self._decode_queue or len(frame) >= self.sliced_decode_threshold):
+                # once anything is queued, later frames queue behind it to keep wire order
+                self._queue_frame(frame=frame)
                 return
-            try:
+            if envelope is None:
                 response = act_pb.Response()
-                msg_data = bytes(self.received_data[4:msg_len + 4])
-                response.ParseFromString(msg_data)
-                self.received_data = self.received_data[msg_len + 4:]
-                self.on_response(response)
-            except google.protobuf.message.DecodeError:
-                logging.exception(f'exception decoding message')
+                response.ParseFromString(frame)
+            else:
+                response = wire.parse_response_body(frame=frame, envelope=envelope)
+        except (google.protobuf.message.DecodeError, wire.WireError):
+            logging.exception(f'exception decoding message')
+            return
+        self.on_response(response)
+
+    def _queue_frame(self, frame: memoryview):
+        data = bytes(frame)  # the receive buffer is reused once we return
+        response = act_pb.Response()
+        merges = wire.merge_in_slices(message=response, buffer=data, start=0, end=len(data), max_slice_bytes=self.decode_slice_bytes)
+        self._decode_queue.append(_QueuedFrame(response=response, merges=merges))
+        self._schedule_decode()
+
+    def _schedule_decode(self):
+        if not self._decode_scheduled:
+            self._decode_scheduled = True
+            self.loop.call_soon(self._decode_queued_frames)
+
+    def _decode_queued_frames(self):
+        """ Decode about decode_slice_bytes of the queued frames, deliver the ones completed in wire order, then yield to the loop """
+        self._decode_scheduled = False
+        budget = self.decode_slice_bytes
+        try:
+            while self._decode_queue and budget > 0:
+                queued_frame = self._decode_queue[0]
+                try:
+                    budget -= next(queued_frame.merges)
+                    continue
+                except StopIteration:
+                    pass
+                except (google.protobuf.message.DecodeError, wire.WireError):
+                    logging.exception(f'exception decoding message')
+                    self._decode_queue.popleft()
+                    continue
+                self._decode_queue.popleft()
+                self.on_response(queued_frame.response)
+        finally:
+            if self._decode_queue:
+                self._schedule_decode()
 
     def add_inspectors(self, incoming_data_inspector: ty.Optional[IncomingDataInspector], outgoing_data_inspector: ty.Optional[OutgoingDataInspector]):
         """ Functions to call on incoming data or outgoing data """
@@ -150,6 +418,10 @@ class ActConnection(asyncio.Protocol):
         if outgoing_data_inspector in self._outgoing_data_inspectors:
             self._outgoing_data_inspectors.remove(outgoing_data_inspector)
 
+    def set_wire_tap(self, wire_tap: ty.Optional[wiretap.WireTap]):
+        """ Have wire_tap capture every frame sent and received, None to detach it """
+        self.wire_tap = wire_tap
+
     def _set_state(self, new_state: ActConnectionState, err_msg: ty.Optional[str] = None):
         if new_state == self.state:
             return
@@ -158,3 +430,54 @@ class ActConnection(asyncio.Protocol):
         self.err_msg = err_msg
         for state_handler in self._state_change_handlers:
             state_handler(self, self.state, self.err_msg, old_state)
+
+
+class ActBufferedConnection(ActConnection, asyncio.BufferedProtocol):
+    """ ActConnection that has the transport read straight into a preallocated, growable receive buffer """
+
+    def __init__(self, ip: str, port: int, loop: asyncio.AbstractEventLoop,
+                 coalesce_writes: bool = False,
+                 write_high_watermark: int = DEFAULT_WRITE_HIGH_WATERMARK,
+                 write_low_watermark: int = DEFAULT_WRITE_LOW_WATERMARK,
+                 sliced_decode_threshold: ty.Optional[int] = None,
+                 decode_slice_bytes: int = DEFAULT_DECODE_SLICE_BYTES,
+                 initial_buffer_size: int = 256 * 1024,
+                 min_read_size: int = 64 * 1024):
+        super().__init__(ip=ip, port=port, loop=loop, coalesce_writes=coalesce_writes,
+                         write_high_watermark=write_high_watermark, write_low_watermark=write_low_watermark,
+                         sliced_decode_threshold=sliced_decode_threshold, decode_slice_bytes=decode_slice_bytes)
+        self._receive_buffer: bytearray = bytearray(initial_buffer_size)
+        self._receive_end: int = 0
+        self._min_read_size = min_read_size
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        needed = self._receive_end + max(sizehint, self._min_read_size)
+        if needed > len(self._receive_buffer):
+            self._grow_receive_buffer(needed=needed)
+        return memoryview(self._receive_buffer)[self._receive_end:]
+
+    def buffer_updated(self, nbytes: int):
+        start = self._receive_end
+        end = start + nbytes
+        self._receive_end = end
+        if self._incoming_data_inspectors:
+            data = bytes(self._receive_buffer[start:end])
+            for incoming_data_inspector in self._incoming_data_inspectors:
+                incoming_data_inspector(data)
+        consumed = self._decode_frames(buffer=self._receive_buffer, end=end)
+        if consumed > 0:
+            # move the partial frame (if any) to the front, same size assignment so the buffer is never resized
+            remaining = end - consumed
+            if remaining > 0:
+                self._receive_buffer[:remaining] = self._receive_buffer[consumed:end]
+            self._receive_end = remaining
+
+    def _reset_connection_state(self):
+        super()._reset_connection_state()
+        self._receive_end = 0
+
+    def _grow_receive_buffer(self, needed: int):
+        # the transport may still hold a view on the old buffer, so allocate a new one rather than resizing in place
+        receive_buffer = bytearray(max(needed, 2 * len(self._receive_buffer)))
+        receive_buffer[:self._receive_end] = self._receive_buffer[:self._receive_end]
+        self._receive_buffer = receive_buffer
@@ -1,15 +1,25 @@
+import asyncio
+import collections
 import csv
 import dataclasses
 import enum
 import io
 import logging
+import struct
 import sys
 import typing as ty
 
+from . import dexframe
+from . import dextable
 from . import session
+from . import wire
 from .proto import DataExchangeAPI_pb2 as dex_pb
 from .util import util
 
+if ty.TYPE_CHECKING:
+    import numpy
+    import pandas
+
 
 class DexQueryData(util.ClassHasEquality):
     def __init__(self, scope_keys: ty.List[str], fields: ty.List[str], is_snapshot: bool,
@@ -28,10 +38,12 @@ VariantVectorValue = ty.List[dex_pb.VariantValue]
 VariantValueToStrFunc = ty.Callable[[dex_pb.VariantValue, VariantVectorValue], str]
 
 DexColumnToStrFunc = ty.Callable[['DexColumn'], str]
+FieldValueToStrFunc = ty.Callable[[ty.Any], str]
+FieldValueToStrFuncs = ty.Dict[ty.Optional[str], FieldValueToStrFunc]  # by VariantValue field name, None for no field set
 
 
 class DexQuantity(util.ClassHasEquality):
-    ScalingFactor: int = 100000000
+    ScalingFactor: int = dextable.QUANTITY_SCALING_FACTOR
     Precision: int = 8
     _INVALID = -sys.maxsize - 1
     _Divisors = [100000000, 10000000, 1000000, 100000, 10000, 1000, 100, 10, 1]
@@ -110,7 +122,7 @@ class DexQuantity(util.ClassHasEquality):
 
 
 class DexPrice(util.ClassHasEquality):
-    ScalingFactor: int = 10000000
+    ScalingFactor: int = dextable.PRICE_SCALING_FACTOR
     Precision: int = 7
     _INVALID = -sys.maxsize - 1
     _Divisors = [10000000, 1000000, 100000, 10000, 1000, 100, 10, 1]
@@ -219,6 +231,52 @@ class DexPrice(util.ClassHasEquality):
         return DexPrice.from_value_and_precision(value=price, precision=decimals)
 
 
+class WireVariantValue(object):
+    """ Read-only stand-in for dex_pb.VariantValue, decoded straight from the wire without building a protobuf message """
+    __slots__ = ('field_name', 'field_value')
+    _Defaults = {'varInt': 0, 'varPrice': 0, 'varDouble': 0.0, 'varString': '', 'varQuantity': 0}
+
+    def __init__(self, field_name: ty.Optional[str], field_value: ty.Any):
+        self.field_name = field_name
+        self.field_value = field_value
+
+    def __getattr__(self, name: str) -> ty.Any:
+        # only called for the varXxx field names, the slots are found before getting here
+        if name not in self._Defaults:
+            raise AttributeError(name)
+        if name == self.field_name:
+            return self.field_value
+        return self._Defaults[name]
+
+    def __eq__(self, other: ty.Any) -> bool:
+        if isinstance(other, WireVariantValue):
+            return self.field_name == other.field_name and self.field_value == other.field_value
+        if isinstance(other, dex_pb.VariantValue):
+            return self.to_proto() == other
+        return False
+
+    def __hash__(self) -> int:
+        return hash((self.field_name, self.field_value))
+
+    def __repr__(self):
+        return f'{self.field_name}: {self.field_value}'
+
+    def HasField(self, field_name: str) -> bool:
+        return field_name == self.field_name
+
+    def to_proto(self) -> dex_pb.VariantValue:
+        value = dex_pb.VariantValue()
+        if self.field_name is not None:
+            setattr(value, self.field_name, self.field_value)
+        return value
+
+
+def variant_value_to_proto(value: ty.Union[dex_pb.VariantValue, WireVariantValue]) -> dex_pb.VariantValue:
+    if isinstance(value, WireVariantValue):
+        return value.to_proto()
+    return value
+
+
 def str_to_variant_value(inp: str, type: dex_pb.VariantType) -> dex_pb.VariantValue:
     value = dex_pb.VariantValue()
     if type == dex_pb.VariantType.VAR_UNKNOWN:
@@ -284,13 +342,16 @@ def variant_value_to_int(value: dex_pb.VariantValue) -> int:
 
 
 class DexColumn(util.ClassHasEquality):
-    def __init__(self, col_index: int, name: str, col_type: dex_pb.VariantType, is_vector: bool, can_write: bool, value_to_str_func: VariantValueToStrFunc):
+    def __init__(self, col_index: int, name: str, col_type: dex_pb.VariantType, is_vector: bool, can_write: bool, value_to_str_func: VariantValueToStrFunc,
+                 field_value_to_str_funcs: ty.Optional[FieldValueToStrFuncs] = None):
+        """ field_value_to_str_funcs: value_to_str_func per field, for the values a DexTable stores without their VariantValue """
         self.col_index = col_index
         self.name = name
         self.col_type = col_type
         self.is_vector = is_vector
         self.can_write = can_write
         self.value_to_str_func = value_to_str_func
+        self.field_value_to_str_funcs = field_value_to_str_funcs
         self.to_str_func: ty.Optional[DexColumnToStrFunc] = None
 
     def set_to_str_func(self, to_str_func: ty.Optional[DexColumnToStrFunc] = None):
@@ -334,6 +395,18 @@ class DexCell(util.ClassHasEquality):
     def value_str(self) -> str:
         return self.value_to_str_func(self.value, self.vector)
 
+    def get_float(self) -> ty.Optional[float]:
+        """ The value as a float, prices and quantities unscaled. None if there is no numeric value """
+        return dextable.variant_value_to_float(self.value)
+
+    def get_price_int(self) -> ty.Optional[int]:
+        """ The value as a varPrice, i.e. DexPrice.to_dex(). None if there is no numeric value """
+        return dextable.variant_value_to_price_int(self.value)
+
+    def get_quantity_int(self) -> ty.Optional[int]:
+        """ The value as a varQuantity, i.e. DexQuantity.to_dex(). None if there is no numeric value """
+        return dextable.variant_value_to_quantity_int(self.value)
+
 
 DexRowKeyToStrFunc = ty.Callable[['DexRowKey'], str]
 
@@ -375,6 +448,7 @@ class DexRow(util.ClassHasEquality):
         self.cells = cells
         for cell in self.cells:
             cell.row = self
+        self.update_count: int = 0
         self.to_str_func: ty.Optional[DexRowToStrFunc] = None
 
     def set_to_str_func(self, to_str_func: ty.Optional[DexRowToStrFunc] = None):
@@ -390,6 +464,7 @@ class DexRow(util.ClassHasEquality):
             return
         dex_cell = self.cells[cell.columnNumber]
         dex_cell.update_count = update_count
+        self.update_count = update_count
         if cell.HasField("value"):
             dex_cell.value = cell.value
         else:
@@ -406,6 +481,9 @@ class DexRow(util.ClassHasEquality):
     def get_updated_cells(self, update_count: int) -> DexCells:
         return self.get_cells(selector=lambda cell: cell.update_count >= update_count)
 
+    def get_cell(self, col_index: int) -> DexCell:
+        return self.cells[col_index]
+
     def get_cell_by_name(self, column_name: str) -> ty.Optional[DexCell]:
         return next((cell for cell in self.cells if cell.column.name == column_name), None)
 
@@ -414,7 +492,7 @@ class DexRow(util.ClassHasEquality):
         for cell in self.cells:
             dex_cell = dex_pb.Cell()
             dex_cell.columnNumber = cell.column.col_index
-            dex_cell.value.CopyFrom(cell.value)
+            dex_cell.value.CopyFrom(variant_value_to_proto(cell.value))
             dex_cells.append(dex_cell)
         dex_row = dex_pb.Row()
         dex_row.key = self.row_key.key
@@ -458,7 +536,328 @@ def get_variant_value_to_str_func(variant_type: dex_pb.VariantType, is_vector: b
     return get_variant_value_unknown
 
 
-DexRows = ty.List[DexRow]
+_FIELD_VALUE_TO_STR_FUNCS: ty.Dict[dex_pb.VariantType, FieldValueToStrFuncs] = {
+    dex_pb.VariantType.VAR_STRING: {'varString': str},
+    dex_pb.VariantType.VAR_DOUBLE: {'varDouble': lambda value: str(DexPrice.from_float(value))},
+    dex_pb.VariantType.VAR_INT32: {'varQuantity': lambda value: str(DexQuantity.from_dex(value)), 'varInt': str},
+    dex_pb.VariantType.VAR_PRICE: {
+        'varPrice': lambda value: str(DexPrice.from_dex(value=value)),
+        'varDouble': lambda value: str(DexPrice.from_float(value=value)),
+        'varQuantity': lambda value: str(DexPrice.from_float(value=DexQuantity.from_dex(value=value).to_float())),
+        'varInt': lambda value: str(DexPrice.from_float(value=value)),
+        'varString': lambda value: str(DexPrice.get_invalid()),
+        None: lambda value: str(DexPrice.get_invalid()),
+    },
+}
+
+
+def get_field_value_to_str_funcs(variant_type: dex_pb.VariantType) -> FieldValueToStrFuncs:
+    """ get_variant_value_to_str_func per field of the VariantValue, a field not in there gives '' """
+    return _FIELD_VALUE_TO_STR_FUNCS.get(variant_type, {})
+
+
+DexRows = ty.Sequence[DexRow]
+RowIndexes = ty.MutableSequence[int]
+
+
+def _to_stored_value(value: dex_pb.VariantValue) -> ty.Union[WireVariantValue, dex_pb.VariantValue]:
+    """ A VariantValue that doesn't keep the TableUpdate it came in alive, a copy if it has more than one field set """
+    fields = value.ListFields()
+    if len(fields) == 0:
+        return WireVariantValue(None, None)
+    if len(fields) == 1:
+        return WireVariantValue(fields[0][0].name, fields[0][1])
+    stored_value = dex_pb.VariantValue()
+    stored_value.CopyFrom(value)
+    return stored_value
+
+
+def _store_cell(stores: ty.List[dextable.DexColumnStore], row_index: int, update_count: int, cell: dex_pb.Cell) -> bool:
+    """ DexRow.update_cell for a row of a DexTable, False if the table has no such column """
+    if not 0 <= cell.columnNumber < len(stores):
+        return False
+    store = stores[cell.columnNumber]
+    store.update_counts[row_index] = update_count
+    if cell.HasField("value"):
+        fields = cell.value.ListFields()
+        if len(fields) == 0:
+            store.set_value(row_index=row_index, field_name=None, field_value=None)
+        elif len(fields) == 1:
+            store.set_value(row_index=row_index, field_name=fields[0][0].name, field_value=fields[0][1])
+        else:
+            store.set_object(row_index=row_index, value=_to_stored_value(cell.value))
+    else:
+        store.set_vector(row_index=row_index, vector=[_to_stored_value(value) for value in cell.valueVector])
+    return True
+
+
+def _get_stored_value(store: dextable.DexColumnStore, row_index: int) -> ty.Union[None, WireVariantValue, dex_pb.VariantValue]:
+    kind = store.kinds[row_index]
+    if kind == dextable.KIND_NONE:
+        return None
+    if kind == dextable.KIND_EMPTY:
+        return WireVariantValue(None, None)
+    if kind == dextable.KIND_OBJECT:
+        value = store.objects[row_index]
+        return value if isinstance(value, dex_pb.VariantValue) else WireVariantValue(*value)
+    return WireVariantValue(store.field_names[kind - 1], store.values[row_index])
+
+
+def _format_stored_value(column: DexColumn, store: dextable.DexColumnStore, row_index: int) -> str:
+    """ value_str of a cell of a DexTable, formatting the stored field value straight away when the column has field_value_to_str_funcs
+
+    A cell without a value, or with a VariantValue without any field set, gives the column type's None entry, e.g. INVALID for
+    a price, '' if there is none.
+    """
+    field_value_to_str_funcs = column.field_value_to_str_funcs
+    kind = store.kinds[row_index]
+    if field_value_to_str_funcs is None or kind == dextable.KIND_OBJECT:
+        return column.value_to_str_func(_get_stored_value(store, row_index), store.vectors.get(row_index))
+    if kind == dextable.KIND_NONE or kind == dextable.KIND_EMPTY:
+        to_str_func = field_value_to_str_funcs.get(None)
+        return to_str_func(None) if to_str_func is not None else ''
+    to_str_func = field_value_to_str_funcs.get(store.field_names[kind - 1])
+    return to_str_func(store.values[row_index]) if to_str_func is not None else ''
+
+
+class DexTableCell(DexCell):
+    """ A cell of a DexQuery, made on access and reading through to the column's DexColumnStore """
+    guessed_value: ty.Optional[str] = None
+    to_str_func: ty.Optional[DexCellToStrFunc] = None
+
+    def __init__(self, row: 'DexTableRow', column: DexColumn):
+        self.row = row
+        self.column = column
+        self.store = row.table.columns[column.col_index]
+
+    def __eq__(self, other: ty.Any) -> bool:
+        return isinstance(other, DexTableCell) and self.row == other.row and self.column.col_index == other.column.col_index
+
+    def __hash__(self) -> int:
+        return hash((self.row, self.column.col_index))
+
+    @property
+    def value_to_str_func(self) -> VariantValueToStrFunc:
+        return self.column.value_to_str_func
+
+    @property
+    def value(self) -> ty.Union[None, WireVariantValue, dex_pb.VariantValue]:
+        return _get_stored_value(self.store, self.row.row_index)
+
+    @property
+    def vector(self) -> ty.Optional[VariantVectorValue]:
+        return self.store.vectors.get(self.row.row_index)
+
+    @property
+    def update_count(self) -> int:
+        return self.store.update_counts[self.row.row_index]
+
+    def value_str(self) -> str:
+        return _format_stored_value(column=self.column, store=self.store, row_index=self.row.row_index)
+
+    def get_float(self) -> ty.Optional[float]:
+        return self.store.get_float(self.row.row_index)
+
+    def get_price_int(self) -> ty.Optional[int]:
+        return self.store.get_price_int(self.row.row_index)
+
+    def get_quantity_int(self) -> ty.Optional[int]:
+        return self.store.get_quantity_int(self.row.row_index)
+
+
+class DexTableRow(DexRow):
+    """ A row of a DexQuery, made on access. Rows are equal if they are the same row of the same table """
+    to_str_func: ty.Optional[DexRowToStrFunc] = None
+
+    def __init__(self, table: dextable.DexTable, columns: DexColumns, row_index: int):
+        self.table = table
+        self.columns = columns
+        self.row_index = row_index
+        self._cells: ty.Optional[DexCells] = None
+
+    def __eq__(self, other: ty.Any) -> bool:
+        return isinstance(other, DexTableRow) and self.table is other.table and self.row_index == other.row_index
+
+    def __hash__(self) -> int:
+        return hash((id(self.table), self.row_index))
+
+    @property
+    def row_key(self) -> DexRowKey:
+        return self.table.row_keys[self.row_index]
+
+    @property
+    def update_count(self) -> int:
+        return self.table.row_update_counts[self.row_index]
+
+    @property
+    def cells(self) -> DexCells:
+        """ Made on first access of this view, use get_cell for one or two of them """
+        if self._cells is None:
+            self._cells = [DexTableCell(self, column) for column in self.columns]
+        return self._cells
+
+    def get_cell(self, col_index: int) -> DexCell:
+        return DexTableCell(self, self.columns[col_index])
+
+    def get_updated_cells(self, update_count: int) -> DexCells:
+        """ Only makes views of the updated cells, the update counts are read from the column stores """
+        row_index = self.row_index
+        return [DexTableCell(self, column) for column, store in zip(self.columns, self.table.columns) if store.update_counts[row_index] >= update_count]
+
+    def get_cell_by_name(self, column_name: str) -> ty.Optional[DexCell]:
+        col_index = self.table.get_column_index(column_name)
+        return self.get_cell(col_index) if col_index is not None else None
+
+    def update_cell(self, update_count: int, cell: dex_pb.Cell):
+        if _store_cell(stores=self.table.columns, row_index=self.row_index, update_count=update_count, cell=cell):
+            self.table.row_update_counts[self.row_index] = update_count
+
+
+class DexTableRows(ty.Sequence[DexRow]):
+    """ DexTableRow views of all rows of a table, or of those at row_indexes """
+
+    def __init__(self, table: dextable.DexTable, columns: DexColumns, row_indexes: ty.Optional[ty.Sequence[int]] = None):
+        self.table = table
+        self.columns = columns
+        self.row_indexes = row_indexes
+
+    def __len__(self) -> int:
+        return self.table.num_rows if self.row_indexes is None else len(self.row_indexes)
+
+    def __getitem__(self, index: ty.Union[int, slice]) -> ty.Any:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        row_index = self.get_row_indexes()[index]
+        return DexTableRow(table=self.table, columns=self.columns, row_index=row_index)
+
+    def get_row_indexes(self) -> ty.Sequence[int]:
+        return range(self.table.num_rows) if self.row_indexes is None else self.row_indexes
+
+    def __iter__(self) -> ty.Iterator[DexRow]:
+        for row_index in self.get_row_indexes():
+            yield DexTableRow(table=self.table, columns=self.columns, row_index=row_index)
+
+    def __repr__(self):
+        return f'DexTableRows({len(self)} rows)'
+
+
+# Hand-written decoding of DataExchangeAPI TableUpdate wire data, the field numbers are from DataExchangeAPI.proto
+
+_unpack_double = struct.Struct('<d').unpack_from
+
+WireColumnDescriptor = ty.Tuple[str, dex_pb.VariantType, bool, bool]  # name, type, isVector, canWrite
+
+
+def _wire_read_tag(buffer: bytes, pos: int) -> ty.Tuple[int, int]:
+    tag = buffer[pos]
+    if tag < 0x80:
+        return tag, pos + 1
+    return wire.read_varint(buffer, pos)
+
+
+def _wire_decode_variant_value(buffer: bytes, pos: int, end: int) -> ty.Union[WireVariantValue, dex_pb.VariantValue]:
+    """ As _to_stored_value of the parsed VariantValue """
+    field_name, field_value = _wire_decode_variant_field(buffer, pos, end)
+    if field_name is None and field_value is not None:
+        return field_value
+    return WireVariantValue(field_name, field_value)
+
+
+def _wire_decode_variant_field(buffer: bytes, pos: int, end: int) -> ty.Tuple[ty.Optional[str], ty.Any]:
+    """ (field name, value) of the field set in a VariantValue, (None, None) if there is none
+
+    The fields aren't a oneof, in the rare value with more than one set this is (None, the dex_pb.VariantValue).
+    """
+    field_name = None
+    field_value = None
+    fields = None
+    while pos < end:
+        if field_name is not None:
+            if fields is None:
+                fields = dict()
+            fields[field_name] = field_value
+        tag = buffer[pos]
+        pos += 1
+        if tag == 0x10:  # varPrice, int64
+            field_value = buffer[pos]
+            pos += 1
+            if field_value >= 0x80:
+                field_value, pos = wire.read_varint(buffer, pos - 1)
+                if field_value >= 0x8000000000000000:
+                    field_value -= 0x10000000000000000
+            field_name = 'varPrice'
+        elif tag == 0x19:  # varDouble, double
+            field_name, field_value = 'varDouble', _unpack_double(buffer, pos)[0]
+            pos += 8
+        elif tag == 0x08:  # varInt, int32
+            raw, pos = wire.read_varint(buffer, pos)
+            field_name, field_value = 'varInt', wire.to_int32(raw)
+        elif tag == 0x22:  # varString, string
+            length, pos = wire.read_varint(buffer, pos)
+            field_name, field_value = 'varString', buffer[pos:pos + length].decode('utf-8')
+            pos += length
+        elif tag == 0x28:  # varQuantity, sint64
+            raw, pos = wire.read_varint(buffer, pos)
+            field_name, field_value = 'varQuantity', (raw >> 1) ^ -(raw & 1)
+        else:
+            tag, pos = _wire_read_tag(buffer, pos - 1)
+            pos = wire.skip_field(buffer, pos, tag & 0x7)
+    if fields is None:
+        return field_name, field_value
+    if field_name is not None:
+        fields[field_name] = field_value
+    if len(fields) == 1:
+        return next(iter(fields.items()))
+    value = dex_pb.VariantValue()
+    for field_name, field_value in fields.items():
+        setattr(value, field_name, field_value)
+    return None, value
+
+
+def _wire_decode_column_descriptor(buffer: bytes, pos: int, end: int) -> WireColumnDescriptor:
+    name = ''
+    col_type = dex_pb.VAR_UNKNOWN
+    is_vector = False
+    can_write = False
+    while pos < end:
+        tag, pos = _wire_read_tag(buffer, pos)
+        if tag == 0x0a:  # name, string
+            length, pos = wire.read_varint(buffer, pos)
+            name = buffer[pos:pos + length].decode('utf-8')
+            pos += length
+        elif tag == 0x10:  # type, VariantType
+            raw, pos = wire.read_varint(buffer, pos)
+            col_type = wire.to_int32(raw)
+        elif tag == 0x18:  # isVector, bool
+            raw, pos = wire.read_varint(buffer, pos)
+            is_vector = raw != 0
+        elif tag == 0x20:  # canWrite, bool
+            raw, pos = wire.read_varint(buffer, pos)
+            can_write = raw != 0
+        else:
+            pos = wire.skip_field(buffer, pos, tag & 0x7)
+    return name, col_type, is_vector, can_write
+
+
+def _wire_split_table_update(buffer: bytes, pos: int, end: int) -> ty.Tuple[ty.List[ty.Tuple[int, int]], ty.List[ty.Tuple[int, int]]]:
+    """ (start, end) of the column descriptors and of the rows of a TableUpdate """
+    column_descriptor_spans = []
+    row_spans = []
+    while pos < end:
+        tag, pos = _wire_read_tag(buffer, pos)
+        if tag == 0x12:  # row, repeated Row
+            length, pos = wire.read_varint(buffer, pos)
+            row_spans.append((pos, pos + length))
+            pos += length
+        elif tag == 0x0a:  # columnDescriptor, repeated ColumnDescriptor
+            length, pos = wire.read_varint(buffer, pos)
+            column_descriptor_spans.append((pos, pos + length))
+            pos += length
+        else:
+            pos = wire.skip_field(buffer, pos, tag & 0x7)
+    if pos != end:
+        raise wire.WireError(f'Field overruns TableUpdate end {end}')
+    return column_descriptor_spans, row_spans
 
 
 @dataclasses.dataclass(unsafe_hash=True)
@@ -494,6 +893,15 @@ def to_csv(columns: DexColumns, rows: DexRows, writer: ty.Optional[csv.writer] =
         column_types = [column.col_type_str() for column in columns]
         type_row = ['Type', *column_types]
         writer.writerow(type_row)
+    if isinstance(rows, DexTableRows):
+        # column by column from the stores, without making a view per row and cell
+        row_indexes = rows.get_row_indexes()
+        stores = rows.table.columns
+        column_values = [[_format_stored_value(column=column, store=stores[column.col_index], row_index=row_index) for row_index in row_indexes]
+                         for column in rows.columns]
+        row_keys = [rows.table.row_keys[row_index].key for row_index in row_indexes]
+        writer.writerows([key, *row_values] for key, row_values in zip(row_keys, zip(*column_values) if column_values else [()] * len(row_keys)))
+        return output.getvalue()
     for row in rows:
         row_values = [cell.value_str() for cell in row.cells]
         writer.writerow([row.row_key.key, *row_values])
@@ -558,20 +966,25 @@ ColumnsReceivedHandler = ty.Callable[['DexQuery', ty.List[DexColumn]], None]
 
 UpdateCount = int
 NumRows = int
-NewRows = ty.List[DexRow]
-NewUpdatedRows = ty.List[DexRow]
+NewRows = ty.Sequence[DexRow]
+NewUpdatedRows = ty.Sequence[DexRow]
 UpdateHandler = ty.Callable[['DexQuery', UpdateCount, NumRows, NewRows, NewUpdatedRows], None]
 
-DeletedRows = ty.List[DexRow]
+DeletedRows = ty.Sequence[DexRow]
 ResetHandler = ty.Callable[['DexQuery', UpdateCount, DeletedRows], None]
 
-DexQueryToStrFunc = ty.Callable[['DexQuery'], str]
+ChangeSetHandler = ty.Callable[['DexQuery', dextable.DexChangeSet], None]
 
+DexQueryToStrFunc = ty.Callable[['DexQuery'], str]
 
 class DexQuery(object):
 
-    def __init__(self, query_data: DexQueryData, act_session: session.ActSession):
+    def __init__(self, query_data: DexQueryData, act_session: session.ActSession, wire_decode: bool = False, change_history: int = 16):
+        """ wire_decode: have table updates decoded from the wire straight into the rows (on_table_update_wire)
+        change_history: how many of the last updates' DexChangeSets to keep, for change_sets and get_updated_rows
+        """
         self.query_data = query_data
+        self.wire_decode = wire_decode
         self.act_session = act_session
         self.logger = logging.getLogger(__name__)
         self.state = DexQueryState.Unknown
@@ -579,13 +992,19 @@ class DexQuery(object):
         self.client_id: ty.Optional[int] = None
         self.update_count: int = 0
         self.columns: DexColumns = []
-        self.rows: DexRows = []
-        self._row_keys: ty.Dict[DexRowKey, int] = dict()
+        self._table = dextable.DexTable(col_types=[])
+        self._key_row_indexes: ty.Dict[str, int] = dict()  # first row with the key, whatever its contexts
         self._row_number_keys: ty.Dict[int, DexRowKey] = dict()
+        self._column_descriptors: ty.List[WireColumnDescriptor] = []
+        # set by restart(), the next snapshot is diffed against the rows we have
+        self._resync = False
+        self._resync_table: ty.Optional[dextable.DexTable] = None
         self._state_change_handlers: ty.List[StateChangeHandler] = []
         self._columns_received_handlers: ty.List[ColumnsReceivedHandler] = []
         self._update_handlers: ty.List[UpdateHandler] = []
         self._reset_handlers: ty.List[ResetHandler] = []
+        self._change_set_handlers: ty.List[ChangeSetHandler] = []
+        self.change_sets: ty.Deque[dextable.DexChangeSet] = collections.deque(maxlen=change_history)
 
         self.to_str_func: ty.Optional[DexQueryToStrFunc] = None
 
@@ -597,11 +1016,21 @@ class DexQuery(object):
             return self.to_str_func(self)
         return f'({self.act_session}:{self.client_id})'
 
+    @property
+    def rows(self) -> DexRows:
+        """ All rows, in the order they arrived. The DexRow and DexCell objects are views made on access, the values are in the table """
+        return DexTableRows(table=self._table, columns=self.columns)
+
+    @property
+    def table(self) -> dextable.DexTable:
+        return self._table
+
     def add_handlers(self,
                      state_change_handler: ty.Optional[StateChangeHandler] = None,
                      columns_received_handler: ty.Optional[ColumnsReceivedHandler] = None,
                      update_handler: ty.Optional[UpdateHandler] = None,
                      reset_handler: ty.Optional[ResetHandler] = None,
+                     change_set_handler: ty.Optional[ChangeSetHandler] = None,
                      ):
         if state_change_handler is not None:
             self._state_change_handlers.append(state_change_handler)
@@ -611,6 +1040,8 @@ class DexQuery(object):
             self._update_handlers.append(update_handler)
         if reset_handler is not None:
             self._reset_handlers.append(reset_handler)
+        if change_set_handler is not None:
+            self._change_set_handlers.append(change_set_handler)
 
     def start(self):
         self._change_state(new_state=DexQueryState.Starting)
@@ -621,7 +1052,25 @@ class DexQuery(object):
                                                                       no_triggers=self.query_data.no_triggers,
                                                                       contexts=self.query_data.contexts,
                                                                       ack_handler=self.on_start_query,
-                                                                      table_update_handler=self.on_table_update)
+                                                                      table_update_handler=self.on_table_update,
+                                                                      raw_table_update_handler=self.on_table_update_wire if self.wire_decode else None)
+
+    def restart(self):
+        """ Start again, e.g. on a new connection. Cells the fresh snapshot leaves unchanged are not reported as updated
+
+        Rows the fresh snapshot doesn't have are removed, their keys are in the change set's deleted_row_keys. The row
+        indexes of the rows after them change.
+        """
+        if self.client_id is not None:
+            self.act_session.dex_sub_session.discard_query(client_id=self.client_id)
+        self._row_number_keys.clear()
+        self._resync = True
+        self.start()
+
+    def is_streaming(self) -> bool:
+        """ Whether the query is (being) started and keeps getting updates, i.e. should be restarted after a reconnect """
+        return not self.query_data.is_snapshot and self.state in (DexQueryState.Starting, DexQueryState.Started, DexQueryState.ColumnsReceived,
+                                                                 DexQueryState.Disconnected)
 
     def stop(self):
         self._change_state(new_state=DexQueryState.Stopping)
@@ -639,58 +1088,355 @@ class DexQuery(object):
         else:
             self._change_state(new_state=DexQueryState.Stopped)
 
+    def on_disconnected(self):
+        self._change_state(new_state=DexQueryState.Disconnected)
+
     def on_table_update(self, client_id: int, err_msg: str, update: dex_pb.TableUpdate):
         self.update_count += 1
         if len(update.columnDescriptor) > 0:
-            self._reset()
-            for i, column_descriptor_x in enumerate(update.columnDescriptor):
-                column_descriptor: dex_pb.ColumnDescriptor = column_descriptor_x
-                dex_column = DexColumn(col_index=i,
-                                       name=column_descriptor.name,
-                                       col_type=column_descriptor.type,
-                                       is_vector=column_descriptor.isVector,
-                                       can_write=column_descriptor.canWrite,
-                                       value_to_str_func=get_variant_value_to_str_func(column_descriptor.type, is_vector=column_descriptor.isVector))
-                self.columns.append(dex_column)
-            self._change_state(new_state=DexQueryState.ColumnsReceived)
-            for columns_received_handler in self._columns_received_handlers:
-                columns_received_handler(self, self.columns)
-
-        current_rows = self.rows
-        new_rows: ty.List[DexRow] = []
-        new_updated_rows: ty.List[DexRow] = []
+            self._set_columns(column_descriptors=[(column_descriptor.name, column_descriptor.type, column_descriptor.isVector, column_descriptor.canWrite)
+                                                  for column_descriptor in update.columnDescriptor])
+
+        if self._table.num_rows == 0:
+            self._table.reserve(capacity=len(update.row))
+        stores = self._table.columns
+        row_update_counts = self._table.row_update_counts
+        change_set = dextable.DexChangeSet(update_count=self.update_count)
+        col_indexes = change_set.col_indexes
         for row_x in update.row:
             row: dex_pb.Row = row_x
-            row_key = self._get_row_key(row=row)
-            if row_key not in self._row_keys:
-                self._row_keys[row_key] = len(current_rows)
-                cells: ty.List[DexCell] = []
-                for column in self.columns:
-                    cells.append(DexCell(column=column, value_to_str_func=column.value_to_str_func))
-                dex_row = DexRow(row_index=len(current_rows), row_key=row_key, cells=cells)
-                current_rows.append(dex_row)
-                new_rows.append(dex_row)
-            row_index = self._row_keys[row_key]
-            dex_row = current_rows[row_index]
+            row_index = self._get_or_add_row(row_key=self._get_row_key(row=row), new_rows=change_set.new_rows)
+            row_update_counts[row_index] = self.update_count
             for cell in row.cell:
-                dex_row.update_cell(cell=cell, update_count=self.update_count)
-            new_updated_rows.append(dex_row)
-        self.rows = current_rows
+                if _store_cell(stores=stores, row_index=row_index, update_count=self.update_count, cell=cell):
+                    col_indexes.append(cell.columnNumber)
+            change_set.end_row(row_index)
+        self._notify_update(change_set=change_set)
+
+    def on_table_update_wire(self, client_id: int, err_msg: str, buffer: wire.Buffer, start: int, end: int):
+        """ on_table_update for an undecoded TableUpdate in buffer[start:end], writes straight into the rows without protobuf messages """
+        # one copy to bytes, indexing bytes is much cheaper than indexing a memoryview
+        buffer = bytes(buffer[start:end])
+        column_descriptor_spans, row_spans = _wire_split_table_update(buffer, 0, len(buffer))
+        self.update_count += 1
+        if column_descriptor_spans:
+            self._set_columns(column_descriptors=[_wire_decode_column_descriptor(buffer, span_start, span_end)
+                                                  for span_start, span_end in column_descriptor_spans])
+
+        if self._table.num_rows == 0:
+            self._table.reserve(capacity=len(row_spans))
+        change_set = dextable.DexChangeSet(update_count=self.update_count)
+        for row_start, row_end in row_spans:
+            self._apply_wire_row(buffer=buffer, pos=row_start, end=row_end, change_set=change_set)
+        self._notify_update(change_set=change_set)
+
+    def _apply_wire_row(self, buffer: bytes, pos: int, end: int, change_set: dextable.DexChangeSet):
+        """ Decode a Row, write its cells into the table and add them to change_set. The hot path of the wire decoder, hence everything inlined """
+        key = ''
+        contexts = ''
+        cell_spans = []
+        while pos < end:
+            tag = buffer[pos]
+            pos += 1
+            if tag == 0x12:  # cell, repeated Cell, decoded once key and contexts are known
+                length = buffer[pos]
+                pos += 1
+                if length >= 0x80:
+                    length, pos = wire.read_varint(buffer, pos - 1)
+                cell_spans.append(pos)
+                pos += length
+                cell_spans.append(pos)
+            elif tag == 0x0a:  # key, string
+                length, pos = wire.read_varint(buffer, pos)
+                key = buffer[pos:pos + length].decode('utf-8')
+                pos += length
+            elif tag == 0x1a:  # contexts, string
+                length, pos = wire.read_varint(buffer, pos)
+                contexts = buffer[pos:pos + length].decode('utf-8')
+                pos += length
+            else:
+                tag, pos = _wire_read_tag(buffer, pos - 1)
+                pos = wire.skip_field(buffer, pos, tag & 0x7)
+
+        row_index = self._get_or_add_row(row_key=DexRowKey(key=key, contexts=contexts), new_rows=change_set.new_rows)
+        stores = self._table.columns
+        num_cells = len(stores)
+        update_count = self.update_count
+        self._table.row_update_counts[row_index] = update_count
+        add_col_index = change_set.col_indexes.append
+        for i in range(0, len(cell_spans), 2):
+            pos = cell_spans[i]
+            cell_end = cell_spans[i + 1]
+            column_number = 0
+            has_value = False
+            field_name = None
+            field_value = None
+            vector = None
+            while pos < cell_end:
+                tag = buffer[pos]
+                pos += 1
+                if tag == 0x08:  # columnNumber, int32
+                    column_number = buffer[pos]
+                    pos += 1
+                    if column_number >= 0x80:
+                        raw, pos = wire.read_varint(buffer, pos - 1)
+                        column_number = wire.to_int32(raw)
+                elif tag == 0x12:  # value, VariantValue
+                    length = buffer[pos]
+                    pos += 1
+                    if length >= 0x80:
+                        length, pos = wire.read_varint(buffer, pos - 1)
+                    value_end = pos + length
+                    if length and buffer[pos] == 0x10:  # inline the usual single varPrice value
+                        price = buffer[pos + 1]
+                        price_end = pos + 2
+                        if price >= 0x80:
+                            price, price_end = wire.read_varint(buffer, pos + 1)
+                            if price >= 0x8000000000000000:
+                                price -= 0x10000000000000000
+                        if price_end == value_end:
+                            has_value, field_name, field_value = True, 'varPrice', price
+                            pos = value_end
+                            continue
+                    field_name, field_value = _wire_decode_variant_field(buffer, pos, value_end)
+                    has_value = True
+                    pos = value_end
+                elif tag == 0x1a:  # valueVector, repeated VariantValue
+                    length, pos = wire.read_varint(buffer, pos)
+                    if vector is None:
+                        vector = []
+                    vector.append(_wire_decode_variant_value(buffer, pos, pos + length))
+                    pos += length
+                else:
+                    tag, pos = _wire_read_tag(buffer, pos - 1)
+                    pos = wire.skip_field(buffer, pos, tag & 0x7)
+            # same as _store_cell
+            if not 0 <= column_number < num_cells:
+                continue
+            store = stores[column_number]
+            store.update_counts[row_index] = update_count
+            if has_value:
+                if field_name is None and field_value is not None:
+                    store.set_object(row_index, field_value)
+                else:
+                    store.set_value(row_index, field_name, field_value)
+            else:
+                store.set_vector(row_index, vector if vector is not None else [])
+            add_col_index(column_number)
+        change_set.end_row(row_index)
+
+    def _set_columns(self, column_descriptors: ty.List[WireColumnDescriptor]):
+        if self._resync and column_descriptors == self._column_descriptors:
+            self._resync_table = self._table.copy()
+            self._change_state(new_state=DexQueryState.ColumnsReceived)
+            return
+        self._reset()
+        self._column_descriptors = column_descriptors
+        for i, (name, col_type, is_vector, can_write) in enumerate(column_descriptors):
+            dex_column = DexColumn(col_index=i,
+                                   name=name,
+                                   col_type=col_type,
+                                   is_vector=is_vector,
+                                   can_write=can_write,
+                                   value_to_str_func=get_variant_value_to_str_func(col_type, is_vector=is_vector),
+                                   field_value_to_str_funcs=get_field_value_to_str_funcs(col_type))
+            self.columns.append(dex_column)
+        self._table = dextable.DexTable(col_types=[col_type for _, col_type, _, _ in column_descriptors],
+                                        col_names=[name for name, _, _, _ in column_descriptors])
+        self._change_state(new_state=DexQueryState.ColumnsReceived)
+        for columns_received_handler in self._columns_received_handlers:
+            columns_received_handler(self, self.columns)
+
+    def _get_or_add_row(self, row_key: DexRowKey, new_rows: RowIndexes) -> int:
+        row_index = self._table.get_row_index(row_key)
+        if row_index is not None:
+            return row_index
+        row_index = self._table.add_row(row_key)
+        self._key_row_indexes.setdefault(row_key.key, row_index)
+        new_rows.append(row_index)
+        return row_index
+
+    def _notify_update(self, change_set: dextable.DexChangeSet):
+        if self._resync_table is not None:
+            change_set = self._drop_unchanged_cells(change_set=change_set)
+            self._resync_table = None
+        self._resync = False
+        self.change_sets.append(change_set)
+        new_rows = DexTableRows(table=self._table, columns=self.columns, row_indexes=change_set.new_rows)
+        new_updated_rows = DexTableRows(table=self._table, columns=self.columns, row_indexes=change_set.updated_rows)
         for update_handler in self._update_handlers:
-            update_handler(self, self.update_count, len(self.rows), new_rows, new_updated_rows)
+            update_handler(self, self.update_count, self._table.num_rows, new_rows, new_updated_rows)
+        for change_set_handler in self._change_set_handlers:
+            change_set_handler(self, change_set)
+
+    def _drop_unchanged_cells(self, change_set: dextable.DexChangeSet) -> dextable.DexChangeSet:
+        """ Undo the update of cells the resync snapshot left as they were, keeping only the cells and rows with a real change
+
+        Rows the resync snapshot doesn't have are removed.
+        """
+        resync_table = self._resync_table
+        num_resync_rows = resync_table.num_rows
+        stores = self._table.columns
+        changed_set = dextable.DexChangeSet(update_count=change_set.update_count)
+        changed_set.new_rows = change_set.new_rows
+        for i, row_index in enumerate(change_set.updated_rows):
+            col_indexes = change_set.get_col_indexes(i)
+            if row_index >= num_resync_rows:
+                changed_set.col_indexes.extend(col_indexes)
+                changed_set.end_row(row_index)
+                continue
+            num_changed = 0
+            for col_index in col_indexes:
+                store = stores[col_index]
+                if store.update_counts[row_index] != self.update_count:
+                    continue
+                resync_store = resync_table.columns[col_index]
+                if store.is_same(row_index=row_index, other=resync_store):
+                    store.update_counts[row_index] = resync_store.update_counts[row_index]
+                else:
+                    changed_set.col_indexes.append(col_index)
+                    num_changed += 1
+            if num_changed > 0:
+                changed_set.end_row(row_index)
+        changed_rows = set(changed_set.updated_rows)
+        seen_rows = {row_index for row_index in change_set.updated_rows if row_index < num_resync_rows}
+        for row_index in seen_rows - changed_rows:
+            self._table.row_update_counts[row_index] = resync_table.row_update_counts[row_index]
+        if len(seen_rows) < num_resync_rows:
+            self._remove_rows(row_indexes=[row_index for row_index in range(num_resync_rows) if row_index not in seen_rows], change_set=changed_set)
+        self.logger.info(f'Resynced {self}: {len(changed_rows)} changed rows, {len(changed_set.deleted_row_keys)} rows not in the new snapshot removed')
+        return changed_set
+
+    def _remove_rows(self, row_indexes: ty.Sequence[int], change_set: dextable.DexChangeSet):
+        """ Replace the table by one without the rows, listing them in change_set.deleted_row_keys. The other rows' indexes change
+
+        Rows and cells already handed out keep reading the old table, so they don't turn into views of another key.
+        """
+        removed = set(row_indexes)
+        change_set.deleted_row_keys = [self._table.row_keys[row_index] for row_index in row_indexes]
+        kept_row_indexes = [row_index for row_index in range(self._table.num_rows) if row_index not in removed]
+        new_indexes = [-1] * self._table.num_rows
+        for new_index, row_index in enumerate(kept_row_indexes):
+            new_indexes[row_index] = new_index
+        self._table = self._table.take_rows(row_indexes=kept_row_indexes)
+        change_set.remap_rows(new_indexes=new_indexes)
+        # the older change sets' row indexes are from before
+        self.change_sets.clear()
+        self._key_row_indexes.clear()
+        for row_index, row_key in enumerate(self._table.row_keys):
+            self._key_row_indexes.setdefault(row_key.key, row_index)
 
     def get_rows(self, selector: ty.Callable[[DexRow], bool]) -> DexRows:
         return [row for row in self.rows if selector(row)]
 
     def get_updated_rows(self, update_count: int) -> DexRows:
-        return self.get_rows(selector=lambda row: row.update_count >= update_count)
-
-    def get_row_by_key(self, key: str) -> ty.Optional[DexRow]:
-        return next((row for row in self.rows if row.row_key.key == key), None)
+        """ Rows updated by update update_count or later, in row order. From the change sets if they go back that far """
+        if self.change_sets and self.change_sets[0].update_count <= update_count:
+            row_indexes = sorted({row_index for change_set in self.change_sets if change_set.update_count >= update_count
+                                  for row_index in change_set.updated_rows})
+        else:
+            row_indexes = self._table.get_updated_row_indexes(update_count=update_count)
+        return DexTableRows(table=self._table, columns=self.columns, row_indexes=row_indexes)
+
+    def get_change_set(self, update_count: int) -> ty.Optional[dextable.DexChangeSet]:
+        """ What update update_count changed, None if it is not among the last change_history updates """
+        if not self.change_sets or update_count < self.change_sets[0].update_count:
+            return None
+        index = update_count - self.change_sets[0].update_count
+        return self.change_sets[index] if index < len(self.change_sets) else None
+
+    def get_row_by_key(self, key: str, contexts: ty.Optional[str] = None) -> ty.Optional[DexRow]:
+        """ The first row with key whatever its contexts, or with contexts given the row with exactly that key and contexts """
+        row_index = self._get_row_index(key=key, contexts=contexts)
+        return DexTableRow(table=self._table, columns=self.columns, row_index=row_index) if row_index is not None else None
+
+    def get_column_index(self, column_name: str) -> ty.Optional[int]:
+        return self._table.get_column_index(column_name)
+
+    def get_column(self, column_name: str) -> ty.Optional[DexColumn]:
+        col_index = self._table.get_column_index(column_name)
+        return self.columns[col_index] if col_index is not None else None
+
+    def get_cell(self, key: str, column_name: str, contexts: ty.Optional[str] = None) -> ty.Optional[DexCell]:
+        row = self.get_row_by_key(key=key, contexts=contexts)
+        return row.get_cell_by_name(column_name=column_name) if row is not None else None
+
+    def get_value(self, key: str, column_name: str, contexts: ty.Optional[str] = None) -> ty.Optional[dex_pb.VariantValue]:
+        """ The value of a cell, None if there is no such row or column or the cell has no value yet """
+        row_index = self._get_row_index(key=key, contexts=contexts)
+        col_index = self._table.get_column_index(column_name)
+        if row_index is None or col_index is None:
+            return None
+        return _get_stored_value(self._table.columns[col_index], row_index)
+
+    def get_values(self, keys: ty.Sequence[str], column_names: ty.Sequence[str],
+                   contexts: ty.Optional[str] = None) -> ty.List[ty.List[ty.Optional[dex_pb.VariantValue]]]:
+        """ Per key, the values of column_names as get_value returns them. Each key and column name is looked up once """
+        stores = [self._table.columns[col_index] if col_index is not None else None
+                  for col_index in (self._table.get_column_index(column_name) for column_name in column_names)]
+        values = []
+        for key in keys:
+            row_index = self._get_row_index(key=key, contexts=contexts)
+            values.append([_get_stored_value(store, row_index) if store is not None and row_index is not None else None for store in stores])
+        return values
+
+    def get_float(self, key: str, column_name: str, contexts: ty.Optional[str] = None) -> ty.Optional[float]:
+        """ DexCell.get_float of a cell, None if there is no such row or column """
+        row_index, store = self._get_row_index_and_store(key=key, column_name=column_name, contexts=contexts)
+        return store.get_float(row_index) if store is not None else None
+
+    def get_price_int(self, key: str, column_name: str, contexts: ty.Optional[str] = None) -> ty.Optional[int]:
+        row_index, store = self._get_row_index_and_store(key=key, column_name=column_name, contexts=contexts)
+        return store.get_price_int(row_index) if store is not None else None
+
+    def get_quantity_int(self, key: str, column_name: str, contexts: ty.Optional[str] = None) -> ty.Optional[int]:
+        row_index, store = self._get_row_index_and_store(key=key, column_name=column_name, contexts=contexts)
+        return store.get_quantity_int(row_index) if store is not None else None
+
+    def _get_row_index_and_store(self, key: str, column_name: str, contexts: ty.Optional[str]) -> ty.Tuple[int, ty.Optional[dextable.DexColumnStore]]:
+        row_index = self._get_row_index(key=key, contexts=contexts)
+        col_index = self._table.get_column_index(column_name)
+        if row_index is None or col_index is None:
+            return 0, None
+        return row_index, self._table.columns[col_index]
+
+    def _get_row_index(self, key: str, contexts: ty.Optional[str]) -> ty.Optional[int]:
+        if contexts is None:
+            return self._key_row_indexes.get(key)
+        return self._table.get_row_index(DexRowKey(key=key, contexts=contexts))
 
     def as_csv(self, csv_writer: ty.Optional[csv.writer] = None, with_type_row: ty.Optional[bool] = None) -> str:
         return to_csv(columns=self.columns, rows=self.rows, writer=csv_writer, with_type_row=with_type_row)
 
+    def to_numpy(self, column_names: ty.Optional[ty.Sequence[str]] = None, copy: bool = False) -> ty.Dict[str, 'numpy.ndarray']:
+        """ The values of column_names (all columns if None) by name, one array entry per row. Needs numpy
+
+        See dexframe.column_to_numpy for the array types. Unless copy, numeric columns share the table's buffers where they can,
+        those arrays are read-only and follow later updates of their rows until the table grows or drops rows.
+        """
+        return {column.name: dexframe.column_to_numpy(store=self._table.columns[column.col_index], num_rows=self._table.num_rows, copy=copy)
+                for column in self._get_columns(column_names=column_names)}
+
+    def to_dataframe(self, column_names: ty.Optional[ty.Sequence[str]] = None, prices_as_float: bool = True, copy: bool = True) -> 'pandas.DataFrame':
+        """ The values of column_names (all columns if None) in a DataFrame indexed by row key. Needs pandas
+
+        A copy unless not copy, then columns shared as in to_numpy make the DataFrame follow later updates of their rows.
+        """
+        columns = self._get_columns(column_names=column_names)
+        return dexframe.table_to_dataframe(table=self._table, col_names=[column.name for column in columns], col_indexes=[column.col_index for column in columns],
+                                           index=[str(row_key) for row_key in self._table.row_keys], prices_as_float=prices_as_float, copy=copy)
+
+    def _get_columns(self, column_names: ty.Optional[ty.Sequence[str]]) -> DexColumns:
+        if column_names is None:
+            return self.columns
+        columns = []
+        for column_name in column_names:
+            column = self.get_column(column_name=column_name)
+            if column is None:
+                raise KeyError(f'No column {column_name} in {self}')
+            columns.append(column)
+        return columns
+
     def _get_row_key(self, row: dex_pb.Row) -> DexRowKey:
         row_number = None
         try:
@@ -708,11 +1454,13 @@ class DexQuery(object):
 
     def _reset(self):
         for reset_handler in self._reset_handlers:
-            reset_handler(self, len(self.rows), self.rows)
+            reset_handler(self, self._table.num_rows, self.rows)
         self.columns = []
-        self.rows = []
-        self._row_keys.clear()
+        self._table = dextable.DexTable(col_types=[])
+        self._key_row_indexes.clear()
         self._row_number_keys.clear()
+        self.change_sets.clear()
+        self._column_descriptors = []
 
     def _change_state(self, new_state: DexQueryState, err_msg: str = None):
         old_state = self.state
@@ -720,3 +1468,35 @@ class DexQuery(object):
         self.err_msg = err_msg
         for state_change_handler in self._state_change_handlers:
             state_change_handler(self, self.state, self.err_msg, old_state)
+
+
+class DexQueryError(Exception):
+    """ A query failed to start or to update """
+    pass
+
+
+async def run_snapshot(act_session: session.ActSession, query_data: DexQueryData, timeout: ty.Optional[float] = None,
+                       wire_decode: bool = False) -> DexQuery:
+    """ Start a snapshot query and wait for the snapshot
+
+    Raises DexQueryError if the query fails, or asyncio.TimeoutError if there is no snapshot within timeout.
+    """
+    on_snapshot = asyncio.get_running_loop().create_future()
+
+    def on_state_change(dex_query: DexQuery, new_state: DexQueryState, err_msg: ErrMsg, old_state: DexQueryState):
+        if new_state in (DexQueryState.StartError, DexQueryState.UpdateError, DexQueryState.Disconnected) and not on_snapshot.done():
+            on_snapshot.set_exception(DexQueryError(f'Query {new_state.value}: {err_msg}'))
+
+    def on_update(dex_query: DexQuery, update_count: int, num_rows: int, new_rows: DexRows, new_updated_rows: DexRows):
+        if not on_snapshot.done():
+            on_snapshot.set_result(True)
+
+    dex_query = DexQuery(query_data=query_data, act_session=act_session, wire_decode=wire_decode)
+    dex_query.add_handlers(state_change_handler=on_state_change, update_handler=on_update)
+    dex_query.start()
+    try:
+        await asyncio.wait_for(on_snapshot, timeout=timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        act_session.dex_sub_session.discard_query(client_id=dex_query.client_id)
+        raise
+    return dex_query
@@ -0,0 +1,93 @@
+"""
+DexTable columns as numpy arrays and pandas DataFrames. numpy and pandas are optional, only needed when these are used
+"""
+import typing as ty
+
+from . import dextable
+from .proto import DataExchangeAPI_pb2 as dex_pb
+
+if ty.TYPE_CHECKING:
+    import numpy
+    import pandas
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError as import_error:
+        raise ImportError('numpy is needed to export DEX tables, pip install numpy') from import_error
+    return numpy
+
+
+def _import_pandas():
+    try:
+        import pandas
+    except ImportError as import_error:
+        raise ImportError('pandas is needed to export DEX tables to a DataFrame, pip install pandas') from import_error
+    return pandas
+
+
+# per column type, the accessor of values that didn't come in the column's own field and the fill for those without one
+_COLUMN_CONVERTERS: ty.Dict[dex_pb.VariantType, ty.Tuple[ty.Callable[[dextable.DexColumnStore, int], ty.Any], ty.Any]] = {
+    dex_pb.VAR_PRICE: (dextable.DexColumnStore.get_price_int, dextable.INVALID_PRICE),
+    dex_pb.VAR_INT32: (dextable.DexColumnStore.get_int, 0),
+    dex_pb.VAR_DOUBLE: (dextable.DexColumnStore.get_float, float('nan')),
+}
+
+
+def column_to_numpy(store: dextable.DexColumnStore, num_rows: int, copy: bool = False) -> 'numpy.ndarray':
+    """ The first num_rows values of a column, without formatting or parsing anything
+
+    Price columns give int64 in DexPrice.to_dex() units with dextable.INVALID_PRICE where there is no price, int32
+    columns int64 with 0 and double columns float64 with NaN where there is no value. String and unknown columns give
+    an object array of the values, None where there is none.
+
+    Unless copy, a numeric column whose values all came in its own field (varPrice, varInt or varDouble) shares the
+    store's buffer, read-only: the array follows later updates of those rows, until the table grows or drops rows and
+    the store moves to a new buffer. Other columns are converted, in a copy of their own.
+    """
+    np = _import_numpy()
+    if store.typecode is None:
+        values = np.empty(num_rows, dtype=object)
+        values[:] = store.values[:num_rows]
+        return values
+    dtype = np.int64 if store.typecode == 'q' else np.float64
+    values = np.frombuffer(store.values, dtype=dtype, count=num_rows)
+    if store.has_only_own_field(num_rows=num_rows):
+        if copy:
+            return values.copy()
+        # writing through it would change the query's values behind its back
+        values.flags.writeable = False
+        return values
+    values = values.copy()
+    get_value, fill_value = _COLUMN_CONVERTERS[store.col_type]
+    kinds = np.frombuffer(store.kinds, dtype=np.uint8, count=num_rows)
+    for row_index in np.flatnonzero((kinds > 1) & (kinds != dextable.KIND_EMPTY)).tolist():
+        value = get_value(store, row_index)
+        values[row_index] = value if value is not None else fill_value
+    return values
+
+
+def prices_to_float(prices: 'numpy.ndarray') -> 'numpy.ndarray':
+    """ int64 prices from column_to_numpy as float64 prices, NaN where there is no price """
+    np = _import_numpy()
+    float_prices = prices / dextable.PRICE_SCALING_FACTOR
+    float_prices[prices == dextable.INVALID_PRICE] = np.nan
+    return float_prices
+
+
+def table_to_dataframe(table: dextable.DexTable, col_names: ty.Sequence[str], col_indexes: ty.Sequence[int], index: ty.Sequence[str],
+                       prices_as_float: bool = True, copy: bool = True) -> 'pandas.DataFrame':
+    """ The columns at col_indexes in a DataFrame with index as its index, prices as floats unless not prices_as_float
+
+    Unless copy, columns column_to_numpy can share stay shared and read-only, the DataFrame follows later updates of those rows.
+    """
+    pd = _import_pandas()
+    data = dict()
+    for col_name, col_index in zip(col_names, col_indexes):
+        store = table.columns[col_index]
+        values = column_to_numpy(store=store, num_rows=table.num_rows, copy=copy)
+        if prices_as_float and store.col_type == dex_pb.VAR_PRICE:
+            values = prices_to_float(prices=values)
+        data[col_name] = values
+    return pd.DataFrame(data, index=pd.Index(index, name='Key'), copy=False)
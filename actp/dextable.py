@@ -0,0 +1,390 @@
+"""
+Column-oriented storage of DexQuery tables: a typed array per column instead of a DexCell object per cell
+"""
+import array
+import math
+import typing as ty
+
+from .proto import DataExchangeAPI_pb2 as dex_pb
+
+_VARIANT_FIELD_NAMES = ('varInt', 'varPrice', 'varDouble', 'varString', 'varQuantity')
+
+# the VariantValue fields stored in the column's array, by column type. Other values (e.g. a varDouble in a price column) are kept as objects
+_COLUMN_FIELD_NAMES: ty.Dict[dex_pb.VariantType, ty.Tuple[str, ...]] = {
+    dex_pb.VAR_PRICE: ('varPrice', 'varQuantity', 'varInt'),
+    dex_pb.VAR_INT32: ('varInt', 'varQuantity', 'varPrice'),
+    dex_pb.VAR_DOUBLE: ('varDouble',),
+}
+_COLUMN_TYPECODES: ty.Dict[dex_pb.VariantType, str] = {
+    dex_pb.VAR_PRICE: 'q',
+    dex_pb.VAR_INT32: 'q',
+    dex_pb.VAR_DOUBLE: 'd',
+}
+
+# kinds[row_index] of a DexColumnStore, values 1 to len(field_names) are field_names[kind - 1] in values[row_index]
+KIND_NONE = 0  # no value received
+KIND_EMPTY = 254  # a VariantValue without any field set
+KIND_OBJECT = 255  # in objects[row_index]
+
+_MIN_CAPACITY = 16
+_OWN_FIELD_KINDS = bytes([KIND_NONE, 1, KIND_EMPTY])
+
+FieldName = ty.Optional[str]
+
+PRICE_SCALING_FACTOR = 10000000  # DexPrice.ScalingFactor, a varPrice is the price times this
+QUANTITY_SCALING_FACTOR = 100000000  # DexQuantity.ScalingFactor
+INVALID_PRICE = -2 ** 63  # DexPrice._INVALID
+
+# what values holds for a row without a value in the column's field, so the array can be used as it is
+_COLUMN_FILL_VALUES: ty.Dict[dex_pb.VariantType, ty.Any] = {
+    dex_pb.VAR_PRICE: INVALID_PRICE,
+    dex_pb.VAR_INT32: 0,
+    dex_pb.VAR_DOUBLE: float('nan'),
+}
+
+
+def _div_round(value: int, divisor: int) -> int:
+    quotient, remainder = divmod(value, divisor)
+    return quotient + 1 if 2 * remainder >= divisor else quotient
+
+
+def _scale_float(value: float, scaling_factor: int) -> ty.Optional[int]:
+    return round(value * scaling_factor) if math.isfinite(value) else None
+
+
+# per VariantValue field, the conversion of its value for each typed accessor. The field orders are the ones the
+# variant_value_to_* helpers of dex probe in, used for the rare value with more than one field set
+_FLOAT_CONVERTERS: ty.Dict[str, ty.Callable[[ty.Any], float]] = {
+    'varPrice': lambda value: value / PRICE_SCALING_FACTOR,
+    'varDouble': float,
+    'varQuantity': lambda value: value / QUANTITY_SCALING_FACTOR,
+    'varInt': float,
+}
+_PRICE_INT_CONVERTERS: ty.Dict[str, ty.Callable[[ty.Any], int]] = {
+    'varPrice': int,
+    'varDouble': lambda value: _scale_float(value, PRICE_SCALING_FACTOR),
+    'varQuantity': lambda value: _div_round(value, QUANTITY_SCALING_FACTOR // PRICE_SCALING_FACTOR),
+    'varInt': lambda value: value * PRICE_SCALING_FACTOR,
+}
+_INT_CONVERTERS: ty.Dict[str, ty.Callable[[ty.Any], int]] = {
+    'varQuantity': lambda value: int(value / QUANTITY_SCALING_FACTOR),
+    'varInt': int,
+    'varDouble': lambda value: int(value) if math.isfinite(value) else None,
+    'varPrice': lambda value: int(value / PRICE_SCALING_FACTOR),
+}
+_QUANTITY_INT_CONVERTERS: ty.Dict[str, ty.Callable[[ty.Any], int]] = {
+    'varQuantity': int,
+    'varDouble': lambda value: _scale_float(value, QUANTITY_SCALING_FACTOR),
+    'varInt': lambda value: value * QUANTITY_SCALING_FACTOR,
+    'varPrice': lambda value: value * (QUANTITY_SCALING_FACTOR // PRICE_SCALING_FACTOR),
+}
+
+Converter = ty.Callable[[ty.Any], ty.Any]
+KindConverters = ty.List[ty.Optional[Converter]]
+
+
+def _convert_object(value: ty.Any, converters: ty.Dict[str, Converter]) -> ty.Any:
+    """ An object of a DexColumnStore, (field_name, field_value), or anything with VariantValue's HasField """
+    if value is None:
+        return None
+    if isinstance(value, tuple):
+        field_name, field_value = value
+        converter = converters.get(field_name)
+        return converter(field_value) if converter is not None else None
+    field_name = next((field_name for field_name in converters if value.HasField(field_name)), None)
+    return converters[field_name](getattr(value, field_name)) if field_name is not None else None
+
+
+def variant_value_to_float(value: ty.Optional[dex_pb.VariantValue]) -> ty.Optional[float]:
+    return _convert_object(value=value, converters=_FLOAT_CONVERTERS)
+
+
+def variant_value_to_int(value: ty.Optional[dex_pb.VariantValue]) -> ty.Optional[int]:
+    return _convert_object(value=value, converters=_INT_CONVERTERS)
+
+
+def variant_value_to_price_int(value: ty.Optional[dex_pb.VariantValue]) -> ty.Optional[int]:
+    return _convert_object(value=value, converters=_PRICE_INT_CONVERTERS)
+
+
+def variant_value_to_quantity_int(value: ty.Optional[dex_pb.VariantValue]) -> ty.Optional[int]:
+    return _convert_object(value=value, converters=_QUANTITY_INT_CONVERTERS)
+
+
+class DexColumnStore(object):
+    """ The values, presence and update counts of one column, indexed by row index
+
+    Values go in a typed array by column type: int64 for price and int32 columns, double for double columns, a list for
+    string and unknown ones. kinds says which VariantValue field each row's value came in, 0 if none came yet.
+    Vectors are rare, they are kept per row in a dict. Rows without a value of the column's own field hold fill_value,
+    e.g. NaN in a double column, so as long as all values come in that field values can be used as the column's data.
+    """
+
+    def __init__(self, col_type: dex_pb.VariantType, capacity: int = 0):
+        self.col_type = col_type
+        self.field_names: ty.Tuple[str, ...] = _COLUMN_FIELD_NAMES.get(col_type, _VARIANT_FIELD_NAMES)
+        self.typecode: ty.Optional[str] = _COLUMN_TYPECODES.get(col_type)
+        self.fill_value: ty.Any = _COLUMN_FILL_VALUES.get(col_type)
+        self.field_kinds: ty.Dict[FieldName, int] = {field_name: kind for kind, field_name in enumerate(self.field_names, start=1)}
+        self.field_kinds[None] = KIND_EMPTY
+        # what each kind converts with, picked once here so the accessors don't test which field a value came in
+        self.float_converters = self._compile_converters(converters=_FLOAT_CONVERTERS)
+        self.int_converters = self._compile_converters(converters=_INT_CONVERTERS)
+        self.price_int_converters = self._compile_converters(converters=_PRICE_INT_CONVERTERS)
+        self.quantity_int_converters = self._compile_converters(converters=_QUANTITY_INT_CONVERTERS)
+        self.values: ty.MutableSequence[ty.Any] = array.array(self.typecode) if self.typecode is not None else []
+        self.kinds = bytearray()
+        self.update_counts = array.array('q')
+        self.objects: ty.Dict[int, ty.Any] = dict()
+        self.vectors: ty.Dict[int, ty.List[ty.Any]] = dict()
+        self.grow(capacity=capacity)
+
+    def grow(self, capacity: int):
+        num_new = capacity - len(self.kinds)
+        if num_new <= 0:
+            return
+        if self.typecode is not None:
+            new_values = array.array(self.typecode, [self.fill_value]) * num_new
+            try:
+                self.values.extend(new_values)
+            except BufferError:
+                # a numpy array still shares the values, it keeps them and the column carries on in a copy
+                self.values = self.values[:]
+                self.values.extend(new_values)
+        else:
+            self.values.extend([None] * num_new)
+        self.kinds.extend(bytes(num_new))
+        self.update_counts.extend(array.array('q', bytes(num_new * self.update_counts.itemsize)))
+
+    def set_value(self, row_index: int, field_name: FieldName, field_value: ty.Any):
+        """ Store the value of a VariantValue with only field_name set, None for one with no field set """
+        kind = self.field_kinds.get(field_name)
+        if kind is None:
+            self.set_object(row_index=row_index, value=(field_name, field_value))
+            return
+        if self.kinds[row_index] == KIND_OBJECT:
+            del self.objects[row_index]
+        self.kinds[row_index] = kind
+        self.values[row_index] = field_value if kind != KIND_EMPTY else self.fill_value
+
+    def set_object(self, row_index: int, value: ty.Any):
+        """ Store a value that doesn't fit the column's array, e.g. (field_name, field_value) of another type """
+        self.kinds[row_index] = KIND_OBJECT
+        self.objects[row_index] = value
+        self.values[row_index] = self.fill_value
+
+    def set_vector(self, row_index: int, vector: ty.List[ty.Any]):
+        self.vectors[row_index] = vector
+
+    def get_vector(self, row_index: int) -> ty.Optional[ty.List[ty.Any]]:
+        return self.vectors.get(row_index)
+
+    def _compile_converters(self, converters: ty.Dict[str, Converter]) -> KindConverters:
+        kind_converters: KindConverters = [None] * (KIND_OBJECT + 1)
+        for kind, field_name in enumerate(self.field_names, start=1):
+            kind_converters[kind] = converters.get(field_name)
+        return kind_converters
+
+    def _convert(self, row_index: int, kind_converters: KindConverters, converters: ty.Dict[str, Converter]) -> ty.Any:
+        kind = self.kinds[row_index]
+        if kind == KIND_OBJECT:
+            return _convert_object(value=self.objects[row_index], converters=converters)
+        converter = kind_converters[kind]
+        return converter(self.values[row_index]) if converter is not None else None
+
+    def get_float(self, row_index: int) -> ty.Optional[float]:
+        """ The value as a float, prices and quantities unscaled. None if there is no numeric value """
+        return self._convert(row_index=row_index, kind_converters=self.float_converters, converters=_FLOAT_CONVERTERS)
+
+    def get_int(self, row_index: int) -> ty.Optional[int]:
+        """ The value as an int like dex.variant_value_to_int, prices and quantities unscaled and truncated. None if there is no numeric value """
+        return self._convert(row_index=row_index, kind_converters=self.int_converters, converters=_INT_CONVERTERS)
+
+    def get_price_int(self, row_index: int) -> ty.Optional[int]:
+        """ The value as a varPrice, i.e. scaled by PRICE_SCALING_FACTOR. None if there is no numeric value """
+        return self._convert(row_index=row_index, kind_converters=self.price_int_converters, converters=_PRICE_INT_CONVERTERS)
+
+    def get_quantity_int(self, row_index: int) -> ty.Optional[int]:
+        """ The value as a varQuantity, i.e. scaled by QUANTITY_SCALING_FACTOR. None if there is no numeric value """
+        return self._convert(row_index=row_index, kind_converters=self.quantity_int_converters, converters=_QUANTITY_INT_CONVERTERS)
+
+    def has_only_own_field(self, num_rows: int) -> bool:
+        """ Whether values[:num_rows] holds every value, i.e. they all came in the column's own field (or none came) """
+        if self.typecode is None:
+            return False
+        return len(self.kinds[:num_rows].translate(None, _OWN_FIELD_KINDS)) == 0
+
+    def take_rows(self, row_indexes: ty.Sequence[int]) -> 'DexColumnStore':
+        """ A new store of only the rows at row_indexes, as rows 0 to len(row_indexes) - 1 in that order. The capacity stays the same """
+        num_dropped = len(self.kinds) - len(row_indexes)
+        new_indexes = {row_index: new_index for new_index, row_index in enumerate(row_indexes)}
+        store = DexColumnStore.__new__(DexColumnStore)
+        store.__dict__.update(self.__dict__)
+        if self.typecode is not None:
+            store.values = array.array(self.typecode, [self.values[row_index] for row_index in row_indexes])
+            store.values.extend(array.array(self.typecode, [self.fill_value]) * num_dropped)
+        else:
+            store.values = [self.values[row_index] for row_index in row_indexes] + [None] * num_dropped
+        store.kinds = bytearray(self.kinds[row_index] for row_index in row_indexes) + bytes(num_dropped)
+        store.update_counts = array.array('q', [self.update_counts[row_index] for row_index in row_indexes])
+        store.update_counts.extend(array.array('q', bytes(num_dropped * self.update_counts.itemsize)))
+        store.objects = {new_indexes[row_index]: value for row_index, value in self.objects.items() if row_index in new_indexes}
+        store.vectors = {new_indexes[row_index]: vector for row_index, vector in self.vectors.items() if row_index in new_indexes}
+        return store
+
+    def is_same(self, row_index: int, other: 'DexColumnStore') -> bool:
+        """ Whether the row has the same value and vector here as in other, a copy of this store """
+        if row_index >= len(other.kinds):
+            return False
+        kind = self.kinds[row_index]
+        if kind != other.kinds[row_index]:
+            return False
+        if kind == KIND_OBJECT:
+            if self.objects[row_index] != other.objects[row_index]:
+                return False
+        elif kind != KIND_NONE and kind != KIND_EMPTY and self.values[row_index] != other.values[row_index]:
+            return False
+        return self.vectors.get(row_index) == other.vectors.get(row_index)
+
+    def copy(self) -> 'DexColumnStore':
+        store = DexColumnStore.__new__(DexColumnStore)
+        store.__dict__.update(self.__dict__)
+        store.values = self.values[:]
+        store.kinds = self.kinds[:]
+        store.update_counts = self.update_counts[:]
+        store.objects = dict(self.objects)
+        store.vectors = dict(self.vectors)
+        return store
+
+    def get_num_bytes(self) -> int:
+        """ Bytes of the arrays, not counting the objects a list or the dicts refer to """
+        num_values_bytes = len(self.values) * (self.values.itemsize if self.typecode is not None else 8)
+        return num_values_bytes + len(self.kinds) + len(self.update_counts) * self.update_counts.itemsize
+
+
+class DexTable(object):
+    """ The rows of a DexQuery: their keys and one DexColumnStore per column
+
+    Row indexes are handed out in order by add_row and never change, take_rows makes a new table to drop rows. The stores grow by
+    doubling so adding a row is amortized O(1) however many columns there are. Rows are found by key and columns by name through dicts, if a name
+    comes twice the first column has it.
+    """
+
+    def __init__(self, col_types: ty.Sequence[dex_pb.VariantType], col_names: ty.Optional[ty.Sequence[str]] = None):
+        self.col_types = list(col_types)
+        self.columns: ty.List[DexColumnStore] = [DexColumnStore(col_type=col_type) for col_type in col_types]
+        self.column_indexes: ty.Dict[str, int] = dict()
+        for col_index, col_name in enumerate(col_names or []):
+            self.column_indexes.setdefault(col_name, col_index)
+        self.row_keys: ty.List[ty.Hashable] = []
+        self.row_indexes: ty.Dict[ty.Hashable, int] = dict()
+        self.row_update_counts = array.array('q')  # of the last update of any cell in the row
+        self.capacity = 0
+
+    @property
+    def num_rows(self) -> int:
+        return len(self.row_keys)
+
+    def get_row_index(self, row_key: ty.Hashable) -> ty.Optional[int]:
+        return self.row_indexes.get(row_key)
+
+    def get_column_index(self, col_name: str) -> ty.Optional[int]:
+        return self.column_indexes.get(col_name)
+
+    def add_row(self, row_key: ty.Hashable) -> int:
+        row_index = len(self.row_keys)
+        if row_index >= self.capacity:
+            self.reserve(capacity=max(self.capacity * 2, _MIN_CAPACITY))
+        self.row_keys.append(row_key)
+        self.row_indexes[row_key] = row_index
+        return row_index
+
+    def reserve(self, capacity: int):
+        if capacity <= self.capacity:
+            return
+        for store in self.columns:
+            store.grow(capacity=capacity)
+        self.row_update_counts.extend(array.array('q', bytes((capacity - self.capacity) * self.row_update_counts.itemsize)))
+        self.capacity = capacity
+
+    def copy(self) -> 'DexTable':
+        """ A copy of the values and update counts, e.g. to compare with after applying a snapshot """
+        table = DexTable(col_types=[])
+        table.col_types = list(self.col_types)
+        table.columns = [store.copy() for store in self.columns]
+        table.column_indexes = dict(self.column_indexes)
+        table.row_keys = list(self.row_keys)
+        table.row_indexes = dict(self.row_indexes)
+        table.row_update_counts = self.row_update_counts[:]
+        table.capacity = self.capacity
+        return table
+
+    def take_rows(self, row_indexes: ty.Sequence[int]) -> 'DexTable':
+        """ A new table of only the rows at row_indexes, which become rows 0 to len(row_indexes) - 1 in that order
+
+        This table is left as it is, so row views and numpy arrays of it keep reading the rows they were made for.
+        """
+        table = DexTable(col_types=[])
+        table.col_types = list(self.col_types)
+        table.columns = [store.take_rows(row_indexes=row_indexes) for store in self.columns]
+        table.column_indexes = dict(self.column_indexes)
+        table.row_keys = [self.row_keys[row_index] for row_index in row_indexes]
+        table.row_indexes = {row_key: row_index for row_index, row_key in enumerate(table.row_keys)}
+        table.row_update_counts = array.array('q', [self.row_update_counts[row_index] for row_index in row_indexes])
+        table.row_update_counts.extend(array.array('q', bytes((self.capacity - len(row_indexes)) * table.row_update_counts.itemsize)))
+        table.capacity = self.capacity
+        return table
+
+    def get_updated_row_indexes(self, update_count: int) -> ty.List[int]:
+        """ Rows with a cell updated by update update_count or later """
+        return [row_index for row_index, row_update_count in enumerate(self.row_update_counts[:self.num_rows]) if row_update_count >= update_count]
+
+    def get_num_bytes(self) -> int:
+        return sum(store.get_num_bytes() for store in self.columns) + len(self.row_update_counts) * self.row_update_counts.itemsize
+
+
+class DexChangeSet(object):
+    """ The rows and cells one table update wrote, as row and column indexes in the order they came in
+
+    The cells of updated_rows[i] are at col_indexes[cell_offsets[i]:cell_offsets[i + 1]]. A row or cell sent twice in
+    the update is listed twice, cells of columns the table doesn't have are left out. deleted_row_keys are the keys of
+    the rows the update removed, those a resync snapshot no longer has.
+    """
+
+    def __init__(self, update_count: int):
+        self.update_count = update_count
+        self.new_rows = array.array('q')
+        self.updated_rows = array.array('q')
+        self.cell_offsets = array.array('q', [0])
+        self.col_indexes = array.array('l')
+        self.deleted_row_keys: ty.List[ty.Hashable] = []
+
+    def __repr__(self):
+        return (f'DexChangeSet(update_count={self.update_count}, new rows:{len(self.new_rows)} updated rows:{len(self.updated_rows)} cells:{self.num_cells} '
+                f'deleted rows:{len(self.deleted_row_keys)})')
+
+    @property
+    def num_cells(self) -> int:
+        return len(self.col_indexes)
+
+    def end_row(self, row_index: int):
+        """ Add row_index as updated, with the cells appended to col_indexes since the previous row """
+        self.updated_rows.append(row_index)
+        self.cell_offsets.append(len(self.col_indexes))
+
+    def remap_rows(self, new_indexes: ty.Sequence[int]):
+        """ Move the row indexes to new_indexes[row_index], after DexTable.take_rows """
+        self.new_rows = array.array('q', [new_indexes[row_index] for row_index in self.new_rows])
+        self.updated_rows = array.array('q', [new_indexes[row_index] for row_index in self.updated_rows])
+
+    def get_col_indexes(self, i: int) -> ty.Sequence[int]:
+        """ The columns written in updated_rows[i] """
+        return self.col_indexes[self.cell_offsets[i]:self.cell_offsets[i + 1]]
+
+    def iter_cells(self) -> ty.Iterator[ty.Tuple[int, int]]:
+        """ (row index, column index) of every cell written """
+        col_indexes = self.col_indexes
+        cell_offsets = self.cell_offsets
+        for i, row_index in enumerate(self.updated_rows):
+            for cell_index in range(cell_offsets[i], cell_offsets[i + 1]):
+                yield row_index, col_indexes[cell_index]
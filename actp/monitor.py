@@ -0,0 +1,202 @@
+"""
+Request round trip times and event loop lag of an ActSession, to tell a slow network or Actant from a busy event loop
+"""
+import asyncio
+import logging
+import math
+import typing as ty
+
+from . import session
+from . import wire
+from .proto import Act_pb2 as act_pb
+
+# log-linear buckets as in HdrHistogram: exact below _SUB_BUCKET_COUNT, then _HALF_SUB_BUCKET_COUNT buckets per power of 2
+_SUB_BUCKET_BITS = 7
+_SUB_BUCKET_COUNT = 1 << _SUB_BUCKET_BITS
+_HALF_SUB_BUCKET_COUNT = _SUB_BUCKET_COUNT >> 1
+
+DEFAULT_PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+
+
+def _get_bucket_index(value: int) -> int:
+    if value < _SUB_BUCKET_COUNT:
+        return value
+    shift = value.bit_length() - _SUB_BUCKET_BITS
+    return _SUB_BUCKET_COUNT + (shift - 1) * _HALF_SUB_BUCKET_COUNT + (value >> shift) - _HALF_SUB_BUCKET_COUNT
+
+
+def _get_bucket_range(index: int) -> ty.Tuple[int, int]:
+    """ The lowest and highest value counted in bucket index """
+    if index < _SUB_BUCKET_COUNT:
+        return index, index
+    shift = (index - _SUB_BUCKET_COUNT) // _HALF_SUB_BUCKET_COUNT + 1
+    top = (index - _SUB_BUCKET_COUNT) % _HALF_SUB_BUCKET_COUNT + _HALF_SUB_BUCKET_COUNT
+    return top << shift, ((top + 1) << shift) - 1
+
+
+class LatencyHistogram(object):
+    """ Counts of durations in microsecond buckets no wider than 1/64 of their value, so percentiles are within about 1.6% at any scale """
+
+    def __init__(self):
+        self._counts: ty.Dict[int, int] = dict()
+        self.count = 0
+        self.total_usecs = 0
+        self.min_usecs: ty.Optional[int] = None
+        self.max_usecs = 0
+
+    def record(self, secs: float):
+        usecs = max(int(secs * 1e6), 0)
+        index = _get_bucket_index(usecs)
+        self._counts[index] = self._counts.get(index, 0) + 1
+        self.count += 1
+        self.total_usecs += usecs
+        if self.min_usecs is None or usecs < self.min_usecs:
+            self.min_usecs = usecs
+        if usecs > self.max_usecs:
+            self.max_usecs = usecs
+
+    def merge(self, other: 'LatencyHistogram'):
+        for index, count in other._counts.items():
+            self._counts[index] = self._counts.get(index, 0) + count
+        self.count += other.count
+        self.total_usecs += other.total_usecs
+        if other.min_usecs is not None and (self.min_usecs is None or other.min_usecs < self.min_usecs):
+            self.min_usecs = other.min_usecs
+        self.max_usecs = max(self.max_usecs, other.max_usecs)
+
+    def reset(self):
+        self._counts.clear()
+        self.count = 0
+        self.total_usecs = 0
+        self.min_usecs = None
+        self.max_usecs = 0
+
+    def get_mean_secs(self) -> float:
+        return self.total_usecs / self.count / 1e6 if self.count > 0 else 0.0
+
+    def get_percentile_secs(self, percentile: float) -> float:
+        """ The value below which percentile % of the recorded values fall, 0.0 if none were recorded """
+        if self.count == 0:
+            return 0.0
+        wanted = max(1, math.ceil(self.count * percentile / 100.0))
+        seen = 0
+        for index in sorted(self._counts):
+            seen += self._counts[index]
+            if seen >= wanted:
+                return min(_get_bucket_range(index)[1], self.max_usecs) / 1e6
+        return self.max_usecs / 1e6
+
+    def get_buckets(self) -> ty.List[ty.Tuple[float, float, int]]:
+        """ (lowest secs, highest secs, count) of the non empty buckets, lowest first """
+        return [(*(usecs / 1e6 for usecs in _get_bucket_range(index)), self._counts[index]) for index in sorted(self._counts)]
+
+    def to_str(self, percentiles: ty.Sequence[float] = DEFAULT_PERCENTILES) -> str:
+        if self.count == 0:
+            return 'n:0'
+        percentiles_str = ' '.join(f'p{percentile:g}:{self.get_percentile_secs(percentile) * 1e3:.3f}ms' for percentile in percentiles)
+        return f'n:{self.count} mean:{self.get_mean_secs() * 1e3:.3f}ms {percentiles_str} max:{self.max_usecs / 1e3:.3f}ms'
+
+
+def get_request_type_name(sub_protocol_type: act_pb.SubProtocolType, request_type: ty.Optional[int]) -> str:
+    """ e.g. SUB_PROTO_DEX/REQ_TABLE_UPDATE """
+    sub_protocol_name = act_pb.SubProtocolType.Name(sub_protocol_type) if sub_protocol_type in act_pb.SubProtocolType.values() else str(sub_protocol_type)
+    field_name = wire.REQUEST_FIELD_NAMES.get(sub_protocol_type)
+    if request_type is None or field_name is None:
+        return f'{sub_protocol_name}/{request_type}'
+    request_type_enum = act_pb.Request.DESCRIPTOR.fields_by_name[field_name].message_type.fields_by_name['requestType'].enum_type
+    request_type_value = request_type_enum.values_by_number.get(request_type)
+    return f'{sub_protocol_name}/{request_type_value.name if request_type_value is not None else request_type}'
+
+
+RequestKey = ty.Tuple[act_pb.SubProtocolType, ty.Optional[int]]
+
+
+class ActSessionMonitor(object):
+    """ Histograms of the response time per request type, from the session's RequestCorrelator, and of event loop lag
+
+    Loop lag is how late a timer due every lag_interval fires, anything the loop runs in between (e.g. decoding a big
+    table update) shows up there. Every log_interval, if given, the histograms of the interval just ended are logged,
+    the get_* methods return the histograms since start (or reset).
+    """
+
+    def __init__(self, act_session: session.ActSession, lag_interval: float = 0.1, log_interval: ty.Optional[float] = 60.0):
+        self.act_session = act_session
+        self.loop: asyncio.AbstractEventLoop = act_session.act_connection.loop
+        self.lag_interval = lag_interval
+        self.log_interval = log_interval
+        self._logger = logging.getLogger(__name__)
+        self._response_times: ty.Dict[RequestKey, LatencyHistogram] = dict()
+        self._interval_response_times: ty.Dict[RequestKey, LatencyHistogram] = dict()
+        self.loop_lag = LatencyHistogram()
+        self._interval_loop_lag = LatencyHistogram()
+        self._lag_timer: ty.Optional[asyncio.TimerHandle] = None
+        self._log_timer: ty.Optional[asyncio.TimerHandle] = None
+        self._is_started = False
+        act_session.requests.add_response_time_handler(self._on_response_time)
+
+    def start(self):
+        if self._is_started:
+            return
+        self._is_started = True
+        self._schedule_lag_timer()
+        if self.log_interval is not None:
+            self._log_timer = self.loop.call_later(self.log_interval, self._on_log_timer)
+
+    def stop(self):
+        """ Stop sampling loop lag and logging, response times are still recorded """
+        self._is_started = False
+        for timer in (self._lag_timer, self._log_timer):
+            if timer is not None:
+                timer.cancel()
+        self._lag_timer = None
+        self._log_timer = None
+
+    def reset(self):
+        self._response_times.clear()
+        self._interval_response_times.clear()
+        self.loop_lag.reset()
+        self._interval_loop_lag.reset()
+
+    def get_response_times(self, sub_protocol_type: act_pb.SubProtocolType, request_type: ty.Optional[int]) -> LatencyHistogram:
+        return self._response_times.get((sub_protocol_type, request_type)) or LatencyHistogram()
+
+    def get_all_response_times(self) -> ty.Dict[RequestKey, LatencyHistogram]:
+        return dict(self._response_times)
+
+    def format_summary(self, is_interval: bool = False) -> str:
+        response_times = self._interval_response_times if is_interval else self._response_times
+        loop_lag = self._interval_loop_lag if is_interval else self.loop_lag
+        lines = [f'loop lag: {loop_lag.to_str()}']
+        for (sub_protocol_type, request_type), histogram in sorted(response_times.items(), key=lambda item: (item[0][0], item[0][1] or 0)):
+            lines.append(f'{get_request_type_name(sub_protocol_type, request_type)}: {histogram.to_str()}')
+        return '\n'.join(lines)
+
+    def log_summary(self):
+        self._logger.info(f'{self.act_session} latency over the last {self.log_interval}s\n{self.format_summary(is_interval=True)}')
+        self._interval_response_times.clear()
+        self._interval_loop_lag.reset()
+
+    def _on_response_time(self, sub_protocol_type: act_pb.SubProtocolType, request_type: ty.Optional[int], response_time: float):
+        key = (sub_protocol_type, request_type)
+        for response_times in (self._response_times, self._interval_response_times):
+            histogram = response_times.get(key)
+            if histogram is None:
+                histogram = LatencyHistogram()
+                response_times[key] = histogram
+            histogram.record(response_time)
+
+    def _schedule_lag_timer(self):
+        due_at = self.loop.time() + self.lag_interval
+        self._lag_timer = self.loop.call_at(due_at, self._on_lag_timer, due_at)
+
+    def _on_lag_timer(self, due_at: float):
+        lag = max(self.loop.time() - due_at, 0.0)
+        self.loop_lag.record(lag)
+        self._interval_loop_lag.record(lag)
+        if self._is_started:
+            self._schedule_lag_timer()
+
+    def _on_log_timer(self):
+        self.log_summary()
+        if self._is_started:
+            self._log_timer = self.loop.call_later(self.log_interval, self._on_log_timer)
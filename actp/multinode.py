@@ -0,0 +1,232 @@
+"""
+Running the same DEX query on several Actant nodes at once, with the results merged into one table tagged with the node
+"""
+import asyncio
+import csv
+import dataclasses
+import io
+import logging
+import typing as ty
+
+from . import connection
+from . import dex
+from . import session
+
+
+@dataclasses.dataclass(unsafe_hash=True)
+class ActNodeAddress:
+    ip: str
+    port: int
+
+    def __str__(self):
+        return f'{self.ip}:{self.port}'
+
+    @classmethod
+    def from_str(cls, address: str, default_port: int) -> 'ActNodeAddress':
+        """ 'ip:port' or just 'ip' """
+        ip, _, port = address.strip().partition(':')
+        return ActNodeAddress(ip=ip, port=int(port) if port else default_port)
+
+
+def parse_node_addresses(addresses: str, default_port: int) -> ty.List[ActNodeAddress]:
+    """ Comma separated 'ip:port' or 'ip' """
+    return [ActNodeAddress.from_str(address=address, default_port=default_port) for address in addresses.split(',') if address.strip()]
+
+
+NodeName = str
+
+
+@dataclasses.dataclass
+class NodeRow:
+    node: NodeName
+    row: dex.DexRow
+
+
+NodeRows = ty.List[NodeRow]
+MultiNodeUpdateHandler = ty.Callable[['MultiNodeQuery', NodeName, dex.UpdateCount, NodeRows, NodeRows], None]
+MultiNodeStateChangeHandler = ty.Callable[['MultiNodeQuery', NodeName, dex.NewState, dex.ErrMsg, dex.OldState], None]
+
+
+class MultiNodeClient(object):
+    """ One ActSession per node, all logged on concurrently. Each session is named after the Node of its ActLoginResponse """
+
+    def __init__(self, addresses: ty.List[ActNodeAddress], loop: asyncio.AbstractEventLoop, user: str, password: str, appname: str):
+        self._logger = logging.getLogger(__name__)
+        self.addresses = addresses
+        self.act_sessions: ty.List[session.ActSession] = [
+            session.ActSession(act_connection=connection.ActConnection(ip=address.ip, port=address.port, loop=loop), user=user, password=password, appname=appname)
+            for address in addresses]
+        # logged on sessions by node name
+        self.node_sessions: ty.Dict[NodeName, session.ActSession] = dict()
+
+    async def logon(self) -> ty.Dict[ActNodeAddress, ty.Optional[session.LogonResponse]]:
+        """ Connect and log on to all nodes concurrently, None for a node that could not be connected to """
+        logon_responses = await asyncio.gather(*[self._connect_and_logon(act_session=act_session) for act_session in self.act_sessions])
+        self.node_sessions.clear()
+        for address, act_session, logon_response in zip(self.addresses, self.act_sessions, logon_responses):
+            if logon_response is None or not logon_response.Success:
+                continue
+            login_response = logon_response.ActLoginResponse
+            node = login_response.Node if login_response is not None and login_response.Node else str(address)
+            if node in self.node_sessions:
+                node = f'{node}@{address}'
+            self.node_sessions[node] = act_session
+        self._logger.info(f'Logged on to {len(self.node_sessions)} of {len(self.addresses)} nodes: {", ".join(self.node_sessions)}')
+        return dict(zip(self.addresses, logon_responses))
+
+    async def _connect_and_logon(self, act_session: session.ActSession) -> ty.Optional[session.LogonResponse]:
+        await act_session.act_connection.connect()
+        if not act_session.act_connection.is_connected():
+            return None
+        logon_response = await act_session.logon()
+        if not logon_response.Success:
+            self._logger.error(f'Failed to log on to {act_session.act_connection}: {logon_response.ErrorMsg}')
+        return logon_response
+
+    def logout(self):
+        for act_session in self.act_sessions:
+            if act_session.act_connection.is_connected():
+                act_session.logout()
+
+    async def wait_on_disconnect(self):
+        await asyncio.gather(*[act_session.act_connection.wait_on_disconnect() for act_session in self.node_sessions.values()])
+
+    def create_query(self, query_data: dex.DexQueryData, wire_decode: bool = False) -> 'MultiNodeQuery':
+        return MultiNodeQuery(query_data=query_data, node_sessions=self.node_sessions, wire_decode=wire_decode)
+
+
+class MultiNodeQuery(object):
+    """ The same DexQueryData run on every node in parallel, rows of all nodes end up in one table tagged with their node """
+
+    def __init__(self, query_data: dex.DexQueryData, node_sessions: ty.Dict[NodeName, session.ActSession], wire_decode: bool = False):
+        self.query_data = query_data
+        self.logger = logging.getLogger(__name__)
+        self.dex_queries: ty.Dict[NodeName, dex.DexQuery] = dict()
+        self.columns: dex.DexColumns = []
+        self.rows: NodeRows = []
+        self._node_rows: ty.Dict[ty.Tuple[NodeName, int], NodeRow] = dict()
+        self._update_handlers: ty.List[MultiNodeUpdateHandler] = []
+        self._state_change_handlers: ty.List[MultiNodeStateChangeHandler] = []
+        self._pending_nodes: ty.Set[NodeName] = set()
+        self.on_all_updated: ty.Optional[asyncio.Future] = None
+        for node, act_session in node_sessions.items():
+            dex_query = dex.DexQuery(query_data=query_data, act_session=act_session, wire_decode=wire_decode)
+            dex_query.add_handlers(state_change_handler=self._get_state_change_handler(node=node),
+                                   columns_received_handler=self._on_columns_received,
+                                   update_handler=self._get_update_handler(node=node),
+                                   reset_handler=self._get_reset_handler(node=node))
+            act_session.act_connection.add_state_change_handler(self._get_connection_state_change_handler(node=node))
+            self.dex_queries[node] = dex_query
+
+    def add_handlers(self,
+                     state_change_handler: ty.Optional[MultiNodeStateChangeHandler] = None,
+                     update_handler: ty.Optional[MultiNodeUpdateHandler] = None,
+                     ):
+        if state_change_handler is not None:
+            self._state_change_handlers.append(state_change_handler)
+        if update_handler is not None:
+            self._update_handlers.append(update_handler)
+
+    def start(self):
+        """ Start the query on all nodes at once """
+        self._pending_nodes = set(self.dex_queries)
+        self.on_all_updated = asyncio.get_running_loop().create_future()
+        if not self._pending_nodes:
+            self.on_all_updated.set_result(True)
+        for dex_query in self.dex_queries.values():
+            dex_query.start()
+
+    def stop(self):
+        for dex_query in self.dex_queries.values():
+            if dex_query.state not in (dex.DexQueryState.StartError, dex.DexQueryState.Stopped, dex.DexQueryState.Disconnected):
+                dex_query.stop()
+
+    async def wait_all_updated(self):
+        """ Wait until every node sent its first update (the snapshot) or failed, i.e. as long as the slowest node """
+        await self.on_all_updated
+
+    def get_rows_for_node(self, node: NodeName) -> dex.DexRows:
+        dex_query = self.dex_queries.get(node)
+        return dex_query.rows if dex_query is not None else []
+
+    def as_csv(self, csv_writer: ty.Optional[csv.writer] = None, with_type_row: ty.Optional[bool] = None) -> str:
+        """ Like DexQuery.as_csv with a leading Node column, cells are matched to the columns by name """
+        output = io.StringIO()
+        writer = csv_writer if csv_writer is not None else csv.writer(output, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(['Node', 'Key', *[column.name for column in self.columns]])
+        if with_type_row is None or with_type_row:
+            writer.writerow(['', 'Type', *[column.col_type_str() for column in self.columns]])
+        # each node's column indexes of self.columns, looked up once rather than by name per cell
+        node_col_indexes = {node: [dex_query.get_column_index(column_name=column.name) for column in self.columns] for node, dex_query in self.dex_queries.items()}
+        for node_row in self.rows:
+            row = node_row.row
+            values = [row.get_cell(col_index).value_str() if col_index is not None else '' for col_index in node_col_indexes[node_row.node]]
+            writer.writerow([node_row.node, row.row_key.key, *values])
+        return output.getvalue()
+
+    def _on_columns_received(self, dex_query: dex.DexQuery, columns: ty.List[dex.DexColumn]):
+        if not self.columns:
+            self.columns = columns
+            return
+        column_names = {column.name for column in self.columns}
+        self.columns = self.columns + [column for column in columns if column.name not in column_names]
+
+    def _get_state_change_handler(self, node: NodeName) -> dex.StateChangeHandler:
+        def on_state_change(dex_query: dex.DexQuery, new_state: dex.DexQueryState, err_msg: dex.ErrMsg, old_state: dex.DexQueryState):
+            if new_state in (dex.DexQueryState.StartError, dex.DexQueryState.UpdateError, dex.DexQueryState.Disconnected):
+                self.logger.warning(f'Query on node {node} is {new_state}: {err_msg}')
+                self._set_node_updated(node=node)
+            for state_change_handler in self._state_change_handlers:
+                state_change_handler(self, node, new_state, err_msg, old_state)
+
+        return on_state_change
+
+    def _get_connection_state_change_handler(self, node: NodeName) -> connection.StateChangeHandler:
+        def on_connection_state_change(act_connection: connection.ActConnection, new_state: connection.ActConnectionState, err_msg: ty.Optional[str],
+                                       old_state: connection.ActConnectionState):
+            if new_state == connection.ActConnectionState.Disconnected and node in self._pending_nodes:
+                self.logger.warning(f'Lost node {node} before its first update')
+                self._set_node_updated(node=node)
+
+        return on_connection_state_change
+
+    def _get_update_handler(self, node: NodeName) -> dex.UpdateHandler:
+        def on_update(dex_query: dex.DexQuery, update_count: int, num_rows: int, new_rows: dex.DexRows, new_updated_rows: dex.DexRows):
+            change_set = dex_query.get_change_set(update_count=update_count)
+            if change_set is not None and len(change_set.deleted_row_keys) > 0:
+                # a resync removed rows and moved the others to new row indexes
+                self._drop_node_rows(node=node)
+                new_row_indexes = set(change_set.new_rows)
+                for dex_row in dex_query.rows:
+                    if dex_row.row_index not in new_row_indexes:
+                        self._add_node_row(node=node, dex_row=dex_row)
+            new_node_rows: NodeRows = []
+            for dex_row in new_rows:
+                new_node_rows.append(self._add_node_row(node=node, dex_row=dex_row))
+            updated_node_rows = [self._node_rows[(node, dex_row.row_index)] for dex_row in new_updated_rows]
+            for update_handler in self._update_handlers:
+                update_handler(self, node, update_count, new_node_rows, updated_node_rows)
+            self._set_node_updated(node=node)
+
+        return on_update
+
+    def _get_reset_handler(self, node: NodeName) -> dex.ResetHandler:
+        def on_reset(dex_query: dex.DexQuery, update_count: int, deleted_rows: dex.DexRows):
+            self._drop_node_rows(node=node)
+
+        return on_reset
+
+    def _add_node_row(self, node: NodeName, dex_row: dex.DexRow) -> NodeRow:
+        node_row = NodeRow(node=node, row=dex_row)
+        self._node_rows[(node, dex_row.row_index)] = node_row
+        self.rows.append(node_row)
+        return node_row
+
+    def _drop_node_rows(self, node: NodeName):
+        self.rows = [node_row for node_row in self.rows if node_row.node != node]
+        self._node_rows = {row_id: node_row for row_id, node_row in self._node_rows.items() if row_id[0] != node}
+
+    def _set_node_updated(self, node: NodeName):
+        self._pending_nodes.discard(node)
+        if not self._pending_nodes and self.on_all_updated is not None and not self.on_all_updated.done():
+            self.on_all_updated.set_result(True)
@@ -0,0 +1,144 @@
+"""
+Several logged on sessions to one Actant node, with DEX queries spread over them by load
+"""
+import asyncio
+import dataclasses
+import logging
+import time
+import typing as ty
+
+from . import connection
+from . import dex
+from . import reconnect
+from . import session
+
+
+@dataclasses.dataclass
+class SessionLoad:
+    act_session: session.ActSession
+    num_queries: int = 0
+    num_rows: int = 0
+    row_updates_per_sec: float = 0.0
+
+    def get_load(self) -> float:
+        """ Rows held plus rows updated per second, what the node evaluates and what the session has to decode """
+        return self.num_rows + self.row_updates_per_sec
+
+
+class _QueryLoad(object):
+    def __init__(self, dex_query: dex.DexQuery, session_index: int):
+        self.dex_query = dex_query
+        self.session_index = session_index
+        self.added_at = time.monotonic()
+        self.num_row_updates = 0
+
+    def on_update(self, dex_query: dex.DexQuery, update_count: int, num_rows: int, new_rows: ty.List[dex.DexRow], new_updated_rows: ty.List[dex.DexRow]):
+        self.num_row_updates += len(new_updated_rows)
+
+    def get_row_updates_per_sec(self) -> float:
+        return self.num_row_updates / max(time.monotonic() - self.added_at, 1.0)
+
+
+class ActSessionPool(object):
+    """ num_sessions ActSessions to the same node, each DexQuery made by create_query goes to the least loaded connected session
+
+    The queries are plain DexQuery objects, so they are used the same way as on a single session.
+    With a reconnect_policy every session gets an ActSessionKeeper and its streaming queries are restarted after a reconnect.
+    """
+
+    def __init__(self, ip: str, port: int, loop: asyncio.AbstractEventLoop, num_sessions: int, user: str, password: str, appname: str,
+                 reconnect_policy: ty.Optional[reconnect.ReconnectPolicy] = None):
+        self._logger = logging.getLogger(__name__)
+        self.act_sessions: ty.List[session.ActSession] = []
+        self.session_keepers: ty.List[reconnect.ActSessionKeeper] = []
+        for _ in range(num_sessions):
+            act_connection = connection.ActConnection(ip=ip, port=port, loop=loop)
+            act_session = session.ActSession(act_connection=act_connection, user=user, password=password, appname=appname)
+            self.act_sessions.append(act_session)
+            if reconnect_policy is not None:
+                self.session_keepers.append(reconnect.ActSessionKeeper(act_session=act_session, policy=reconnect_policy))
+        self._query_loads: ty.List[_QueryLoad] = []
+
+    def __str__(self):
+        return f'({", ".join(str(act_session) for act_session in self.act_sessions)})'
+
+    async def logon(self) -> ty.List[ty.Optional[session.LogonResponse]]:
+        """ Connect and log on all sessions concurrently, None for a session that could not connect """
+        return list(await asyncio.gather(*[self._connect_and_logon(act_session=act_session) for act_session in self.act_sessions]))
+
+    async def _connect_and_logon(self, act_session: session.ActSession) -> ty.Optional[session.LogonResponse]:
+        await act_session.act_connection.connect()
+        if not act_session.act_connection.is_connected():
+            return None
+        logon_response = await act_session.logon()
+        if not logon_response.Success:
+            self._logger.error(f'Failed to log on {act_session}: {logon_response.ErrorMsg}')
+        return logon_response
+
+    def start(self):
+        """ Start the session keepers, call once logged on """
+        for session_keeper in self.session_keepers:
+            session_keeper.start()
+
+    def logout(self):
+        for session_keeper in self.session_keepers:
+            session_keeper.stop()
+        for act_session in self.act_sessions:
+            if act_session.act_connection.is_connected():
+                act_session.logout()
+
+    async def wait_on_disconnect(self):
+        """ Wait until all sessions are gone, i.e. their keepers stopped or, without keepers, their connections closed """
+        if self.session_keepers:
+            await asyncio.gather(*[session_keeper.wait_stopped() for session_keeper in self.session_keepers])
+        else:
+            await asyncio.gather(*[act_session.act_connection.wait_on_disconnect() for act_session in self.act_sessions])
+
+    def create_query(self, query_data: dex.DexQueryData, wire_decode: bool = False) -> dex.DexQuery:
+        """ A DexQuery on the least loaded session, start it as usual """
+        session_index = self._get_least_loaded_session_index()
+        act_session = self.act_sessions[session_index]
+        dex_query = dex.DexQuery(query_data=query_data, act_session=act_session, wire_decode=wire_decode)
+        query_load = _QueryLoad(dex_query=dex_query, session_index=session_index)
+        dex_query.add_handlers(state_change_handler=self._on_query_state_change, update_handler=query_load.on_update)
+        self._query_loads.append(query_load)
+        if self.session_keepers:
+            self.session_keepers[session_index].add_query(dex_query=dex_query)
+        self._logger.debug(f'Query on {",".join(query_data.scope_keys)} assigned to {act_session}')
+        return dex_query
+
+    def get_session_loads(self) -> ty.List[SessionLoad]:
+        # a snapshot query is no load once its snapshot arrived
+        self._query_loads = [query_load for query_load in self._query_loads
+                             if not (query_load.dex_query.query_data.is_snapshot and query_load.dex_query.update_count > 0)]
+        session_loads = [SessionLoad(act_session=act_session) for act_session in self.act_sessions]
+        for query_load in self._query_loads:
+            session_load = session_loads[query_load.session_index]
+            session_load.num_queries += 1
+            session_load.num_rows += len(query_load.dex_query.rows)
+            session_load.row_updates_per_sec += query_load.get_row_updates_per_sec()
+        return session_loads
+
+    def _get_least_loaded_session_index(self) -> int:
+        session_loads = self.get_session_loads()
+        candidates = [i for i, act_session in enumerate(self.act_sessions) if act_session.act_connection.is_connected()]
+        if not candidates:
+            candidates = list(range(len(self.act_sessions)))
+        return min(candidates, key=lambda i: (session_loads[i].get_load(), session_loads[i].num_queries))
+
+    def _on_query_state_change(self, dex_query: dex.DexQuery, new_state: dex.DexQueryState, err_msg: str, old_state: dex.DexQueryState):
+        if new_state not in (dex.DexQueryState.Stopped, dex.DexQueryState.StopError, dex.DexQueryState.StartError):
+            return
+        for query_load in self._query_loads:
+            if query_load.dex_query is dex_query:
+                self._query_loads.remove(query_load)
+                if self.session_keepers:
+                    self.session_keepers[query_load.session_index].remove_query(dex_query=dex_query)
+                return
+
+
+def split_query_data(query_data: dex.DexQueryData, max_scope_keys: int) -> ty.List[dex.DexQueryData]:
+    """ Split a query on many scope keys into queries on at most max_scope_keys each, to be spread over the pool """
+    return [dex.DexQueryData(scope_keys=query_data.scope_keys[i:i + max_scope_keys], fields=query_data.fields, is_snapshot=query_data.is_snapshot,
+                             frequency=query_data.frequency, no_triggers=query_data.no_triggers, contexts=query_data.contexts)
+            for i in range(0, len(query_data.scope_keys), max_scope_keys)]
@@ -0,0 +1,194 @@
+"""
+Priority lanes for outgoing requests, so a hold or terminate is not stuck behind a big table update or a burst of queries
+"""
+import collections
+import dataclasses
+import enum
+import logging
+import time
+import typing as ty
+
+from . import connection
+from . import wire
+from .proto import ActAlgo_pb2 as algo_pb
+from .proto import ActAutoControl_pb2 as autocontrol_pb
+from .proto import Act_pb2 as act_pb
+from .proto import DataExchangeAPI_pb2 as dex_pb
+
+RequestType = int
+
+
+class RequestPriority(enum.IntEnum):
+    """ Lane of a request, lower values are sent first """
+    High = 0
+    Normal = 1
+    Bulk = 2
+
+
+DEFAULT_REQUEST_PRIORITIES: ty.Dict[ty.Tuple[act_pb.SubProtocolType, RequestType], RequestPriority] = {
+    (act_pb.SUB_PROTO_ACT, act_pb.REQ_LOGIN): RequestPriority.High,
+    (act_pb.SUB_PROTO_ACT, act_pb.REQ_LOGOUT): RequestPriority.High,
+    (act_pb.SUB_PROTO_AUTOCONTROL, autocontrol_pb.REQ_AUTOCONTROL_UPDATE): RequestPriority.High,
+    (act_pb.SUB_PROTO_ALGO, algo_pb.REQ_TERMINATE_ALGO): RequestPriority.High,
+    (act_pb.SUB_PROTO_ALGO, algo_pb.REQ_SET_ALGO_STATUS): RequestPriority.High,
+    (act_pb.SUB_PROTO_ALGO, algo_pb.REQ_CREATE_DIRECT_ACTION): RequestPriority.Normal,
+    (act_pb.SUB_PROTO_DEX, dex_pb.REQ_STOP_QUERY): RequestPriority.Normal,
+    (act_pb.SUB_PROTO_DEX, dex_pb.REQ_START_QUERY): RequestPriority.Bulk,
+    (act_pb.SUB_PROTO_DEX, dex_pb.REQ_TABLE_UPDATE): RequestPriority.Bulk,
+}
+
+# frames a lane may send per round while lanes are backed up, so Bulk gets 1 in 21 rather than starving
+DEFAULT_LANE_WEIGHTS: ty.Dict[RequestPriority, int] = {
+    RequestPriority.High: 16,
+    RequestPriority.Normal: 4,
+    RequestPriority.Bulk: 1,
+}
+
+
+def get_request_type(request: act_pb.Request) -> ty.Optional[RequestType]:
+    """ The requestType of the request's sub-request, None for sub-protocols we don't know """
+    field_name = wire.REQUEST_FIELD_NAMES.get(request.subProtocolType)
+    if field_name is None:
+        return None
+    return getattr(request, field_name).requestType
+
+
+@dataclasses.dataclass
+class LaneStats:
+    """ Queueing delay is the time from submit until the frame is handed to the connection, 0 for frames sent straight away """
+    num_sent: int = 0
+    num_queued: int = 0  # that had to wait in the lane rather than go straight out
+    num_dropped: int = 0  # queued, then cleared on disconnect or refused by the connection when their turn came
+    num_bytes: int = 0
+    total_delay_secs: float = 0.0
+    max_delay_secs: float = 0.0
+    peak_depth: int = 0
+
+    def on_sent(self, num_bytes: int, delay_secs: float):
+        self.num_sent += 1
+        self.num_bytes += num_bytes
+        self.total_delay_secs += delay_secs
+        self.max_delay_secs = max(self.max_delay_secs, delay_secs)
+
+    def get_mean_delay_secs(self) -> float:
+        return self.total_delay_secs / self.num_sent if self.num_sent > 0 else 0.0
+
+    def to_str(self) -> str:
+        return (f'sent:{self.num_sent} queued:{self.num_queued} dropped:{self.num_dropped} bytes:{self.num_bytes} peak depth:{self.peak_depth} '
+                f'delay mean:{self.get_mean_delay_secs() * 1e3:.3f}ms max:{self.max_delay_secs * 1e3:.3f}ms')
+
+
+@dataclasses.dataclass
+class _QueuedRequest:
+    msg_data: bytes
+    queued_at: float
+
+
+class PriorityRequestScheduler(object):
+    """ Holds serialized requests in one FIFO lane per RequestPriority while the connection can't take them, and sends them in priority order
+
+    A request is sent straight away if nothing is queued and the transport has not paused writing, so without back pressure this
+    costs a dict lookup. Once requests queue, each round visits the lanes highest priority first, each sending up to its weight
+    in frames, so High goes out first but every backed up lane gets its share. Queued requests are dropped on disconnect,
+    the session fails what was waiting on them.
+    """
+
+    def __init__(self, act_connection: connection.ActConnection,
+                 priorities: ty.Optional[ty.Dict[ty.Tuple[act_pb.SubProtocolType, RequestType], RequestPriority]] = None,
+                 default_priority: RequestPriority = RequestPriority.Normal,
+                 lane_weights: ty.Optional[ty.Dict[RequestPriority, int]] = None,
+                 clock: ty.Optional[ty.Callable[[], float]] = None):
+        self.act_connection = act_connection
+        self._logger = logging.getLogger(__name__)
+        self.priorities = dict(priorities if priorities is not None else DEFAULT_REQUEST_PRIORITIES)
+        self.default_priority = default_priority
+        weights = lane_weights if lane_weights is not None else DEFAULT_LANE_WEIGHTS
+        self._lane_weights: ty.List[int] = [max(weights.get(priority, 1), 1) for priority in RequestPriority]
+        self._credits: ty.List[int] = list(self._lane_weights)
+        self._lanes: ty.List[ty.Deque[_QueuedRequest]] = [collections.deque() for _ in RequestPriority]
+        self.lane_stats: ty.Dict[RequestPriority, LaneStats] = {priority: LaneStats() for priority in RequestPriority}
+        self._num_queued = 0
+        self._drain_scheduled = False
+        self._clock = clock if clock is not None else time.perf_counter
+        self.act_connection.add_state_change_handler(self._on_connection_state_change)
+        self.act_connection.add_resume_writing_handler(self._on_resume_writing)
+
+    def set_priority(self, sub_protocol_type: act_pb.SubProtocolType, request_type: RequestType, priority: RequestPriority):
+        self.priorities[(sub_protocol_type, request_type)] = priority
+
+    def get_priority(self, sub_protocol_type: act_pb.SubProtocolType, request_type: ty.Optional[RequestType]) -> RequestPriority:
+        return self.priorities.get((sub_protocol_type, request_type), self.default_priority)
+
+    def get_request_priority(self, request: act_pb.Request) -> RequestPriority:
+        return self.get_priority(sub_protocol_type=request.subProtocolType, request_type=get_request_type(request))
+
+    def num_queued(self, priority: ty.Optional[RequestPriority] = None) -> int:
+        if priority is not None:
+            return len(self._lanes[priority])
+        return self._num_queued
+
+    def submit(self, msg_data: bytes, priority: RequestPriority) -> bool:
+        """ Send the serialized request now if possible, else queue it in its lane. False if it could not be sent """
+        if self._num_queued == 0 and not self.act_connection.is_writing_paused():
+            is_sent = self.act_connection.send_serialized_request(msg_data=msg_data)
+            if is_sent:
+                self.lane_stats[priority].on_sent(num_bytes=len(msg_data), delay_secs=0.0)
+            return is_sent
+        lane = self._lanes[priority]
+        lane.append(_QueuedRequest(msg_data=msg_data, queued_at=self._clock()))
+        self._num_queued += 1
+        lane_stats = self.lane_stats[priority]
+        lane_stats.num_queued += 1
+        lane_stats.peak_depth = max(lane_stats.peak_depth, len(lane))
+        if not self.act_connection.is_writing_paused():
+            self._schedule_drain()
+        return True
+
+    def drain(self):
+        """ Send queued requests in priority order until the queue is empty or the transport pauses writing """
+        self._drain_scheduled = False
+        while self._num_queued > 0 and not self.act_connection.is_writing_paused():
+            priority = self._next_lane()
+            queued_request = self._lanes[priority].popleft()
+            self._num_queued -= 1
+            self._credits[priority] -= 1
+            delay_secs = self._clock() - queued_request.queued_at
+            if self.act_connection.send_serialized_request(msg_data=queued_request.msg_data):
+                self.lane_stats[priority].on_sent(num_bytes=len(queued_request.msg_data), delay_secs=delay_secs)
+            else:
+                self.lane_stats[priority].num_dropped += 1
+        if self._num_queued == 0:
+            # the next backlog starts a fresh round
+            self._credits = list(self._lane_weights)
+
+    def _next_lane(self) -> RequestPriority:
+        """ The highest priority non empty lane with credit left in this round, starting a new round once none has """
+        for _ in range(2):
+            for priority in RequestPriority:
+                if self._lanes[priority] and self._credits[priority] > 0:
+                    return priority
+            self._credits = list(self._lane_weights)
+        raise RuntimeError(f'No queued request to send')
+
+    def _schedule_drain(self):
+        if not self._drain_scheduled:
+            self._drain_scheduled = True
+            self.act_connection.loop.call_soon(self.drain)
+
+    def _on_resume_writing(self, act_connection: connection.ActConnection):
+        if self._num_queued > 0:
+            self._schedule_drain()
+
+    def _on_connection_state_change(self, act_connection: connection.ActConnection, new_state: connection.ActConnectionState, err_msg: ty.Optional[str],
+                                    old_state: connection.ActConnectionState):
+        if new_state != connection.ActConnectionState.Disconnected or self._num_queued == 0:
+            return
+        for priority in RequestPriority:
+            self.lane_stats[priority].num_dropped += len(self._lanes[priority])
+            self._lanes[priority].clear()
+        self._logger.warning(f'Dropped {self._num_queued} queued requests on disconnect from {act_connection}')
+        self._num_queued = 0
+        self._credits = list(self._lane_weights)
+
+    def format_stats(self) -> str:
+        return '\n'.join(f'{priority.name}: {self.lane_stats[priority].to_str()}' for priority in RequestPriority)
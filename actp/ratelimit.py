@@ -0,0 +1,173 @@
+"""
+Client side rate limiting of requests per sub-protocol, optionally adapting the rate to how fast the server acknowledges them
+"""
+import asyncio
+import dataclasses
+import logging
+import time
+import typing as ty
+
+from .proto import Act_pb2 as act_pb
+
+
+@dataclasses.dataclass(unsafe_hash=True)
+class AimdPolicy:
+    """ Additive increase, multiplicative decrease of the rate, decided once per adjust_interval in which responses came back
+
+    If any response in the interval took longer than target_rtt (or timed out) the rate is multiplied by decrease_factor,
+    otherwise increase requests/s are added, always within [min_rate, max_rate].
+    """
+    target_rtt: float = 0.25
+    increase: float = 5.0
+    decrease_factor: float = 0.5
+    min_rate: float = 1.0
+    max_rate: float = 1000.0
+    adjust_interval: float = 0.5
+
+    def get_next_rate(self, rate: float, max_rtt: float) -> float:
+        if max_rtt > self.target_rtt:
+            return max(self.min_rate, rate * self.decrease_factor)
+        return min(self.max_rate, rate + self.increase)
+
+
+@dataclasses.dataclass(unsafe_hash=True)
+class RateLimit:
+    rate: float  # requests per second, the starting rate with aimd
+    burst: int = 1  # requests that may go at once after being idle
+    aimd: ty.Optional[AimdPolicy] = None
+
+
+@dataclasses.dataclass
+class RateLimitStats:
+    num_acquired: int = 0
+    num_waited: int = 0  # of num_acquired, those that had to wait for a token
+    total_wait_secs: float = 0.0
+    max_wait_secs: float = 0.0
+    num_responses: int = 0
+    max_rtt: float = 0.0
+    num_increases: int = 0
+    num_decreases: int = 0
+
+    def to_str(self) -> str:
+        mean_wait_secs = self.total_wait_secs / self.num_acquired if self.num_acquired > 0 else 0.0
+        return (f'acquired:{self.num_acquired} waited:{self.num_waited} wait mean:{mean_wait_secs * 1e3:.1f}ms max:{self.max_wait_secs * 1e3:.1f}ms '
+                f'responses:{self.num_responses} max rtt:{self.max_rtt * 1e3:.1f}ms increases:{self.num_increases} decreases:{self.num_decreases}')
+
+
+class TokenBucket(object):
+    """ Holds up to burst tokens, refilled at rate tokens per second """
+
+    def __init__(self, rate: float, burst: int, clock: ty.Callable[[], float]):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._clock = clock
+        self._tokens = float(self.burst)
+        self._updated_at = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(float(self.burst), self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def try_take(self) -> float:
+        """ Take a token and return 0.0, or if there is none return the seconds until there will be """
+        self._refill()
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return 0.0
+        return (1.0 - self._tokens) / self.rate
+
+    def set_rate(self, rate: float):
+        self._refill()
+        self.rate = rate
+
+
+class _SubProtocolLimiter(object):
+    def __init__(self, rate_limit: RateLimit, clock: ty.Callable[[], float]):
+        self.rate_limit = rate_limit
+        self.bucket = TokenBucket(rate=rate_limit.rate, burst=rate_limit.burst, clock=clock)
+        self.lock = asyncio.Lock()  # waiters get their tokens in arrival order
+        self.stats = RateLimitStats()
+        self.window_max_rtt: ty.Optional[float] = None
+        self.window_started_at = clock()
+
+
+class RequestRateLimiter(object):
+    """ A token bucket per sub-protocol, sub-protocols without a RateLimit are not limited
+
+    ActSession waits on it in the bulk request methods, DexSubSession.update_table_async and AlgoSubSession.create_direct_action_async,
+    so holds, algo status changes and terminates are never held back. With an AimdPolicy the rate follows the response times
+    RequestCorrelator reports for all requests of the sub-protocol, including the interactive ones.
+    """
+
+    def __init__(self, clock: ty.Optional[ty.Callable[[], float]] = None):
+        self._clock = clock if clock is not None else time.monotonic
+        self._logger = logging.getLogger(__name__)
+        self._limiters: ty.Dict[act_pb.SubProtocolType, _SubProtocolLimiter] = dict()
+
+    def set_limit(self, sub_protocol_type: act_pb.SubProtocolType, rate_limit: ty.Optional[RateLimit]):
+        """ None to stop limiting sub_protocol_type """
+        if rate_limit is None:
+            self._limiters.pop(sub_protocol_type, None)
+            return
+        self._limiters[sub_protocol_type] = _SubProtocolLimiter(rate_limit=rate_limit, clock=self._clock)
+
+    def get_rate(self, sub_protocol_type: act_pb.SubProtocolType) -> ty.Optional[float]:
+        """ The current requests/s limit, None if not limited """
+        limiter = self._limiters.get(sub_protocol_type)
+        return limiter.bucket.rate if limiter is not None else None
+
+    def get_stats(self, sub_protocol_type: act_pb.SubProtocolType) -> ty.Optional[RateLimitStats]:
+        limiter = self._limiters.get(sub_protocol_type)
+        return limiter.stats if limiter is not None else None
+
+    async def acquire(self, sub_protocol_type: act_pb.SubProtocolType):
+        """ Wait until a request of sub_protocol_type may be sent """
+        limiter = self._limiters.get(sub_protocol_type)
+        if limiter is None:
+            return
+        started_at = self._clock()
+        has_waited = limiter.lock.locked()
+        async with limiter.lock:
+            while True:
+                wait_secs = limiter.bucket.try_take()
+                if wait_secs <= 0.0:
+                    break
+                has_waited = True
+                await asyncio.sleep(wait_secs)
+        stats = limiter.stats
+        stats.num_acquired += 1
+        if has_waited:
+            waited_secs = self._clock() - started_at
+            stats.num_waited += 1
+            stats.total_wait_secs += waited_secs
+            stats.max_wait_secs = max(stats.max_wait_secs, waited_secs)
+
+    def on_response_time(self, sub_protocol_type: act_pb.SubProtocolType, request_type: ty.Optional[int], rtt: float):
+        """ RequestCorrelator response time handler, a timed out request comes with its timeout """
+        limiter = self._limiters.get(sub_protocol_type)
+        if limiter is None:
+            return
+        limiter.stats.num_responses += 1
+        limiter.stats.max_rtt = max(limiter.stats.max_rtt, rtt)
+        aimd = limiter.rate_limit.aimd
+        if aimd is None:
+            return
+        limiter.window_max_rtt = rtt if limiter.window_max_rtt is None else max(limiter.window_max_rtt, rtt)
+        now = self._clock()
+        if now - limiter.window_started_at < aimd.adjust_interval:
+            return
+        rate = limiter.bucket.rate
+        next_rate = aimd.get_next_rate(rate=rate, max_rtt=limiter.window_max_rtt)
+        if next_rate < rate:
+            limiter.stats.num_decreases += 1
+            self._logger.info(f'Slowing sub-protocol {sub_protocol_type} requests to {next_rate:.1f}/s, response time {limiter.window_max_rtt * 1e3:.1f}ms')
+        elif next_rate > rate:
+            limiter.stats.num_increases += 1
+        limiter.bucket.set_rate(next_rate)
+        limiter.window_max_rtt = None
+        limiter.window_started_at = now
+
+    def format_stats(self) -> str:
+        return '\n'.join(f'sub-protocol {sub_protocol_type} rate:{limiter.bucket.rate:.1f}/s {limiter.stats.to_str()}'
+                         for sub_protocol_type, limiter in self._limiters.items())
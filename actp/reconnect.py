@@ -0,0 +1,152 @@
+"""
+Keeping an ActSession alive across dropped connections, e.g. an Actant restart
+"""
+import asyncio
+import dataclasses
+import logging
+import random
+import typing as ty
+
+from . import connection
+from . import dex
+from . import session
+
+
+@dataclasses.dataclass(unsafe_hash=True)
+class ReconnectPolicy:
+    """ Jittered exponential backoff: attempt n waits a random time in [(1 - jitter) * delay, delay], delay = min(max_delay, initial_delay * multiplier ** n) """
+    initial_delay: float = 0.5
+    max_delay: float = 30.0
+    multiplier: float = 2.0
+    jitter: float = 0.5
+    max_attempts: ty.Optional[int] = None  # None to keep trying
+    logon_timeout: float = 10.0
+
+    def get_delay(self, attempt: int, rnd: random.Random) -> float:
+        delay = min(self.max_delay, self.initial_delay * self.multiplier ** attempt)
+        return delay * (1.0 - self.jitter * rnd.random())
+
+
+@dataclasses.dataclass
+class ReconnectStats:
+    num_disconnects: int = 0
+    num_attempts: int = 0
+    num_reconnects: int = 0
+    last_recovery_secs: ty.Optional[float] = None
+    max_recovery_secs: float = 0.0
+
+
+ReconnectHandler = ty.Callable[['ActSessionKeeper', session.LogonResponse], None]
+
+
+class ActSessionKeeper(object):
+    """ Reconnects and logs on again after the connection of an ActSession drops, then restarts its streaming DexQuerys
+
+    Only unexpected disconnects are handled, after act_session.logout() or act_connection.disconnect() the keeper stops.
+    """
+
+    def __init__(self, act_session: session.ActSession, policy: ty.Optional[ReconnectPolicy] = None, rnd: ty.Optional[random.Random] = None):
+        self.act_session = act_session
+        self.act_connection: connection.ActConnection = act_session.act_connection
+        self.policy = policy if policy is not None else ReconnectPolicy()
+        self._rnd = rnd if rnd is not None else random.Random()
+        self._logger = logging.getLogger(__name__)
+        self.stats = ReconnectStats()
+        self._dex_queries: ty.List[dex.DexQuery] = []
+        self._reconnect_handlers: ty.List[ReconnectHandler] = []
+        self._reconnect_task: ty.Optional[asyncio.Task] = None
+        self._is_started = False
+        self.on_stopped: asyncio.Future = self.act_connection.loop.create_future()
+        self.act_connection.add_state_change_handler(self._on_connection_state_change)
+
+    def add_query(self, dex_query: dex.DexQuery):
+        """ Have dex_query restarted after a reconnect if it is still streaming then """
+        self._dex_queries.append(dex_query)
+
+    def remove_query(self, dex_query: dex.DexQuery):
+        if dex_query in self._dex_queries:
+            self._dex_queries.remove(dex_query)
+
+    def add_reconnect_handler(self, reconnect_handler: ReconnectHandler):
+        self._reconnect_handlers.append(reconnect_handler)
+
+    def start(self):
+        """ Start watching the connection, call once connected and logged on """
+        self._is_started = True
+
+    def stop(self):
+        self._is_started = False
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        if not self.on_stopped.done():
+            self.on_stopped.set_result(True)
+
+    async def wait_stopped(self):
+        """ Wait until stopped, by stop(), a deliberate disconnect or running out of reconnect attempts """
+        await self.on_stopped
+
+    def _on_connection_state_change(self, act_connection: connection.ActConnection, new_state: connection.ActConnectionState, err_msg: ty.Optional[str],
+                                    old_state: connection.ActConnectionState):
+        if not self._is_started or new_state != connection.ActConnectionState.Disconnected or self._reconnect_task is not None:
+            return
+        if act_connection.disconnect_requested:
+            self.stop()
+            return
+        self.stats.num_disconnects += 1
+        self._logger.warning(f'Lost connection to {act_connection} ({err_msg}), reconnecting')
+        for dex_query in self._dex_queries:
+            if dex_query.is_streaming():
+                dex_query.on_disconnected()
+        self._reconnect_task = self.act_connection.loop.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        started_at = self.act_connection.loop.time()
+        attempt = 0
+        while self.policy.max_attempts is None or attempt < self.policy.max_attempts:
+            delay = self.policy.get_delay(attempt=attempt, rnd=self._rnd)
+            attempt += 1
+            self.stats.num_attempts += 1
+            self._logger.info(f'Reconnect attempt {attempt} to {self.act_connection} in {delay:.2f}s')
+            await asyncio.sleep(delay)
+            logon_response = await self._try_logon()
+            if logon_response is None:
+                continue
+            recovery_secs = self.act_connection.loop.time() - started_at
+            self.stats.num_reconnects += 1
+            self.stats.last_recovery_secs = recovery_secs
+            self.stats.max_recovery_secs = max(self.stats.max_recovery_secs, recovery_secs)
+            self._logger.info(f'Reconnected to {self.act_connection} after {recovery_secs:.2f}s and {attempt} attempts')
+            self._reconnect_task = None
+            self._restart_queries()
+            for reconnect_handler in self._reconnect_handlers:
+                reconnect_handler(self, logon_response)
+            return
+        self._logger.error(f'Giving up reconnecting to {self.act_connection} after {attempt} attempts')
+        self._reconnect_task = None
+        self.stop()
+
+    async def _try_logon(self) -> ty.Optional[session.LogonResponse]:
+        """ Connect and log on, None if either failed. A failed logon leaves the connection closed for the next attempt """
+        await self.act_connection.reconnect()
+        if not self.act_connection.is_connected():
+            return None
+        logon = asyncio.ensure_future(self.act_session.logon())
+        done, pending = await asyncio.wait((logon, self.act_connection.on_connection_lost), timeout=self.policy.logon_timeout,
+                                           return_when=asyncio.FIRST_COMPLETED)
+        if logon not in done:
+            logon.cancel()
+            self._logger.warning(f'No logon response from {self.act_connection}')
+        elif not logon.result().Success:
+            self._logger.warning(f'Failed to log on to {self.act_connection}: {logon.result().ErrorMsg}')
+        else:
+            return logon.result()
+        if self.act_connection.is_connected():
+            self.act_connection.disconnect()
+        return None
+
+    def _restart_queries(self):
+        for dex_query in self._dex_queries:
+            if dex_query.is_streaming():
+                self._logger.info(f'Restarting query {dex_query}')
+                dex_query.restart()
@@ -5,9 +5,14 @@ import collections
 import dataclasses
 import enum
 import logging
+import time
 import typing as ty
 
 from . import connection
+from . import priority
+from . import ratelimit
+from . import wire
+from . import wiretap
 from .proto import ActAlgo_pb2 as algo_pb
 from .proto import ActAutoControl_pb2 as autocontrol_pb
 from .proto import ActTypes_pb2 as act_types_pb
@@ -42,9 +47,12 @@ class StrProperty:
 
     def to_proto(self) -> act_types_pb.Property:
         property = act_types_pb.Property()
+        self.fill_proto(property)
+        return property
+
+    def fill_proto(self, property: act_types_pb.Property):
         property.name = self.name
         property.value = self.value
-        return property
 
 
 @dataclasses.dataclass(unsafe_hash=True)
@@ -60,14 +68,58 @@ ActSessionToStrFunc = ty.Callable[['ActSession'], str]
 RequestInspector = ty.Callable[[act_pb.Request], None]
 ResponseInspector = ty.Callable[[act_pb.Response], None]
 
+ClientIdFilter = ty.Callable[[connection.ClientId], bool]
+RawSubSessionHandler = connection.RawResponseHandler
+
+ResponseType = int
+# Get the sub-protocol's own response message, e.g. response.dexResponse
+SubResponseHandler = ty.Callable[[ty.Any], None]
+# Also get the request the response is for, found by its clientId
+CorrelatedResponseHandler = ty.Callable[[ty.Any, 'PendingRequest'], None]
+
+
+@dataclasses.dataclass
+class _ResponseRoute:
+    correlated_handler: ty.Optional[CorrelatedResponseHandler] = None
+    subscribers: ty.List[SubResponseHandler] = dataclasses.field(default_factory=list)
+
+
+class PreparedRequest(object):
+    """ An act_pb.Request serialized once, to be sent any number of times with a different clientId each time """
+
+    def __init__(self, request: act_pb.Request):
+        self.request = request
+        self.sub_protocol_type: act_pb.SubProtocolType = request.subProtocolType
+        self.request_type: ty.Optional[priority.RequestType] = priority.get_request_type(request)
+        self.msg_data: bytes = request.SerializeToString()
+
+    def get_msg_data(self, client_id: ty.Optional[ClientId] = None) -> bytes:
+        if client_id is None:
+            return self.msg_data
+        return self.msg_data + wire.encode_request_client_id(sub_protocol_type=self.sub_protocol_type, client_id=client_id)
+
+    def to_request(self, client_id: ty.Optional[ClientId] = None) -> act_pb.Request:
+        """ The request as it is sent with client_id, for request inspectors """
+        request = act_pb.Request()
+        request.ParseFromString(self.get_msg_data(client_id=client_id))
+        return request
+
 
 class ActSession(object):
     def __init__(self, act_connection: connection.ActConnection, user: str, password: str, appname: str,
                  failure_actions: ty.Optional[ty.List[act_pb.FailureAction]] = None,
                  session_options: ty.Optional[ty.List[act_pb.SessionOption]] = None,
                  client_properties: ty.Optional[ty.List[StrProperty]] = None,
+                 request_timeout: ty.Optional[float] = None,
+                 request_scheduler: ty.Optional[priority.PriorityRequestScheduler] = None,
+                 rate_limiter: ty.Optional[ratelimit.RequestRateLimiter] = None,
                  ):
+        """ request_timeout: default for how long requests wait for a response before they are failed, None to wait forever
+        request_scheduler: sends requests through priority lanes on act_connection, None to send them in the order made
+        rate_limiter: paces bulk requests per sub-protocol, fed the response times of this session's requests
+        """
         self.act_connection: connection.ActConnection = act_connection
+        self.request_scheduler = request_scheduler
         self._logger = logging.getLogger(__name__)
         self.user = user
         self.password = password
@@ -76,13 +128,25 @@ class ActSession(object):
         self.session_options = session_options
         self.client_properties = client_properties
         self._handlers: ty.Dict[act_pb.SubProtocolType, connection.ResponseHandler] = dict()
+        self._routes: ty.Dict[ty.Tuple[act_pb.SubProtocolType, ResponseType], _ResponseRoute] = dict()
+        self._handled_sub_protocol_types: ty.Set[act_pb.SubProtocolType] = set()
+        self.num_unhandled_responses: ty.Counter[ty.Tuple[act_pb.SubProtocolType, ResponseType]] = collections.Counter()
+        self._client_id_filters: ty.Dict[act_pb.SubProtocolType, ClientIdFilter] = dict()
+        self._raw_handlers: ty.Dict[act_pb.SubProtocolType, RawSubSessionHandler] = dict()
         self.session_id: int = 0
         self.to_str_func: ty.Optional[ActSessionToStrFunc] = None
         self.session_properties: ty.List[StrProperty] = []
         self.server_connections: ty.List[ServerConnection] = []
         self._request_inspectors: ty.List[RequestInspector] = []
         self._response_inspectors: ty.List[ResponseInspector] = []
+        self.requests = RequestCorrelator(loop=act_connection.loop, default_timeout=request_timeout)
+        self.rate_limiter = rate_limiter
+        if rate_limiter is not None:
+            self.requests.add_response_time_handler(rate_limiter.on_response_time)
+        self.act_connection.add_state_change_handler(self._on_connection_state_change)
         self.act_connection.set_response_handler(on_response=self.on_response)
+        self.act_connection.set_response_filter(response_filter=self._accept_response)
+        self.act_connection.set_raw_response_handler(raw_response_handler=self._on_raw_response)
         self.act_sub_session = ActSubSession(act_session=self)
         self.dex_sub_session = DexSubSession(act_session=self)
         self.autocontrol_sub_session = AutoControlSubSession(act_session=self)
@@ -97,15 +161,57 @@ class ActSession(object):
         return f'({self.act_connection}:{self.session_id}:{self.user})'
 
     async def logon(self) -> LogonResponse:
-        return await self.act_sub_session.logon(user=self.user, password=self.password, appname=self.appname)
+        """ Can be called again after a reconnect, the logon uses the same parameters """
+        self.session_properties.clear()
+        self.server_connections.clear()
+        return await self.act_sub_session.logon(user=self.user, password=self.password, appname=self.appname, failure_actions=self.failure_actions,
+                                                session_options=self.session_options, client_properties=self.client_properties)
 
     def logout(self):
         self.act_sub_session.logout()
         self.act_connection.disconnect()
 
-    def add_sub_session_handler(self, sub_protocol_type: act_pb.SubProtocolType, handler: connection.ResponseHandler) -> None:
+    def _on_connection_state_change(self, act_connection: connection.ActConnection, new_state: connection.ActConnectionState, err_msg: ty.Optional[str],
+                                    old_state: connection.ActConnectionState):
+        if new_state != connection.ActConnectionState.Disconnected:
+            return
+        num_failed = self.requests.fail_all(err_msg=f'Disconnected from {act_connection}')
+        if num_failed > 0:
+            self._logger.warning(f'Failed {num_failed} requests still waiting for a response on disconnect')
+
+    def add_sub_session_handler(self, sub_protocol_type: act_pb.SubProtocolType, handler: connection.ResponseHandler,
+                                client_id_filter: ty.Optional[ClientIdFilter] = None) -> None:
+        """ handler gets the sub-protocol's responses of types without a response handler """
         # self._logger.info(f'adding handler for sub-protocol {sub_protocol_type}')
         self._handlers[sub_protocol_type] = handler
+        self._handled_sub_protocol_types.add(sub_protocol_type)
+        if client_id_filter is not None:
+            self.set_client_id_filter(sub_protocol_type=sub_protocol_type, client_id_filter=client_id_filter)
+
+    def set_client_id_filter(self, sub_protocol_type: act_pb.SubProtocolType, client_id_filter: ClientIdFilter) -> None:
+        """ client_id_filter drops that sub-protocol's responses for unknown client ids before they are decoded """
+        self._client_id_filters[sub_protocol_type] = client_id_filter
+
+    def add_response_handler(self, sub_protocol_type: act_pb.SubProtocolType, response_type: ResponseType, handler: SubResponseHandler) -> None:
+        """ handler gets every response of response_type, e.g. broadcasts or updates of a subscription """
+        self._get_route(sub_protocol_type=sub_protocol_type, response_type=response_type).subscribers.append(handler)
+
+    def set_correlated_response_handler(self, sub_protocol_type: act_pb.SubProtocolType, response_type: ResponseType,
+                                        handler: CorrelatedResponseHandler) -> None:
+        """ handler gets responses of response_type together with the pending request (see requests) they answer, which is then done """
+        self._get_route(sub_protocol_type=sub_protocol_type, response_type=response_type).correlated_handler = handler
+
+    def _get_route(self, sub_protocol_type: act_pb.SubProtocolType, response_type: ResponseType) -> _ResponseRoute:
+        route = self._routes.get((sub_protocol_type, response_type))
+        if route is None:
+            route = _ResponseRoute()
+            self._routes[(sub_protocol_type, response_type)] = route
+            self._handled_sub_protocol_types.add(sub_protocol_type)
+        return route
+
+    def add_sub_session_raw_handler(self, sub_protocol_type: act_pb.SubProtocolType, raw_handler: RawSubSessionHandler) -> None:
+        """ raw_handler may consume a sub-protocol's frames before they are decoded into protobuf messages """
+        self._raw_handlers[sub_protocol_type] = raw_handler
 
     def add_inspectors(self, request_inspector: ty.Optional[RequestInspector], response_inspector: ty.Optional[ResponseInspector]):
         """ Functions to call on every request or response """
@@ -117,24 +223,103 @@ class ActSession(object):
     def remove_inspectors(self, request_inspector: ty.Optional[RequestInspector], response_inspector: ty.Optional[ResponseInspector]):
         if request_inspector in self._request_inspectors:
             self._request_inspectors.remove(request_inspector)
-        if response_inspector is self._response_inspectors:
+        if response_inspector in self._response_inspectors:
             self._response_inspectors.remove(response_inspector)
 
     def send_request(self, request: act_pb.Request) -> None:
         # self._logger.info(f'sending sub-protocol {request.subProtocolType} request')
         for request_inspector in self._request_inspectors:
             request_inspector(request)
+        if self.request_scheduler is not None:
+            self.request_scheduler.submit(msg_data=request.SerializeToString(), priority=self.request_scheduler.get_request_priority(request))
+            return
         self.act_connection.send_request(request=request)
 
+    async def send_request_async(self, request: act_pb.Request) -> bool:
+        """ Send, waiting first while the connection is paused by transport flow control
+
+        With a request_scheduler, High priority requests don't wait but queue ahead of what is held back
+        """
+        for request_inspector in self._request_inspectors:
+            request_inspector(request)
+        if self.request_scheduler is not None:
+            return await self._submit_async(msg_data=request.SerializeToString(), request_priority=self.request_scheduler.get_request_priority(request))
+        return await self.act_connection.send_request_async(request=request)
+
+    def send_prepared_request(self, prepared_request: PreparedRequest, client_id: ty.Optional[ClientId] = None) -> None:
+        """ Send prepared_request without serializing it again, with its clientId set to client_id if given """
+        for request_inspector in self._request_inspectors:
+            request_inspector(prepared_request.to_request(client_id=client_id))
+        if self.request_scheduler is not None:
+            self.request_scheduler.submit(msg_data=prepared_request.get_msg_data(client_id=client_id),
+                                          priority=self.request_scheduler.get_priority(prepared_request.sub_protocol_type, prepared_request.request_type))
+            return
+        self.act_connection.send_serialized_request(msg_data=prepared_request.get_msg_data(client_id=client_id))
+
+    async def send_prepared_request_async(self, prepared_request: PreparedRequest, client_id: ty.Optional[ClientId] = None) -> bool:
+        for request_inspector in self._request_inspectors:
+            request_inspector(prepared_request.to_request(client_id=client_id))
+        if self.request_scheduler is not None:
+            return await self._submit_async(msg_data=prepared_request.get_msg_data(client_id=client_id),
+                                            request_priority=self.request_scheduler.get_priority(prepared_request.sub_protocol_type, prepared_request.request_type))
+        return await self.act_connection.send_serialized_request_async(msg_data=prepared_request.get_msg_data(client_id=client_id))
+
+    async def _submit_async(self, msg_data: bytes, request_priority: priority.RequestPriority) -> bool:
+        if request_priority != priority.RequestPriority.High:
+            # keeps what is held back bounded, as without a scheduler
+            await self.act_connection.wait_writable()
+        return self.request_scheduler.submit(msg_data=msg_data, priority=request_priority)
+
+    async def wait_rate_limit(self, sub_protocol_type: act_pb.SubProtocolType):
+        """ Wait until the rate limiter, if any, lets a request of sub_protocol_type go """
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire(sub_protocol_type)
+
+    def _accept_response(self, sub_protocol_type: act_pb.SubProtocolType, client_id: ty.Optional[connection.ClientId]) -> bool:
+        if self._response_inspectors:
+            # inspectors get to see everything
+            return True
+        if sub_protocol_type not in self._handled_sub_protocol_types:
+            return False
+        client_id_filter = self._client_id_filters.get(sub_protocol_type)
+        return client_id_filter is None or client_id is None or client_id_filter(client_id)
+
+    def _on_raw_response(self, frame: memoryview, envelope: wire.ResponseEnvelope) -> bool:
+        if self._response_inspectors:
+            return False
+        raw_handler = self._raw_handlers.get(envelope.sub_protocol_type)
+        return raw_handler is not None and raw_handler(frame, envelope)
+
     def on_response(self, response: act_pb.Response):
         for response_inspector in self._response_inspectors:
             response_inspector(response)
         sub_protocol_type = response.subProtocolType
         # self._logger.info(f'received sub-protocol {sub_protocol_type} response')
-        if sub_protocol_type in self._handlers:
-            self._handlers[sub_protocol_type](response)
-        else:
-            self._logger.warning(f'sub protocol type {sub_protocol_type} responses not handled')
+        field_name = wire.RESPONSE_FIELD_NAMES.get(sub_protocol_type)
+        response_type = None
+        if field_name is not None:
+            sub_response = getattr(response, field_name)
+            response_type = sub_response.responseType
+            route = self._routes.get((sub_protocol_type, response_type))
+            if route is not None:
+                is_handled = False
+                if route.correlated_handler is not None:
+                    pending_request = self.requests.pop(sub_protocol_type=sub_protocol_type, client_id=sub_response.clientId)
+                    if pending_request is not None:
+                        route.correlated_handler(sub_response, pending_request)
+                        is_handled = True
+                for subscriber in route.subscribers:
+                    subscriber(sub_response)
+                    is_handled = True
+                if is_handled:
+                    return
+        handler = self._handlers.get(sub_protocol_type)
+        if handler is not None:
+            handler(response)
+            return
+        self.num_unhandled_responses[(sub_protocol_type, response_type)] += 1
+        if self.num_unhandled_responses[(sub_protocol_type, response_type)] == 1:
+            self._logger.warning(f'sub protocol type {sub_protocol_type} responses of type {response_type} not handled')
 
 
 class InspectorHelper(object):
@@ -148,6 +333,7 @@ class InspectorHelper(object):
         self.response_inspector: ty.Optional[ResponseInspector] = None
         self.incoming_data_inspector: ty.Optional[connection.IncomingDataInspector] = None
         self.outgoing_data_inspector: ty.Optional[connection.OutgoingDataInspector] = None
+        self.wire_tap: ty.Optional[wiretap.WireTap] = None
 
     def start(self, inspect_requests=False, inspect_responses=False, inspect_incoming_data=False, inspect_outgoing_data=False):
         if self._started:
@@ -161,6 +347,22 @@ class InspectorHelper(object):
         self.act_session.add_inspectors(request_inspector=self.request_inspector, response_inspector=self.response_inspector)
         self.act_session.act_connection.add_inspectors(outgoing_data_inspector=self.outgoing_data_inspector, incoming_data_inspector=self.incoming_data_inspector)
 
+    def start_wire_tap(self, max_frames: int = 10000, sample_every: int = 1, max_frame_bytes: ty.Optional[int] = None) -> wiretap.WireTap:
+        """ Capture raw frames into a ring buffer instead of logging every message as text, see WireTap.dump """
+        self.wire_tap = wiretap.WireTap(max_frames=max_frames, sample_every=sample_every, max_frame_bytes=max_frame_bytes)
+        self._logger.info(f'Starting wire tap. Max frames:{max_frames}, Sample every:{sample_every}, Max frame bytes:{max_frame_bytes}')
+        self.act_session.act_connection.set_wire_tap(wire_tap=self.wire_tap)
+        return self.wire_tap
+
+    def stop_wire_tap(self) -> ty.Optional[wiretap.WireTap]:
+        """ Detach the wire tap, returned so what it captured can still be dumped """
+        wire_tap = self.wire_tap
+        self.wire_tap = None
+        if wire_tap is not None:
+            self._logger.info(f'Stopping wire tap')
+            self.act_session.act_connection.set_wire_tap(wire_tap=None)
+        return wire_tap
+
     def stop(self):
         self._started = False
         self._logger.info(f'Stopping inspection')
@@ -181,14 +383,17 @@ class ActSubSession(object):
         self.on_logon_response: ty.Optional[asyncio.Future] = None
         self.on_logon_error: ty.Optional[str] = None
         self.on_logon_data: ty.Optional[act_pb.ActLoginResponse] = None
-        self.session.add_sub_session_handler(sub_protocol_type=self._sub_proto_type, handler=self.on_act_response)
+        self.session.add_response_handler(sub_protocol_type=self._sub_proto_type, response_type=act_pb.RESP_LOGIN, handler=self.on_login_response)
 
     async def logon(self, user: str, password: str, appname: str,
                     failure_actions: ty.Optional[ty.List[act_pb.FailureAction]] = None,
                     session_options: ty.Optional[ty.List[act_pb.SessionOption]] = None,
                     client_properties: ty.Optional[ty.List[StrProperty]] = None,
                     ) -> LogonResponse:
-        login_request = act_pb.ActLoginRequest()
+        request, act_request = self._new_request()
+        act_request.requestType = act_pb.REQ_LOGIN
+        act_request.clientId = 0
+        login_request = act_request.loginRequest
         login_request.username = user
         login_request.password = password
         login_request.appname = appname
@@ -201,68 +406,56 @@ class ActSubSession(object):
 
         if client_properties is not None:
             for client_property in client_properties:
-                login_request.clientProperties.append(client_property.to_proto())
-
-        act_request = act_pb.ActRequest()
-        act_request.requestType = act_pb.REQ_LOGIN
-        act_request.clientId = 0
-        act_request.loginRequest.CopyFrom(login_request)
+                client_property.fill_proto(login_request.clientProperties.add())
 
         self._logger.info(f'Logging in as user "{user}" and app "{appname}"')
-        self._send_request(act_request=act_request)
+        self.on_logon_error = None
+        self.on_logon_data = None
         self.on_logon_response = asyncio.get_running_loop().create_future()
+        self.session.send_request(request=request)
         await self.on_logon_response
         return LogonResponse(self.on_logon_error is None, self.on_logon_error, self.on_logon_data)
 
     def logout(self):
-        act_request = act_pb.ActRequest()
+        request, act_request = self._new_request()
         act_request.requestType = act_pb.REQ_LOGOUT
         act_request.clientId = 0
 
         self._logger.info(f'Logging off')
-        self._send_request(act_request=act_request)
+        self.session.send_request(request=request)
 
-    def _send_request(self, act_request: act_pb.Request):
+    def _new_request(self) -> ty.Tuple[act_pb.Request, act_pb.ActRequest]:
+        """ A request and its actRequest, to be filled in place """
         request = act_pb.Request()
         request.subProtocolType = self._sub_proto_type
-        request.actRequest.CopyFrom(act_request)
-        self.session.send_request(request=request)
+        return request, request.actRequest
 
-    def on_act_response(self, response: act_pb.Response):
-        act_response = response.actResponse
-        if act_response is None:
-            self._logger.error(f'Got empty act sub-protocol response')
+    def on_login_response(self, act_response: act_pb.ActResponse):
+        if log_any_error("login response", act_response.operationStatus):
+            self.on_logon_error = act_response.operationStatus.errorMessage
+            self.on_logon_response.set_result(True)
             return
-
-        response_type = act_response.responseType
-        if response_type == act_pb.RESP_LOGIN:
-            if log_any_error("login response", act_response.operationStatus):
-                self.on_logon_error = act_response.operationStatus.errorMessage
-                self.on_logon_response.set_result(True)
-                return
-            login_response = act_response.loginResponse
-            if login_response is None:
-                self.on_logon_error = f'No logon response'
-                self.on_logon_response.set_result(True)
-                return
-            self.session.session_id = act_response.sessionId
-            self._logger.info(f'Logged in on {self.session.act_connection} as {login_response.User}, session id {self.session.session_id}')
-            self._logger.info(f'Actant version: {login_response.Version}')
-            self._logger.info(f'Link time: {login_response.LinkTime}')
-            has_allocations = False
-            if login_response.HasField('hasAllocations'):
-                has_allocations = login_response.hasAllocations
-            self._logger.info(f'Node: {login_response.Node}, user:{login_response.User}, allocations: {has_allocations}')
-            if login_response.HasField('actProtocolVersion'):
-                self._logger.info(f'Act Version: {login_response.actProtocolVersion}')
-            for prop in login_response.properties:
-                self.session.session_properties.append(StrProperty(prop.name, prop.value))
-            for server_connection in act_response.connections:
-                self.session.server_connections.append(ServerConnection(server_connection.name, server_connection.status))
-            self.on_logon_data = login_response
+        login_response = act_response.loginResponse
+        if login_response is None:
+            self.on_logon_error = f'No logon response'
             self.on_logon_response.set_result(True)
-        else:
-            self._logger.info(f'Unhandled act sub-protocol response type')
+            return
+        self.session.session_id = act_response.sessionId
+        self._logger.info(f'Logged in on {self.session.act_connection} as {login_response.User}, session id {self.session.session_id}')
+        self._logger.info(f'Actant version: {login_response.Version}')
+        self._logger.info(f'Link time: {login_response.LinkTime}')
+        has_allocations = False
+        if login_response.HasField('hasAllocations'):
+            has_allocations = login_response.hasAllocations
+        self._logger.info(f'Node: {login_response.Node}, user:{login_response.User}, allocations: {has_allocations}')
+        if login_response.HasField('actProtocolVersion'):
+            self._logger.info(f'Act Version: {login_response.actProtocolVersion}')
+        for prop in login_response.properties:
+            self.session.session_properties.append(StrProperty(prop.name, prop.value))
+        for server_connection in act_response.connections:
+            self.session.server_connections.append(ServerConnection(server_connection.name, server_connection.status))
+        self.on_logon_data = login_response
+        self.on_logon_response.set_result(True)
 
 
 # ActAutoControl sub-session
@@ -284,6 +477,141 @@ ClientId = int
 ErrMsg = str
 AckResponseHandler = ty.Callable[[ClientId, ErrMsg], None]
 
+# Request correlation
+
+# Called with an error message instead of the response handler when a request can't get a response any more, e.g. on disconnect
+RequestFailHandler = ty.Callable[[ClientId, ErrMsg], None]
+
+MAX_CLIENT_ID: ClientId = 2 ** 31 - 1  # clientId is an int32 or sint32 in most sub-protocols
+
+# Gets how long a request took to be answered, or its timeout if it was not
+ResponseTimeHandler = ty.Callable[[act_pb.SubProtocolType, ty.Optional[priority.RequestType], float], None]
+
+
+@dataclasses.dataclass
+class PendingRequest:
+    sub_protocol_type: act_pb.SubProtocolType
+    client_id: ClientId
+    handler: ty.Any  # sub-session specific response handler
+    on_fail: ty.Optional[RequestFailHandler]
+    sent_at: float
+    timeout_handle: ty.Optional[asyncio.TimerHandle] = None
+    request_type: ty.Optional[priority.RequestType] = None
+
+
+class RequestCorrelator(object):
+    """ Hands out client ids unique across the session and keeps the requests waiting for a response, per sub-protocol
+
+    A request not answered within its timeout (default_timeout if not given, None for no timeout) is failed and forgotten.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, default_timeout: ty.Optional[float] = None):
+        self.loop = loop
+        self.default_timeout = default_timeout
+        self._last_client_id: ClientId = 0
+        self._pending: ty.Dict[act_pb.SubProtocolType, ty.Dict[ClientId, PendingRequest]] = collections.defaultdict(dict)
+        self.peak_in_flight: ty.Dict[act_pb.SubProtocolType, int] = collections.defaultdict(int)
+        self.num_timeouts: int = 0
+        self._response_time_handlers: ty.List[ResponseTimeHandler] = []
+
+    def add_response_time_handler(self, response_time_handler: ResponseTimeHandler):
+        self._response_time_handlers.append(response_time_handler)
+
+    def next_client_id(self) -> ClientId:
+        """ Ids wrap at MAX_CLIENT_ID, skipping any still in flight """
+        while True:
+            self._last_client_id = self._last_client_id % MAX_CLIENT_ID + 1
+            if not any(self._last_client_id in pending for pending in self._pending.values()):
+                return self._last_client_id
+
+    def add(self, sub_protocol_type: act_pb.SubProtocolType, handler: ty.Any, on_fail: ty.Optional[RequestFailHandler] = None,
+            client_id: ty.Optional[ClientId] = None, timeout: ty.Optional[float] = None,
+            request_type: ty.Optional[priority.RequestType] = None) -> PendingRequest:
+        """ Track a request, with a new client id unless it is about an existing one (e.g. stopping a query) """
+        if client_id is None:
+            client_id = self.next_client_id()
+        pending = self._pending[sub_protocol_type]
+        pending_request = PendingRequest(sub_protocol_type=sub_protocol_type, client_id=client_id, handler=handler, on_fail=on_fail, sent_at=time.monotonic(),
+                                         request_type=request_type)
+        if timeout is None:
+            timeout = self.default_timeout
+        if timeout is not None:
+            pending_request.timeout_handle = self.loop.call_later(timeout, self._on_timeout, pending_request, timeout)
+        pending[client_id] = pending_request
+        if len(pending) > self.peak_in_flight[sub_protocol_type]:
+            self.peak_in_flight[sub_protocol_type] = len(pending)
+        return pending_request
+
+    def get(self, sub_protocol_type: act_pb.SubProtocolType, client_id: ClientId) -> ty.Optional[PendingRequest]:
+        pending = self._pending.get(sub_protocol_type)
+        return pending.get(client_id) if pending is not None else None
+
+    def pop(self, sub_protocol_type: act_pb.SubProtocolType, client_id: ClientId, is_answered: bool = True) -> ty.Optional[PendingRequest]:
+        """ The request is done, None if it was not (or no longer) in flight. is_answered False if it was given up on rather than answered """
+        pending = self._pending.get(sub_protocol_type)
+        pending_request = pending.pop(client_id, None) if pending is not None else None
+        if pending_request is None:
+            return None
+        if pending_request.timeout_handle is not None:
+            pending_request.timeout_handle.cancel()
+        if is_answered and self._response_time_handlers:
+            self.report_response_time(sub_protocol_type=sub_protocol_type, request_type=pending_request.request_type,
+                                      response_time=time.monotonic() - pending_request.sent_at)
+        return pending_request
+
+    def report_response_time(self, sub_protocol_type: act_pb.SubProtocolType, request_type: ty.Optional[priority.RequestType], response_time: float):
+        """ Also for requests answered without being tracked here, e.g. DEX start query """
+        for response_time_handler in self._response_time_handlers:
+            response_time_handler(sub_protocol_type, request_type, response_time)
+
+    def num_in_flight(self, sub_protocol_type: ty.Optional[act_pb.SubProtocolType] = None) -> int:
+        if sub_protocol_type is not None:
+            return len(self._pending.get(sub_protocol_type, ()))
+        return sum(len(pending) for pending in self._pending.values())
+
+    def fail_all(self, err_msg: ErrMsg) -> int:
+        """ Stop tracking every request, calling their on_fail, return how many there were """
+        pending_requests = [pending_request for pending in self._pending.values() for pending_request in pending.values()]
+        self._pending.clear()
+        for pending_request in pending_requests:
+            if pending_request.timeout_handle is not None:
+                pending_request.timeout_handle.cancel()
+            if pending_request.on_fail is not None:
+                pending_request.on_fail(pending_request.client_id, err_msg)
+        return len(pending_requests)
+
+    def _on_timeout(self, pending_request: PendingRequest, timeout: float):
+        if self.pop(sub_protocol_type=pending_request.sub_protocol_type, client_id=pending_request.client_id, is_answered=False) is not pending_request:
+            return
+        self.num_timeouts += 1
+        self.report_response_time(sub_protocol_type=pending_request.sub_protocol_type, request_type=pending_request.request_type, response_time=timeout)
+        if pending_request.on_fail is not None:
+            pending_request.on_fail(pending_request.client_id, f'No response within {timeout}s')
+
+
+@dataclasses.dataclass
+class AckResult:
+    client_id: ClientId
+    err_msg: ty.Optional[ErrMsg]
+
+    def is_ok(self) -> bool:
+        return self.err_msg is None or len(self.err_msg) == 0
+
+
+def _set_future_result(future: asyncio.Future, result: ty.Any):
+    """ The awaiting task may have been cancelled in the meantime """
+    if not future.done():
+        future.set_result(result)
+
+
+async def _await_response(requests: RequestCorrelator, sub_protocol_type: act_pb.SubProtocolType, client_id: ClientId, future: asyncio.Future) -> ty.Any:
+    """ Await the future a response handler completes, forgetting the request if the wait is cancelled """
+    try:
+        return await future
+    except asyncio.CancelledError:
+        requests.pop(sub_protocol_type=sub_protocol_type, client_id=client_id, is_answered=False)
+        raise
+
 
 class AutoControlSubSession(object):
     def __init__(self, act_session: ActSession):
@@ -291,21 +619,23 @@ class AutoControlSubSession(object):
         self._logger = logging.getLogger(__name__)
         self._sub_proto_type = act_pb.SUB_PROTO_AUTOCONTROL
         self._request_id = 0  # interactive id
-        self._client_id: ClientId = 0
-        self._automation_request_handlers: ty.Dict[ClientId, AckResponseHandler] = dict()
-        self.session.add_sub_session_handler(sub_protocol_type=self._sub_proto_type, handler=self.on_autocontrol_response)
+        self.session.add_response_handler(sub_protocol_type=self._sub_proto_type, response_type=autocontrol_pb.RESP_AUTOCONTROL_UPDATE,
+                                          handler=self.on_autocontrol_update_response)
+        self.session.set_correlated_response_handler(sub_protocol_type=self._sub_proto_type, response_type=autocontrol_pb.RESP_PRODUCT_AUTOMATION,
+                                                     handler=self.on_product_automation_response)
 
-    def _send_request(self, autocontrol_request: autocontrol_pb.Request):
+    def _new_request(self) -> ty.Tuple[act_pb.Request, autocontrol_pb.Request]:
+        """ A request and its autoControlRequest, to be filled in place """
         request = act_pb.Request()
         request.subProtocolType = self._sub_proto_type
-        request.autoControlRequest.CopyFrom(autocontrol_request)
-        self.session.send_request(request=request)
+        return request, request.autoControlRequest
 
-    def send_automation_updates(self, product_updates: ty.List[ProductAutomationUpdate], callback: AckResponseHandler) -> ClientId:
-        client_id = ++self._client_id
-        self._automation_request_handlers[client_id] = callback
+    def send_automation_updates(self, product_updates: ty.List[ProductAutomationUpdate], callback: AckResponseHandler,
+                                timeout: ty.Optional[float] = None) -> ClientId:
+        client_id = self.session.requests.add(sub_protocol_type=self._sub_proto_type, handler=callback, on_fail=callback, timeout=timeout,
+                                              request_type=autocontrol_pb.REQ_AUTOCONTROL_UPDATE).client_id
 
-        autocontrol_request = autocontrol_pb.Request()
+        request, autocontrol_request = self._new_request()
         autocontrol_request.requestType = autocontrol_pb.RequestType.REQ_AUTOCONTROL_UPDATE
         autocontrol_request.clientId = client_id
 
@@ -320,38 +650,35 @@ class AutoControlSubSession(object):
                 proto_update.automationStatus = automation_update.automation_status
 
         # self._logger.info(f'Sending automation update request')
-        self._send_request(autocontrol_request=autocontrol_request)
+        self.session.send_request(request=request)
         return client_id
 
-    def on_autocontrol_response(self, response: act_pb.Response):
-        autocontrol_response = response.autoControlResponse
-        if autocontrol_response is None:
-            self._logger.error(f'Got empty autocontrol sub-protocol response')
-            return
+    async def send_automation_updates_async(self, product_updates: ty.List[ProductAutomationUpdate], timeout: ty.Optional[float] = None) -> AckResult:
+        future = asyncio.get_running_loop().create_future()
+        client_id = self.send_automation_updates(product_updates=product_updates, timeout=timeout,
+                                                 callback=lambda client_id, err_msg: _set_future_result(future, AckResult(client_id, err_msg)))
+        return await _await_response(requests=self.session.requests, sub_protocol_type=self._sub_proto_type, client_id=client_id, future=future)
 
-        response_type = autocontrol_response.responseType
-        if response_type == autocontrol_pb.RESP_AUTOCONTROL_UPDATE:
-            if has_error(autocontrol_response.operationStatus):
-                if autocontrol_response.clientId in self._automation_request_handlers:
-                    self._automation_request_handlers[autocontrol_response.clientId](autocontrol_response.clientId, _get_error(autocontrol_response.operationStatus))
-                    del self._automation_request_handlers[autocontrol_response.clientId]
-        elif response_type == autocontrol_pb.RESP_PRODUCT_AUTOMATION:
-            self._automation_request_handlers[autocontrol_response.clientId](autocontrol_response.clientId, _get_error(autocontrol_response.operationStatus))
-            del self._automation_request_handlers[autocontrol_response.clientId]
-            # if log_any_error("product automation response", autocontrol_response.operationStatus):
-            #     return
-        else:
-            self._logger.info(f'Unhandled autocontrol sub-protocol response type')
-        pass
+    def on_autocontrol_update_response(self, autocontrol_response: autocontrol_pb.Response):
+        if has_error(autocontrol_response.operationStatus):
+            pending_request = self.session.requests.pop(sub_protocol_type=self._sub_proto_type, client_id=autocontrol_response.clientId)
+            if pending_request is not None:
+                pending_request.handler(autocontrol_response.clientId, _get_error(autocontrol_response.operationStatus))
+
+    def on_product_automation_response(self, autocontrol_response: autocontrol_pb.Response, pending_request: PendingRequest):
+        pending_request.handler(autocontrol_response.clientId, _get_error(autocontrol_response.operationStatus))
 
     def _get_next_iid(self) -> str:
-        return f'{self.session.session_id}:{++self._request_id}'
+        self._request_id += 1
+        return f'{self.session.session_id}:{self._request_id}'
 
 
 # Dex sub-session
 
 
 DexQueryTableUpdateHandler = ty.Callable[[ClientId, ErrMsg, dex_pb.TableUpdate], None]
+# Gets the TableUpdate undecoded as buffer[start:end], buffer is only valid during the call
+DexQueryRawTableUpdateHandler = ty.Callable[[ClientId, ErrMsg, wire.Buffer, int, int], None]
 
 
 @dataclasses.dataclass(unsafe_hash=True)
@@ -359,6 +686,8 @@ class _DexQueryHandlerData:
     is_snapshot: bool
     ack_handler: AckResponseHandler
     table_update_handler: DexQueryTableUpdateHandler
+    raw_table_update_handler: ty.Optional[DexQueryRawTableUpdateHandler] = None
+    started_at: float = 0.0  # time.monotonic() the start query request was made
 
 
 class DexSubSession(object):
@@ -366,25 +695,39 @@ class DexSubSession(object):
         self.session: ActSession = act_session
         self._logger = logging.getLogger(__name__)
         self._sub_proto_type = act_pb.SUB_PROTO_DEX
-        self._client_id: ClientId = 0
         self._query_handler_data: ty.Dict[ClientId, _DexQueryHandlerData] = dict()
-        self._table_update_resp_handlers: ty.Dict[ClientId, AckResponseHandler] = dict()
-        self._stop_query_resp_handlers: ty.Dict[ClientId, AckResponseHandler] = dict()
-        self.session.add_sub_session_handler(sub_protocol_type=self._sub_proto_type, handler=self.on_dex_response)
-
-    def _send_request(self, dex_request: dex_pb.Request):
+        self.session.set_client_id_filter(sub_protocol_type=self._sub_proto_type, client_id_filter=self._is_known_client_id)
+        self.session.add_response_handler(sub_protocol_type=self._sub_proto_type, response_type=dex_pb.RESP_START_QUERY, handler=self.on_start_query_response)
+        self.session.add_response_handler(sub_protocol_type=self._sub_proto_type, response_type=dex_pb.UPDATE_TABLE, handler=self.on_update_table_response)
+        self.session.set_correlated_response_handler(sub_protocol_type=self._sub_proto_type, response_type=dex_pb.RESP_STOP_QUERY,
+                                                     handler=self.on_stop_query_response)
+        self.session.set_correlated_response_handler(sub_protocol_type=self._sub_proto_type, response_type=dex_pb.RESP_TABLE_UPDATE,
+                                                     handler=self.on_table_update_response)
+        self.session.add_sub_session_raw_handler(sub_protocol_type=self._sub_proto_type, raw_handler=self.on_dex_raw_response)
+
+    def _is_known_client_id(self, client_id: ClientId) -> bool:
+        """ Table updates for queries we no longer track (e.g. after stop) are dropped without decoding """
+        return client_id in self._query_handler_data or self.session.requests.get(sub_protocol_type=self._sub_proto_type, client_id=client_id) is not None
+
+    def _new_request(self) -> ty.Tuple[act_pb.Request, dex_pb.Request]:
+        """ A request and its dexRequest, to be filled in place """
         request = act_pb.Request()
         request.subProtocolType = self._sub_proto_type
-        request.dexRequest.CopyFrom(dex_request)
-        self.session.send_request(request=request)
+        return request, request.dexRequest
 
     def start_query(self, scope_keys: ty.List[str], fields: ty.List[str], frequency: int, is_snapshot: bool,
                     ack_handler: AckResponseHandler, table_update_handler: DexQueryTableUpdateHandler,
-                    no_triggers: ty.Optional[ty.List[str]] = None, contexts: ty.Optional[ty.List[str]] = None) -> ClientId:
-        client_id = ++self._client_id
-        self._query_handler_data[client_id] = _DexQueryHandlerData(is_snapshot=is_snapshot, ack_handler=ack_handler, table_update_handler=table_update_handler)
-
-        proto_start_query = dex_pb.StartQuery()
+                    no_triggers: ty.Optional[ty.List[str]] = None, contexts: ty.Optional[ty.List[str]] = None,
+                    raw_table_update_handler: ty.Optional[DexQueryRawTableUpdateHandler] = None) -> ClientId:
+        """ If given, raw_table_update_handler gets table updates instead of table_update_handler, without them being decoded """
+        client_id = self.session.requests.next_client_id()
+        self._query_handler_data[client_id] = _DexQueryHandlerData(is_snapshot=is_snapshot, ack_handler=ack_handler, table_update_handler=table_update_handler,
+                                                                   raw_table_update_handler=raw_table_update_handler, started_at=time.monotonic())
+
+        request, dex_request = self._new_request()
+        dex_request.requestType = dex_pb.RequestType.REQ_START_QUERY
+        dex_request.clientId = client_id
+        proto_start_query = dex_request.startQuery
         proto_start_query.scopeKey.extend(scope_keys)
         proto_start_query.field.extend(fields)
         proto_start_query.frequency = frequency
@@ -394,71 +737,101 @@ class DexSubSession(object):
         if contexts is not None:
             proto_start_query.context.extend(contexts)
 
-        dex_request = dex_pb.Request()
-        dex_request.requestType = dex_pb.RequestType.REQ_START_QUERY
-        dex_request.clientId = client_id
-        dex_request.startQuery.CopyFrom(proto_start_query)
-
-        self._send_request(dex_request=dex_request)
+        self.session.send_request(request=request)
         return client_id
 
-    def stop_query(self, client_id: ClientId, ack_handler: AckResponseHandler):
-        self._stop_query_resp_handlers[client_id] = ack_handler
-        dex_request = dex_pb.Request()
+    def discard_query(self, client_id: ClientId):
+        """ Forget a query without stopping it, e.g. when the connection it was started on is gone """
+        self._query_handler_data.pop(client_id, None)
+        self.session.requests.pop(sub_protocol_type=self._sub_proto_type, client_id=client_id, is_answered=False)
+
+    def stop_query(self, client_id: ClientId, ack_handler: AckResponseHandler, timeout: ty.Optional[float] = None):
+        self.session.requests.add(sub_protocol_type=self._sub_proto_type, handler=ack_handler, on_fail=ack_handler, client_id=client_id, timeout=timeout,
+                                  request_type=dex_pb.REQ_STOP_QUERY)
+        request, dex_request = self._new_request()
         dex_request.requestType = dex_pb.RequestType.REQ_STOP_QUERY
         dex_request.clientId = client_id
 
-        self._send_request(dex_request=dex_request)
+        self.session.send_request(request=request)
 
-    def update_table(self, table_update: dex_pb.TableUpdate, ack_handler: AckResponseHandler):
-        client_id = ++self._client_id
-        self._table_update_resp_handlers[client_id] = ack_handler
-        dex_request = dex_pb.Request()
+    def update_table(self, table_update: dex_pb.TableUpdate, ack_handler: AckResponseHandler, timeout: ty.Optional[float] = None):
+        client_id = self.session.requests.add(sub_protocol_type=self._sub_proto_type, handler=ack_handler, on_fail=ack_handler, timeout=timeout,
+                                              request_type=dex_pb.REQ_TABLE_UPDATE).client_id
+        request, dex_request = self._new_request()
         dex_request.requestType = dex_pb.RequestType.REQ_TABLE_UPDATE
         dex_request.clientId = client_id
         dex_request.tableUpdate.CopyFrom(table_update)
 
-        self._send_request(dex_request=dex_request)
+        self.session.send_request(request=request)
         return client_id
 
-    def on_dex_response(self, response: act_pb.Response):
-        dex_response = response.dexResponse
-        if dex_response is None:
-            self._logger.error(f'Got empty dex sub-protocol response')
-            return
+    def prepare_table_update(self, table_update: dex_pb.TableUpdate) -> PreparedRequest:
+        """ A table update request serialized once, for update_table_prepared to send repeatedly """
+        request, dex_request = self._new_request()
+        dex_request.requestType = dex_pb.RequestType.REQ_TABLE_UPDATE
+        dex_request.tableUpdate.CopyFrom(table_update)
+        return PreparedRequest(request=request)
 
-        response_type = dex_response.responseType
-        if response_type == dex_pb.RESP_START_QUERY:
-            if dex_response.clientId not in self._query_handler_data:
-                self._logger.error(f'No start query response handler for query id {dex_response.clientId}')
-                return
-            query_handler_data = self._query_handler_data[dex_response.clientId]
-            query_handler_data.ack_handler(dex_response.clientId, _get_error(dex_response.operationStatus))
+    def update_table_prepared(self, prepared_request: PreparedRequest, ack_handler: AckResponseHandler, timeout: ty.Optional[float] = None) -> ClientId:
+        client_id = self.session.requests.add(sub_protocol_type=self._sub_proto_type, handler=ack_handler, on_fail=ack_handler, timeout=timeout,
+                                              request_type=dex_pb.REQ_TABLE_UPDATE).client_id
+        self.session.send_prepared_request(prepared_request=prepared_request, client_id=client_id)
+        return client_id
+
+    async def stop_query_async(self, client_id: ClientId, timeout: ty.Optional[float] = None) -> AckResult:
+        future = asyncio.get_running_loop().create_future()
+        self.stop_query(client_id=client_id, timeout=timeout, ack_handler=lambda client_id, err_msg: _set_future_result(future, AckResult(client_id, err_msg)))
+        return await _await_response(requests=self.session.requests, sub_protocol_type=self._sub_proto_type, client_id=client_id, future=future)
+
+    async def update_table_async(self, table_update: dex_pb.TableUpdate, timeout: ty.Optional[float] = None) -> AckResult:
+        await self.session.wait_rate_limit(self._sub_proto_type)
+        future = asyncio.get_running_loop().create_future()
+        client_id = self.update_table(table_update=table_update, timeout=timeout,
+                                      ack_handler=lambda client_id, err_msg: _set_future_result(future, AckResult(client_id, err_msg)))
+        return await _await_response(requests=self.session.requests, sub_protocol_type=self._sub_proto_type, client_id=client_id, future=future)
+
+    def on_dex_raw_response(self, frame: memoryview, envelope: wire.ResponseEnvelope) -> bool:
+        """ Hand table updates straight from the wire to queries that can take them, anything else gets decoded as usual """
+        query_handler_data = self._query_handler_data.get(envelope.client_id)
+        if query_handler_data is None or query_handler_data.raw_table_update_handler is None or len(envelope.body_spans) != 1:
+            return False
+        start, end = envelope.body_spans[0]
+        try:
+            dex_envelope = wire.peek_dex_response(buffer=frame, start=start, end=end)
+        except wire.WireError:
+            return False
+        if dex_envelope.response_type != dex_pb.UPDATE_TABLE or dex_envelope.table_update_span is None:
+            return False
+        table_update_start, table_update_end = dex_envelope.table_update_span
+        query_handler_data.raw_table_update_handler(envelope.client_id, dex_envelope.error_message, frame, table_update_start, table_update_end)
+        if query_handler_data.is_snapshot:
+            del self._query_handler_data[envelope.client_id]
+        return True
+
+    def on_start_query_response(self, dex_response: dex_pb.Response):
+        query_handler_data = self._query_handler_data.get(dex_response.clientId)
+        if query_handler_data is None:
+            self._logger.error(f'No start query response handler for query id {dex_response.clientId}')
             return
-        elif response_type == dex_pb.UPDATE_TABLE:
-            if dex_response.clientId not in self._query_handler_data:
-                self._logger.error(f'No query table update handler for query id {dex_response.clientId}')
-                return
-            query_handler_data = self._query_handler_data[dex_response.clientId]
-            query_handler_data.table_update_handler(dex_response.clientId, _get_error(dex_response.operationStatus), dex_response.tableUpdate)
-            if query_handler_data.is_snapshot:
-                del self._query_handler_data[dex_response.clientId]
+        self.session.requests.report_response_time(sub_protocol_type=self._sub_proto_type, request_type=dex_pb.REQ_START_QUERY,
+                                                   response_time=time.monotonic() - query_handler_data.started_at)
+        query_handler_data.ack_handler(dex_response.clientId, _get_error(dex_response.operationStatus))
+
+    def on_update_table_response(self, dex_response: dex_pb.Response):
+        query_handler_data = self._query_handler_data.get(dex_response.clientId)
+        if query_handler_data is None:
+            self._logger.error(f'No query table update handler for query id {dex_response.clientId}')
             return
-        elif response_type == dex_pb.RESP_STOP_QUERY:
-            if dex_response.clientId not in self._stop_query_resp_handlers:
-                # self._logger.error(f'No stop query response handler for query id {dex_response.clientId}')
-                return
-            stop_query_ack_handler = self._stop_query_resp_handlers[dex_response.clientId]
-            stop_query_ack_handler(dex_response.clientId, _get_error(dex_response.operationStatus))
-            del self._stop_query_resp_handlers[dex_response.clientId]
+        query_handler_data.table_update_handler(dex_response.clientId, _get_error(dex_response.operationStatus), dex_response.tableUpdate)
+        if query_handler_data.is_snapshot:
             del self._query_handler_data[dex_response.clientId]
-        elif response_type == dex_pb.RESP_TABLE_UPDATE:
-            if dex_response.clientId not in self._table_update_resp_handlers:
-                self._logger.error(f'No stop query response handler for query id {dex_response.clientId}')
-                return
-            table_update_ack_handler = self._table_update_resp_handlers[dex_response.clientId]
-            table_update_ack_handler(dex_response.clientId, _get_error(dex_response.operationStatus))
-            del self._table_update_resp_handlers[dex_response.clientId]
+
+    def on_stop_query_response(self, dex_response: dex_pb.Response, pending_request: PendingRequest):
+        self._query_handler_data.pop(dex_response.clientId, None)
+        pending_request.handler(dex_response.clientId, _get_error(dex_response.operationStatus))
+
+    def on_table_update_response(self, dex_response: dex_pb.Response, pending_request: PendingRequest):
+        pending_request.handler(dex_response.clientId, _get_error(dex_response.operationStatus))
 
 
 @dataclasses.dataclass(unsafe_hash=True)
@@ -468,9 +841,12 @@ class NamedInstrument:
 
     def to_proto(self) -> algo_pb.NamedInstrument:
         named_instrument = algo_pb.NamedInstrument()
+        self.fill_proto(named_instrument)
+        return named_instrument
+
+    def fill_proto(self, named_instrument: algo_pb.NamedInstrument):
         named_instrument.name = self.name
         named_instrument.instrument = self.instrument
-        return named_instrument
 
 
 DirectActionAdditionalInstruments = ty.List[NamedInstrument]
@@ -484,6 +860,17 @@ SetAlgoStatusResponseHandler = ty.Callable[[ClientId, ErrMsg, ty.Optional[AlgoNa
 TerminateAlgoResponseHandler = ty.Callable[[ClientId, ErrMsg, ty.Optional[AlgoName]], None]
 
 
+@dataclasses.dataclass
+class CreateDirectActionResult(AckResult):
+    action_name: ty.Optional[DirectActionName] = None
+    automation_status: ty.Optional[AutomationStatus] = None
+
+
+@dataclasses.dataclass
+class AlgoResult(AckResult):
+    algo_name: ty.Optional[AlgoName] = None
+
+
 class AlgoControlStatus(str, enum.Enum):
     Unknown = "Unknown",
     Off = "Off",
@@ -520,17 +907,20 @@ class DirectActionData:
 
     def to_proto(self) -> algo_pb.CreateDirectActionRequest:
         create_direct_action_request = algo_pb.CreateDirectActionRequest()
+        self.fill_proto(create_direct_action_request)
+        return create_direct_action_request
+
+    def fill_proto(self, create_direct_action_request: algo_pb.CreateDirectActionRequest):
         create_direct_action_request.directActionName = self.name
         create_direct_action_request.baseInstrument = self.base_instrument
         if self.additional_instruments is not None:
             for additional_instrument in self.additional_instruments:
-                create_direct_action_request.additionalInstruments.append(additional_instrument.to_proto())
+                additional_instrument.fill_proto(create_direct_action_request.additionalInstruments.add())
         if self.input_parameters is not None:
             for input_parameter in self.input_parameters:
-                create_direct_action_request.inputParameters.append(input_parameter.to_proto())
+                input_parameter.fill_proto(create_direct_action_request.inputParameters.add())
         if self.action_status is not None:
             create_direct_action_request.actionStatus = self.action_status
-        return create_direct_action_request
 
 
 # algo sub-session
@@ -540,92 +930,87 @@ class AlgoSubSession(object):
         self.session: ActSession = act_session
         self._logger = logging.getLogger(__name__)
         self._sub_proto_type = act_pb.SUB_PROTO_ALGO
-        self._client_id: ClientId = 0
-        self._create_da_request_handlers: ty.Dict[ClientId, CreateDirectActionResponseHandler] = dict()
-        self._set_algo_status_request_handlers: ty.Dict[ClientId, SetAlgoStatusResponseHandler] = dict()
-        self._terminate_algo_request_handlers: ty.Dict[ClientId, TerminateAlgoResponseHandler] = dict()
-        self.session.add_sub_session_handler(sub_protocol_type=self._sub_proto_type, handler=self.on_algo_response)
-
-    def _send_request(self, algo_request: algo_pb.Request):
+        self.session.set_correlated_response_handler(sub_protocol_type=self._sub_proto_type, response_type=algo_pb.RESP_CREATE_DIRECT_ACTION,
+                                                     handler=self.on_create_direct_action_response)
+        self.session.set_correlated_response_handler(sub_protocol_type=self._sub_proto_type, response_type=algo_pb.RESP_SET_ALGO_STATUS,
+                                                     handler=self.on_algo_name_response)
+        self.session.set_correlated_response_handler(sub_protocol_type=self._sub_proto_type, response_type=algo_pb.RESP_TERMINATE_ALGO,
+                                                     handler=self.on_algo_name_response)
+
+    def _new_request(self) -> ty.Tuple[act_pb.Request, algo_pb.Request]:
+        """ A request and its algoRequest, to be filled in place """
         request = act_pb.Request()
         request.subProtocolType = self._sub_proto_type
-        request.algoRequest.CopyFrom(algo_request)
-        self.session.send_request(request=request)
-
-    def create_direct_action(self, direct_action: DirectActionData, callback: CreateDirectActionResponseHandler) -> ClientId:
-        client_id = ++self._client_id
-        self._create_da_request_handlers[client_id] = callback
+        return request, request.algoRequest
 
-        create_direct_action_request = direct_action.to_proto()
+    def create_direct_action(self, direct_action: DirectActionData, callback: CreateDirectActionResponseHandler,
+                             timeout: ty.Optional[float] = None) -> ClientId:
+        client_id = self.session.requests.add(sub_protocol_type=self._sub_proto_type, handler=callback,
+                                              on_fail=lambda failed_client_id, err_msg: callback(failed_client_id, err_msg, None, None), timeout=timeout,
+                                              request_type=algo_pb.REQ_CREATE_DIRECT_ACTION).client_id
 
-        algo_request = algo_pb.Request()
+        request, algo_request = self._new_request()
         algo_request.requestType = algo_pb.RequestType.REQ_CREATE_DIRECT_ACTION
         algo_request.clientId = client_id
-        algo_request.createDirectActionRequest.CopyFrom(create_direct_action_request)
+        direct_action.fill_proto(algo_request.createDirectActionRequest)
 
         self._logger.info(f'Sending create direct action request')
-        self._send_request(algo_request=algo_request)
+        self.session.send_request(request=request)
         return client_id
 
-    def set_algo_status(self, algo_name: str, status: AlgoControlStatus, callback: SetAlgoStatusResponseHandler) -> ClientId:
-        client_id = ++self._client_id
-        self._set_algo_status_request_handlers[client_id] = callback
+    def set_algo_status(self, algo_name: str, status: AlgoControlStatus, callback: SetAlgoStatusResponseHandler, timeout: ty.Optional[float] = None) -> ClientId:
+        client_id = self.session.requests.add(sub_protocol_type=self._sub_proto_type, handler=callback,
+                                              on_fail=lambda failed_client_id, err_msg: callback(failed_client_id, err_msg, algo_name), timeout=timeout,
+                                              request_type=algo_pb.REQ_SET_ALGO_STATUS).client_id
 
-        algo_request = algo_pb.Request()
+        request, algo_request = self._new_request()
         algo_request.requestType = algo_pb.RequestType.REQ_SET_ALGO_STATUS
         algo_request.clientId = client_id
         algo_request.algoName = algo_name
         algo_request.controlStatus = status.to_proto()
 
         self._logger.info(f'Sending set algo status request')
-        self._send_request(algo_request=algo_request)
+        self.session.send_request(request=request)
         return client_id
 
-    def terminate_algo(self, algo_name: str, callback: TerminateAlgoResponseHandler) -> ClientId:
-        client_id = ++self._client_id
-        self._terminate_algo_request_handlers[client_id] = callback
+    def terminate_algo(self, algo_name: str, callback: TerminateAlgoResponseHandler, timeout: ty.Optional[float] = None) -> ClientId:
+        client_id = self.session.requests.add(sub_protocol_type=self._sub_proto_type, handler=callback,
+                                              on_fail=lambda failed_client_id, err_msg: callback(failed_client_id, err_msg, algo_name), timeout=timeout,
+                                              request_type=algo_pb.REQ_TERMINATE_ALGO).client_id
 
-        algo_request = algo_pb.Request()
+        request, algo_request = self._new_request()
         algo_request.requestType = algo_pb.RequestType.REQ_TERMINATE_ALGO
         algo_request.clientId = client_id
         algo_request.algoName = algo_name
 
         self._logger.info(f'Sending terminate algo request')
-        self._send_request(algo_request=algo_request)
+        self.session.send_request(request=request)
         return client_id
 
-    def on_algo_response(self, response: act_pb.Response):
-        algo_response = response.algoResponse
-        if algo_response is None:
-            self._logger.error(f'Got empty algo sub-protocol response')
-            return
-
-        response_type = algo_response.responseType
-        # self._logger.info(f'Got algo response: {response_type}')
-        if response_type == algo_pb.RESP_CREATE_DIRECT_ACTION:
-            if algo_response.clientId in self._create_da_request_handlers:
-                create_da_response = algo_response.createDirectActionResponse
-                action_name = None
-                automation_status = None
-                if create_da_response is not None:
-                    action_name = create_da_response.actionName
-                    automation_status = create_da_response.automationStatus
-                self._create_da_request_handlers[algo_response.clientId](algo_response.clientId, _get_error(algo_response.operationStatus), action_name, automation_status)
-                del self._create_da_request_handlers[algo_response.clientId]
-            else:
-                self._logger.error(f'No handler for create direct action response')
-        elif response_type == algo_pb.RESP_SET_ALGO_STATUS:
-            if algo_response.clientId in self._set_algo_status_request_handlers:
-                self._set_algo_status_request_handlers[algo_response.clientId](algo_response.clientId, _get_error(algo_response.operationStatus), algo_response.algoName)
-                del self._set_algo_status_request_handlers[algo_response.clientId]
-            else:
-                self._logger.error(f'No handler for set algo status response')
-        elif response_type == algo_pb.RESP_TERMINATE_ALGO:
-            if algo_response.clientId in self._terminate_algo_request_handlers:
-                self._terminate_algo_request_handlers[algo_response.clientId](algo_response.clientId, _get_error(algo_response.operationStatus), algo_response.algoName)
-                del self._terminate_algo_request_handlers[algo_response.clientId]
-            else:
-                self._logger.error(f'No handler for terminate algo response')
-        else:
-            self._logger.info(f'Unhandled algo sub-protocol response type')
-        pass
+    async def create_direct_action_async(self, direct_action: DirectActionData, timeout: ty.Optional[float] = None) -> CreateDirectActionResult:
+        await self.session.wait_rate_limit(self._sub_proto_type)
+        future = asyncio.get_running_loop().create_future()
+        client_id = self.create_direct_action(direct_action=direct_action, timeout=timeout,
+                                              callback=lambda client_id, err_msg, action_name, automation_status:
+                                              _set_future_result(future, CreateDirectActionResult(client_id, err_msg, action_name, automation_status)))
+        return await _await_response(requests=self.session.requests, sub_protocol_type=self._sub_proto_type, client_id=client_id, future=future)
+
+    async def set_algo_status_async(self, algo_name: str, status: AlgoControlStatus, timeout: ty.Optional[float] = None) -> AlgoResult:
+        future = asyncio.get_running_loop().create_future()
+        client_id = self.set_algo_status(algo_name=algo_name, status=status, timeout=timeout,
+                                         callback=lambda client_id, err_msg, name: _set_future_result(future, AlgoResult(client_id, err_msg, name)))
+        return await _await_response(requests=self.session.requests, sub_protocol_type=self._sub_proto_type, client_id=client_id, future=future)
+
+    async def terminate_algo_async(self, algo_name: str, timeout: ty.Optional[float] = None) -> AlgoResult:
+        future = asyncio.get_running_loop().create_future()
+        client_id = self.terminate_algo(algo_name=algo_name, timeout=timeout,
+                                        callback=lambda client_id, err_msg, name: _set_future_result(future, AlgoResult(client_id, err_msg, name)))
+        return await _await_response(requests=self.session.requests, sub_protocol_type=self._sub_proto_type, client_id=client_id, future=future)
+
+    def on_create_direct_action_response(self, algo_response: algo_pb.Response, pending_request: PendingRequest):
+        create_da_response = algo_response.createDirectActionResponse
+        pending_request.handler(algo_response.clientId, _get_error(algo_response.operationStatus), create_da_response.actionName, create_da_response.automationStatus)
+
+    def on_algo_name_response(self, algo_response: algo_pb.Response, pending_request: PendingRequest):
+        """ Set algo status and terminate algo responses """
+        pending_request.handler(algo_response.clientId, _get_error(algo_response.operationStatus), algo_response.algoName)
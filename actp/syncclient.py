@@ -0,0 +1,195 @@
+"""
+Blocking and concurrent.futures access to one logged on ActSession, for code that is not asyncio, e.g. notebooks and pandas jobs
+"""
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import typing as ty
+
+from . import connection
+from . import dex
+from . import reconnect
+from . import session
+from .proto import DataExchangeAPI_pb2 as dex_pb
+
+T = ty.TypeVar('T')
+
+
+class SyncActClient(object):
+    """ Runs an event loop in a daemon thread holding one logged on ActSession, shared by every thread calling in
+
+    Each request method comes as a blocking call and as a *_future variant returning a concurrent.futures.Future.
+    The event loop thread must not call the blocking methods, they would wait on the very loop that has to answer them.
+
+        with SyncActClient(ip='192.168.45.117', port=4722, user='Shared', password='...', appname='notebook') as client:
+            snapshot = client.snapshot(scope_keys=['XCME.ES.F'], fields=['bid', 'ask'])
+    """
+
+    def __init__(self, ip: str, port: int, user: str, password: str, appname: str,
+                 request_timeout: ty.Optional[float] = 30.0,
+                 reconnect_policy: ty.Optional[reconnect.ReconnectPolicy] = None):
+        """ request_timeout: default wait for logon and responses, reconnect_policy: how to reconnect if the connection drops, None not to """
+        self.ip = ip
+        self.port = port
+        self.user = user
+        self.password = password
+        self.appname = appname
+        self.request_timeout = request_timeout
+        self.reconnect_policy = reconnect_policy
+        self._logger = logging.getLogger(__name__)
+        self.loop: ty.Optional[asyncio.AbstractEventLoop] = None
+        self._thread: ty.Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self.act_session: ty.Optional[session.ActSession] = None
+        self._session_keeper: ty.Optional[reconnect.ActSessionKeeper] = None
+        self.logon_response: ty.Optional[session.LogonResponse] = None
+
+    def __enter__(self) -> 'SyncActClient':
+        logon_response = self.logon()
+        if not logon_response.Success:
+            self.close()
+            raise ConnectionError(f'Failed to log on to {self.ip}:{self.port}: {logon_response.ErrorMsg}')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def logon(self) -> session.LogonResponse:
+        """ Start the event loop thread, connect and log on. Does nothing if already logged on """
+        with self._start_lock:
+            if self._thread is None:
+                self.loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._run_loop, name=f'actp-{self.ip}:{self.port}', daemon=True)
+                self._thread.start()
+            if not self.is_logged_on():
+                self.logon_response = self._wait(self.submit(self._connect_and_logon()))
+        return self.logon_response
+
+    def close(self):
+        """ Log out, then stop and join the event loop thread """
+        with self._start_lock:
+            if self._thread is None:
+                return
+            try:
+                self._wait(self.submit(self._logout()), timeout=self.request_timeout)
+            except concurrent.futures.TimeoutError:
+                self._logger.warning(f'Timed out logging out of {self.ip}:{self.port}')
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._thread = None
+
+    def is_logged_on(self) -> bool:
+        return self.act_session is not None and self.act_session.act_connection.is_connected()
+
+    def submit(self, coro: ty.Awaitable[T]) -> 'concurrent.futures.Future[T]':
+        """ Run coro on the event loop thread, e.g. a coroutine using self.act_session directly """
+        if self._thread is None:
+            raise RuntimeError(f'Not started, call logon() first')
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def snapshot_future(self, scope_keys: ty.List[str], fields: ty.List[str],
+                        no_triggers: ty.Optional[ty.List[str]] = None, contexts: ty.Optional[ty.List[str]] = None,
+                        timeout: ty.Optional[float] = None) -> 'concurrent.futures.Future[dex.DexTableUpdate]':
+        query_data = dex.DexQueryData(scope_keys=scope_keys, fields=fields, is_snapshot=True, no_triggers=no_triggers, contexts=contexts)
+        return self.submit(self._snapshot(query_data=query_data, timeout=self._get_timeout(timeout)))
+
+    def snapshot(self, scope_keys: ty.List[str], fields: ty.List[str],
+                 no_triggers: ty.Optional[ty.List[str]] = None, contexts: ty.Optional[ty.List[str]] = None,
+                 timeout: ty.Optional[float] = None) -> dex.DexTableUpdate:
+        """ The columns and rows of a snapshot query, dex.to_csv turns them into csv. Raises dex.DexQueryError if the query fails """
+        return self._wait(self.snapshot_future(scope_keys=scope_keys, fields=fields, no_triggers=no_triggers, contexts=contexts, timeout=timeout))
+
+    def update_table_future(self, table_update: dex_pb.TableUpdate, timeout: ty.Optional[float] = None) -> 'concurrent.futures.Future[session.AckResult]':
+        return self.submit(self._call(lambda: self.act_session.dex_sub_session.update_table_async(table_update=table_update, timeout=self._get_timeout(timeout))))
+
+    def update_table(self, table_update: dex_pb.TableUpdate, timeout: ty.Optional[float] = None) -> session.AckResult:
+        return self._wait(self.update_table_future(table_update=table_update, timeout=timeout))
+
+    def send_automation_updates_future(self, product_updates: ty.List[session.ProductAutomationUpdate],
+                                       timeout: ty.Optional[float] = None) -> 'concurrent.futures.Future[session.AckResult]':
+        return self.submit(self._call(lambda: self.act_session.autocontrol_sub_session.send_automation_updates_async(
+            product_updates=product_updates, timeout=self._get_timeout(timeout))))
+
+    def send_automation_updates(self, product_updates: ty.List[session.ProductAutomationUpdate], timeout: ty.Optional[float] = None) -> session.AckResult:
+        return self._wait(self.send_automation_updates_future(product_updates=product_updates, timeout=timeout))
+
+    def create_direct_action_future(self, direct_action: session.DirectActionData,
+                                    timeout: ty.Optional[float] = None) -> 'concurrent.futures.Future[session.CreateDirectActionResult]':
+        return self.submit(self._call(lambda: self.act_session.algo_sub_session.create_direct_action_async(
+            direct_action=direct_action, timeout=self._get_timeout(timeout))))
+
+    def create_direct_action(self, direct_action: session.DirectActionData, timeout: ty.Optional[float] = None) -> session.CreateDirectActionResult:
+        return self._wait(self.create_direct_action_future(direct_action=direct_action, timeout=timeout))
+
+    def set_algo_status_future(self, algo_name: str, status: session.AlgoControlStatus,
+                               timeout: ty.Optional[float] = None) -> 'concurrent.futures.Future[session.AlgoResult]':
+        return self.submit(self._call(lambda: self.act_session.algo_sub_session.set_algo_status_async(
+            algo_name=algo_name, status=status, timeout=self._get_timeout(timeout))))
+
+    def set_algo_status(self, algo_name: str, status: session.AlgoControlStatus, timeout: ty.Optional[float] = None) -> session.AlgoResult:
+        return self._wait(self.set_algo_status_future(algo_name=algo_name, status=status, timeout=timeout))
+
+    def terminate_algo_future(self, algo_name: str, timeout: ty.Optional[float] = None) -> 'concurrent.futures.Future[session.AlgoResult]':
+        return self.submit(self._call(lambda: self.act_session.algo_sub_session.terminate_algo_async(algo_name=algo_name, timeout=self._get_timeout(timeout))))
+
+    def terminate_algo(self, algo_name: str, timeout: ty.Optional[float] = None) -> session.AlgoResult:
+        return self._wait(self.terminate_algo_future(algo_name=algo_name, timeout=timeout))
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def _get_timeout(self, timeout: ty.Optional[float]) -> ty.Optional[float]:
+        return timeout if timeout is not None else self.request_timeout
+
+    def _wait(self, future: 'concurrent.futures.Future[T]', timeout: ty.Optional[float] = None) -> T:
+        if threading.current_thread() is self._thread:
+            raise RuntimeError(f'Blocking call on the event loop thread, use the *_future methods or self.act_session there')
+        # requests time out on the loop, this only guards against the loop itself being stuck
+        return future.result(timeout=timeout)
+
+    async def _call(self, make_coro: ty.Callable[[], ty.Awaitable[T]]) -> T:
+        """ Create the request's coroutine on the loop thread, once the session is known to be there """
+        if not self.is_logged_on():
+            raise ConnectionError(f'Not logged on to {self.ip}:{self.port}')
+        return await make_coro()
+
+    async def _snapshot(self, query_data: dex.DexQueryData, timeout: ty.Optional[float]) -> dex.DexTableUpdate:
+        if not self.is_logged_on():
+            raise ConnectionError(f'Not logged on to {self.ip}:{self.port}')
+        try:
+            dex_query = await dex.run_snapshot(act_session=self.act_session, query_data=query_data, timeout=timeout)
+        except asyncio.TimeoutError:
+            raise dex.DexQueryError(f'No snapshot within {timeout}s') from None
+        return dex.DexTableUpdate(columns=dex_query.columns, rows=dex_query.rows)
+
+    async def _connect_and_logon(self) -> session.LogonResponse:
+        act_connection = connection.ActConnection(ip=self.ip, port=self.port, loop=self.loop)
+        await act_connection.connect()
+        if not act_connection.is_connected():
+            return session.LogonResponse(False, act_connection.err_msg or f'Could not connect to {act_connection}', None)
+        self.act_session = session.ActSession(act_connection=act_connection, user=self.user, password=self.password, appname=self.appname,
+                                              request_timeout=self.request_timeout)
+        try:
+            logon_response = await asyncio.wait_for(self.act_session.logon(), timeout=self.request_timeout)
+        except asyncio.TimeoutError:
+            logon_response = session.LogonResponse(False, f'No logon response from {act_connection}', None)
+        if not logon_response.Success:
+            act_connection.disconnect()
+            return logon_response
+        if self.reconnect_policy is not None:
+            self._session_keeper = reconnect.ActSessionKeeper(act_session=self.act_session, policy=self.reconnect_policy)
+            self._session_keeper.start()
+        return logon_response
+
+    async def _logout(self):
+        if self._session_keeper is not None:
+            self._session_keeper.stop()
+            self._session_keeper = None
+        if self.is_logged_on():
+            self.act_session.logout()
+            self.act_session.act_connection.disconnect()
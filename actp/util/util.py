@@ -7,7 +7,9 @@ import time
 import typing as ty
 # DO NOT IMPORT from ..act, it prevents future usage of util inside that act.* file
 
-from ..proto import Act_pb2 as act_pb
+if ty.TYPE_CHECKING:
+    # only for the annotations, so scripts running through the broker can use util without loading protobuf
+    from ..proto import Act_pb2 as act_pb
 
 
 class ClassHasEquality(object):
@@ -153,12 +155,12 @@ def add_act_connection_args(parser: argparse.ArgumentParser):
     parser.add_argument('-p', '--port', help='The Act port', default=4722, type=int)
 
 
-def log_requests(request: act_pb.Request):
+def log_requests(request: 'act_pb.Request'):
     logger = logging.getLogger(__name__)
     logger.info(f'[Request]:\n[\n{request}]')
 
 
-def log_responses(response: act_pb.Response):
+def log_responses(response: 'act_pb.Response'):
     logger = logging.getLogger(__name__)
     logger.info(f'[Response]:\n[\n{response}]')
 
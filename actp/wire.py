@@ -0,0 +1,337 @@
+"""
+Minimal protobuf wire format reading, used to look inside frames without decoding them into messages
+"""
+import dataclasses
+import typing as ty
+
+import google.protobuf.message
+from google.protobuf import descriptor as pb_descriptor
+
+from .proto import Act_pb2 as act_pb
+
+Buffer = ty.Union[bytes, bytearray, memoryview]
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LEN = 2
+WIRE_FIXED32 = 5
+
+
+class WireError(ValueError):
+    pass
+
+
+def read_varint(buffer: Buffer, pos: int) -> ty.Tuple[int, int]:
+    """ Return (value, new pos) for the varint starting at pos """
+    result = 0
+    shift = 0
+    while True:
+        try:
+            b = buffer[pos]
+        except IndexError:
+            raise WireError(f'Truncated varint at {pos}') from None
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 64:
+            raise WireError(f'Varint too long at {pos}')
+
+
+def to_int32(value: int) -> int:
+    """ Varint encoded (non zigzag) int32, negative values are sign extended to 64 bits on the wire """
+    value &= 0xffffffff
+    return value - 0x100000000 if value & 0x80000000 else value
+
+
+def to_int64(value: int) -> int:
+    return value - 0x10000000000000000 if value & 0x8000000000000000 else value
+
+
+def zigzag_decode(value: int) -> int:
+    """ sint32/sint64 """
+    return (value >> 1) ^ -(value & 1)
+
+
+def zigzag_encode(value: int) -> int:
+    """ sint32/sint64 """
+    return (value << 1) ^ (value >> 63)
+
+
+def encode_varint(value: int) -> bytes:
+    """ Negative values are sign extended to 64 bits, as for int32/int64 """
+    value &= 0xffffffffffffffff
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def skip_field(buffer: Buffer, pos: int, wire_type: int) -> int:
+    """ Return the pos after the value of a field of wire_type starting at pos """
+    if wire_type == WIRE_VARINT:
+        return read_varint(buffer, pos)[1]
+    if wire_type == WIRE_LEN:
+        length, pos = read_varint(buffer, pos)
+        return pos + length
+    if wire_type == WIRE_FIXED64:
+        return pos + 8
+    if wire_type == WIRE_FIXED32:
+        return pos + 4
+    raise WireError(f'Unsupported wire type {wire_type} at {pos}')
+
+
+def find_varint_field(buffer: Buffer, pos: int, end: int, field_number: int) -> ty.Optional[int]:
+    """ Raw value of the last occurrence of varint field_number in buffer[pos:end], None if not present """
+    value = None
+    while pos < end:
+        tag, pos = read_varint(buffer, pos)
+        wire_type = tag & 0x7
+        if tag >> 3 == field_number and wire_type == WIRE_VARINT:
+            value, pos = read_varint(buffer, pos)
+        else:
+            pos = skip_field(buffer, pos, wire_type)
+    if pos != end:
+        raise WireError(f'Field overruns message end {end}')
+    return value
+
+
+# act_pb.Response field holding each sub-protocol's response
+RESPONSE_FIELD_NAMES: ty.Dict[act_pb.SubProtocolType, str] = {
+    act_pb.SUB_PROTO_DEX: 'dexResponse',
+    act_pb.SUB_PROTO_ORDER: 'orderResponse',
+    act_pb.SUB_PROTO_ACT: 'actResponse',
+    act_pb.SUB_PROTO_AUTOCONTROL: 'autoControlResponse',
+    act_pb.SUB_PROTO_STRATEGY: 'strategyResponse',
+    act_pb.SUB_PROTO_TRADE: 'tradeResponse',
+    act_pb.SUB_PROTO_VALUATION: 'valuationResponse',
+    act_pb.SUB_PROTO_TICK: 'tickResponse',
+    act_pb.SUB_PROTO_ALGO: 'algoResponse',
+    act_pb.SUB_PROTO_INSTRUMENT: 'instrumentResponse',
+}
+
+
+# act_pb.Request field holding each sub-protocol's request
+REQUEST_FIELD_NAMES: ty.Dict[act_pb.SubProtocolType, str] = {
+    act_pb.SUB_PROTO_DEX: 'dexRequest',
+    act_pb.SUB_PROTO_ORDER: 'orderRequest',
+    act_pb.SUB_PROTO_ACT: 'actRequest',
+    act_pb.SUB_PROTO_AUTOCONTROL: 'autoControlRequest',
+    act_pb.SUB_PROTO_STRATEGY: 'strategyRequest',
+    act_pb.SUB_PROTO_TRADE: 'tradeRequest',
+    act_pb.SUB_PROTO_VALUATION: 'valuationRequest',
+    act_pb.SUB_PROTO_TICK: 'tickRequest',
+    act_pb.SUB_PROTO_ALGO: 'algoRequest',
+    act_pb.SUB_PROTO_INSTRUMENT: 'instrumentRequest',
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class _SubMessageLayout:
+    field_name: str
+    field_number: int
+    client_id_field_number: int
+    client_id_type: int
+
+
+def _get_sub_message_layouts(message_type: ty.Type[google.protobuf.message.Message], field_names: ty.Dict[act_pb.SubProtocolType, str]
+                             ) -> ty.Dict[int, _SubMessageLayout]:
+    """ Field numbers and clientId encoding per sub-protocol, taken from the generated descriptors """
+    layouts: ty.Dict[int, _SubMessageLayout] = dict()
+    for sub_protocol_type, field_name in field_names.items():
+        field = message_type.DESCRIPTOR.fields_by_name[field_name]
+        client_id_field = field.message_type.fields_by_name['clientId']
+        layouts[sub_protocol_type] = _SubMessageLayout(field_name=field_name, field_number=field.number,
+                                                       client_id_field_number=client_id_field.number, client_id_type=client_id_field.type)
+    return layouts
+
+
+_SUB_RESPONSE_LAYOUTS = _get_sub_message_layouts(message_type=act_pb.Response, field_names=RESPONSE_FIELD_NAMES)
+_SUB_REQUEST_LAYOUTS = _get_sub_message_layouts(message_type=act_pb.Request, field_names=REQUEST_FIELD_NAMES)
+_SUB_PROTOCOL_TYPE_FIELD_NUMBER = act_pb.Response.DESCRIPTOR.fields_by_name['subProtocolType'].number
+
+
+def _decode_client_id(raw: int, client_id_type: int) -> int:
+    if client_id_type == pb_descriptor.FieldDescriptor.TYPE_SINT32:
+        return zigzag_decode(raw)
+    if client_id_type == pb_descriptor.FieldDescriptor.TYPE_INT32:
+        return to_int32(raw)
+    return raw
+
+
+def _encode_client_id(client_id: int, client_id_type: int) -> int:
+    if client_id_type in (pb_descriptor.FieldDescriptor.TYPE_SINT32, pb_descriptor.FieldDescriptor.TYPE_SINT64):
+        return zigzag_encode(client_id)
+    return client_id
+
+
+def encode_request_client_id(sub_protocol_type: act_pb.SubProtocolType, client_id: int) -> bytes:
+    """ act_pb.Request bytes that set the clientId of the sub-protocol's request when appended to a serialized act_pb.Request
+
+    A message field occurring twice is merged and the last scalar wins, so a request serialized once can be sent with any clientId.
+    """
+    layout = _SUB_REQUEST_LAYOUTS[sub_protocol_type]
+    body = encode_varint(layout.client_id_field_number << 3 | WIRE_VARINT) + encode_varint(
+        _encode_client_id(client_id=client_id, client_id_type=layout.client_id_type))
+    return encode_varint(layout.field_number << 3 | WIRE_LEN) + encode_varint(len(body)) + body
+
+
+@dataclasses.dataclass
+class ResponseEnvelope:
+    """ What can be read from an act_pb.Response frame without decoding it """
+    sub_protocol_type: act_pb.SubProtocolType
+    client_id: ty.Optional[int]  # None for sub-protocols without a known response layout
+    # (start, end) of each occurrence of the sub-protocol's response field in the frame
+    body_spans: ty.List[ty.Tuple[int, int]]
+
+
+def peek_response_envelope(frame: Buffer) -> ResponseEnvelope:
+    """ Read subProtocolType and the sub-response clientId straight from the wire bytes of an act_pb.Response """
+    sub_protocol_type = act_pb.SUB_PROTO_DEX  # proto2 default
+    spans: ty.Dict[int, ty.List[ty.Tuple[int, int]]] = dict()
+    pos = 0
+    end = len(frame)
+    while pos < end:
+        tag, pos = read_varint(frame, pos)
+        field_number = tag >> 3
+        wire_type = tag & 0x7
+        if field_number == _SUB_PROTOCOL_TYPE_FIELD_NUMBER and wire_type == WIRE_VARINT:
+            raw, pos = read_varint(frame, pos)
+            sub_protocol_type = to_int32(raw)
+        elif wire_type == WIRE_LEN:
+            length, pos = read_varint(frame, pos)
+            spans.setdefault(field_number, []).append((pos, pos + length))
+            pos += length
+        else:
+            pos = skip_field(frame, pos, wire_type)
+    if pos != end:
+        raise WireError(f'Field overruns frame end {end}')
+
+    layout = _SUB_RESPONSE_LAYOUTS.get(sub_protocol_type)
+    if layout is None:
+        return ResponseEnvelope(sub_protocol_type=sub_protocol_type, client_id=None, body_spans=[])
+    body_spans = spans.get(layout.field_number, [])
+    client_id = 0  # proto2 default, as reading clientId off the decoded message would give
+    for start, stop in body_spans:
+        raw = find_varint_field(frame, start, stop, layout.client_id_field_number)
+        if raw is not None:
+            client_id = _decode_client_id(raw=raw, client_id_type=layout.client_id_type)
+    return ResponseEnvelope(sub_protocol_type=sub_protocol_type, client_id=client_id, body_spans=body_spans)
+
+
+def parse_response_body(frame: memoryview, envelope: ResponseEnvelope) -> act_pb.Response:
+    """ Build an act_pb.Response decoding only the sub-protocol's own response field """
+    response = act_pb.Response()
+    layout = _SUB_RESPONSE_LAYOUTS.get(envelope.sub_protocol_type)
+    if layout is None:
+        response.ParseFromString(frame)
+        return response
+    response.subProtocolType = envelope.sub_protocol_type
+    sub_response = getattr(response, layout.field_name)
+    for start, stop in envelope.body_spans:
+        with frame[start:stop] as body:
+            sub_response.MergeFromString(body)
+    return response
+
+
+def merge_in_slices(message: google.protobuf.message.Message, buffer: Buffer, start: int, end: int, max_slice_bytes: int) -> ty.Iterator[int]:
+    """ MergeFromString buffer[start:end] into message a slice at a time, yielding the bytes merged after each slice
+
+    Slices are runs of whole fields. A field bigger than max_slice_bytes that holds a message is merged by recursing into it,
+    so one huge TableUpdate becomes many small merges. The result is the same as a single MergeFromString.
+    """
+    fields_by_number = message.DESCRIPTOR.fields_by_number
+    run_start = start
+    pos = start
+    while pos < end:
+        field_start = pos
+        tag, pos = read_varint(buffer, pos)
+        wire_type = tag & 0x7
+        if wire_type != WIRE_LEN:
+            pos = skip_field(buffer, pos, wire_type)
+            continue
+        length, body_start = read_varint(buffer, pos)
+        pos = body_start + length
+        field = fields_by_number.get(tag >> 3)
+        if length <= max_slice_bytes or field is None or field.message_type is None or field.message_type.GetOptions().map_entry:
+            if pos - run_start >= max_slice_bytes:
+                with memoryview(buffer)[run_start:pos] as run:
+                    message.MergeFromString(run)
+                yield pos - run_start
+                run_start = pos
+            continue
+        if field_start > run_start:
+            with memoryview(buffer)[run_start:field_start] as run:
+                message.MergeFromString(run)
+            yield field_start - run_start
+        if field.label == pb_descriptor.FieldDescriptor.LABEL_REPEATED:
+            sub_message = getattr(message, field.name).add()
+        else:
+            sub_message = getattr(message, field.name)
+        yield from merge_in_slices(message=sub_message, buffer=buffer, start=body_start, end=pos, max_slice_bytes=max_slice_bytes)
+        run_start = pos
+    if pos != end:
+        raise WireError(f'Field overruns message end {end}')
+    if end > run_start:
+        with memoryview(buffer)[run_start:end] as run:
+            message.MergeFromString(run)
+        yield end - run_start
+
+
+@dataclasses.dataclass
+class DexResponseEnvelope:
+    """ The small fields of a DataExchangeAPI.Response and where its tableUpdate is """
+    response_type: int
+    error_message: ty.Optional[str]
+    table_update_span: ty.Optional[ty.Tuple[int, int]]
+
+
+def _read_string(buffer: Buffer, start: int, end: int) -> str:
+    return str(buffer[start:end], 'utf-8')
+
+
+def peek_dex_response(buffer: Buffer, start: int, end: int) -> DexResponseEnvelope:
+    """ Read a DataExchangeAPI.Response in buffer[start:end] without decoding its tableUpdate """
+    response_type = 0
+    error_message = None
+    table_update_span = None
+    pos = start
+    while pos < end:
+        tag, pos = read_varint(buffer, pos)
+        field_number = tag >> 3
+        wire_type = tag & 0x7
+        if field_number == 1 and wire_type == WIRE_VARINT:  # responseType
+            raw, pos = read_varint(buffer, pos)
+            response_type = to_int32(raw)
+        elif field_number == 3 and wire_type == WIRE_LEN:  # operationStatus
+            length, pos = read_varint(buffer, pos)
+            error_message = _read_operation_status_error(buffer, pos, pos + length)
+            pos += length
+        elif field_number == 4 and wire_type == WIRE_LEN:  # tableUpdate
+            length, pos = read_varint(buffer, pos)
+            if table_update_span is not None:
+                raise WireError(f'Repeated tableUpdate at {pos}')  # would need merging, leave it to the protobuf parser
+            table_update_span = (pos, pos + length)
+            pos += length
+        else:
+            pos = skip_field(buffer, pos, wire_type)
+    if pos != end:
+        raise WireError(f'Field overruns message end {end}')
+    return DexResponseEnvelope(response_type=response_type, error_message=error_message or None, table_update_span=table_update_span)
+
+
+def _read_operation_status_error(buffer: Buffer, start: int, end: int) -> ty.Optional[str]:
+    error_message = None
+    pos = start
+    while pos < end:
+        tag, pos = read_varint(buffer, pos)
+        if tag == (1 << 3) | WIRE_LEN:  # errorMessage
+            length, pos = read_varint(buffer, pos)
+            error_message = _read_string(buffer, pos, pos + length)
+            pos += length
+        else:
+            pos = skip_field(buffer, pos, tag & 0x7)
+    return error_message
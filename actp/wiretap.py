@@ -0,0 +1,105 @@
+"""
+Cheap always-on capture of the frames sent and received on a connection, rendered as text only when dumped
+"""
+import collections
+import dataclasses
+import datetime
+import logging
+import time
+import typing as ty
+
+import google.protobuf.message
+
+from .proto import Act_pb2 as act_pb
+
+
+@dataclasses.dataclass
+class TappedFrame:
+    timestamp: float  # time.time() when captured
+    is_incoming: bool
+    data: bytes
+    frame_size: int  # len(data) unless the frame was truncated
+
+    def is_truncated(self) -> bool:
+        return len(self.data) < self.frame_size
+
+    def to_message(self) -> ty.Optional[ty.Union[act_pb.Request, act_pb.Response]]:
+        """ The decoded act_pb.Response or act_pb.Request, None if truncated or not decodable """
+        if self.is_truncated():
+            return None
+        message = act_pb.Response() if self.is_incoming else act_pb.Request()
+        try:
+            message.ParseFromString(self.data)
+        except google.protobuf.message.DecodeError:
+            return None
+        return message
+
+    def to_str(self) -> str:
+        time_str = datetime.datetime.fromtimestamp(self.timestamp).strftime('%H:%M:%S.%f')
+        header = f'{time_str} [{"Response" if self.is_incoming else "Request"}] {self.frame_size} bytes'
+        message = self.to_message()
+        if message is None:
+            return f'{header}, {"truncated" if self.is_truncated() else "undecodable"}: {self.data[:64].hex()}'
+        return f'{header}:\n[\n{message}]'
+
+
+class WireTap(object):
+    """ Ring buffer of the last max_frames frames seen, raw bytes with a timestamp
+
+    Capturing costs a copy of the frame, decoding and text rendering only happen in TappedFrame.to_message, format and dump.
+    With sample_every N only every Nth frame in each direction is kept, max_frame_bytes caps what is kept of big frames.
+    """
+
+    def __init__(self, max_frames: int = 10000, sample_every: int = 1, max_frame_bytes: ty.Optional[int] = None,
+                 clock: ty.Optional[ty.Callable[[], float]] = None):
+        self._frames: ty.Deque[TappedFrame] = collections.deque(maxlen=max_frames)
+        self.sample_every = max(sample_every, 1)
+        self.max_frame_bytes = max_frame_bytes
+        self._clock = clock if clock is not None else time.time
+        self._logger = logging.getLogger(__name__)
+        self.num_incoming = 0
+        self.num_outgoing = 0
+        self.num_captured = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def on_incoming(self, frame: ty.Union[bytes, memoryview]):
+        self.num_incoming += 1
+        if self.num_incoming % self.sample_every == 0:
+            self._capture(frame=frame, is_incoming=True)
+
+    def on_outgoing(self, msg_data: bytes):
+        self.num_outgoing += 1
+        if self.num_outgoing % self.sample_every == 0:
+            self._capture(frame=msg_data, is_incoming=False)
+
+    def _capture(self, frame: ty.Union[bytes, memoryview], is_incoming: bool):
+        frame_size = len(frame)
+        data = bytes(frame if self.max_frame_bytes is None or frame_size <= self.max_frame_bytes else frame[:self.max_frame_bytes])
+        self._frames.append(TappedFrame(timestamp=self._clock(), is_incoming=is_incoming, data=data, frame_size=frame_size))
+        self.num_captured += 1
+
+    def get_frames(self) -> ty.List[TappedFrame]:
+        return list(self._frames)
+
+    def clear(self):
+        self._frames.clear()
+
+    def format(self, last: ty.Optional[int] = None) -> str:
+        """ The captured frames, oldest first, as text. Only the last ones if given """
+        frames = self.get_frames()
+        if last is not None:
+            frames = frames[-last:]
+        return '\n'.join(frame.to_str() for frame in frames)
+
+    def dump(self, last: ty.Optional[int] = None, path: ty.Optional[str] = None):
+        """ Log the captured frames, or write them to path """
+        text = self.format(last=last)
+        summary = f'Wire tap: {len(self._frames)} frames kept of {self.num_captured} captured, {self.num_incoming} in, {self.num_outgoing} out, 1 in {self.sample_every} sampled'
+        if path is None:
+            self._logger.info(f'{summary}\n{text}')
+            return
+        with open(file=path, mode='w', encoding='utf-8') as out_file:
+            out_file.write(f'{summary}\n{text}\n')
+        self._logger.info(f'{summary}, written to {path}')
@@ -2,7 +2,8 @@ import asyncio
 import contextlib
 import logging
 import typing as ty
-from actp import connection, session
+from actp import brokerclient, connection, ratelimit, session
+from actp.proto import Act_pb2 as act_pb
 from actp.util import util
 
 logger = logging.getLogger(__name__)
@@ -12,8 +13,17 @@ async def run_all_direct_actions(
     port: int,
     user: str,
     password: str,
-    da_list: list[session.DirectActionData]
+    da_list: list[session.DirectActionData],
+    timeout: ty.Optional[float] = 30.0,
+    broker_socket_path: ty.Optional[str] = None,
+    rate_limit: ty.Optional[ratelimit.RateLimit] = None,
 ):
+    """ rate_limit paces the create direct action requests, e.g. ratelimit.RateLimit(rate=20, aimd=ratelimit.AimdPolicy()) """
+    if broker_socket_path is not None:
+        await run_all_direct_actions_through_broker(brokerclient.ActAddress(ip=ip, port=port, user=user, password=password),
+                                                    da_list, broker_socket_path, timeout)
+        return
+
     loop = asyncio.get_running_loop()
     loop.set_exception_handler(handler=util.handle_asyncio_exceptions)
 
@@ -25,11 +35,17 @@ async def run_all_direct_actions(
             logger.error("❌ Could not connect to server.")
             return
 
+        rate_limiter = None
+        if rate_limit is not None:
+            rate_limiter = ratelimit.RequestRateLimiter()
+            rate_limiter.set_limit(sub_protocol_type=act_pb.SUB_PROTO_ALGO, rate_limit=rate_limit)
+
         act_session = session.ActSession(
             act_connection=act_connection,
             user=user,
             password=password,
             appname="DA Runner",
+            rate_limiter=rate_limiter,
         )
 
         logon_result: session.LogonResponse = await act_session.logon()
@@ -39,28 +55,20 @@ async def run_all_direct_actions(
 
         logger.info("✅ Logged in successfully.")
 
+        # each request has its own client id, so send them all and wait for the acks together
         for da_data in da_list:
             logger.info(f"🚀 Sending Direct Action request for: {da_data.base_instrument}")
-            done_event = asyncio.Event()
-
-            def on_create_da_callback(
-                client_id: session.ClientId,
-                err_msg: session.ErrMsg,
-                name: ty.Optional[session.DirectActionName],
-                status: ty.Optional[session.AutomationStatus]
-            ):
-                if err_msg:
-                    logger.error(f"❌ Failed to create direct action: {err_msg}")
-                else:
-                    logger.info(f"✅ Created Direct Action '{name}' with status '{status}'")
-                done_event.set()
-
-            act_session.algo_sub_session.create_direct_action(
-                direct_action=da_data,
-                callback=on_create_da_callback
-            )
-
-            await done_event.wait()
+        results = await asyncio.gather(*[
+            act_session.algo_sub_session.create_direct_action_async(direct_action=da_data, timeout=timeout)
+            for da_data in da_list
+        ])
+        for result in results:
+            if not result.is_ok():
+                logger.error(f"❌ Failed to create direct action: {result.err_msg}")
+            else:
+                logger.info(f"✅ Created Direct Action '{result.action_name}' with status '{result.automation_status}'")
+        if rate_limiter is not None:
+            logger.info(f"Rate limiting: {rate_limiter.format_stats()}")
 
         act_connection.disconnect()
         await act_connection.wait_on_disconnect()
@@ -74,3 +82,37 @@ async def run_all_direct_actions(
                 task.cancel()
                 with contextlib.suppress(asyncio.CancelledError):
                     await task
+
+
+async def _create_direct_action_through_broker(act_address: brokerclient.ActAddress, da_data: session.DirectActionData,
+                                               broker_socket_path: str, timeout: ty.Optional[float]):
+    async with brokerclient.BrokerClient(act_address=act_address, socket_path=broker_socket_path) as client:
+        return await client.create_direct_action(
+            name=da_data.name,
+            base_instrument=da_data.base_instrument,
+            additional_instruments={ai.name: ai.instrument for ai in da_data.additional_instruments or []},
+            input_parameters={prop.name: prop.value for prop in da_data.input_parameters or []},
+            action_status=da_data.action_status,
+            timeout=timeout,
+        )
+
+
+async def run_all_direct_actions_through_broker(
+    act_address: brokerclient.ActAddress,
+    da_list: list[session.DirectActionData],
+    broker_socket_path: str,
+    timeout: ty.Optional[float] = 30.0
+):
+    # one broker connection per request, so the broker runs them concurrently on its warm session
+    for da_data in da_list:
+        logger.info(f"🚀 Sending Direct Action request for: {da_data.base_instrument} through the broker")
+    results = await asyncio.gather(*[
+        _create_direct_action_through_broker(act_address, da_data, broker_socket_path, timeout)
+        for da_data in da_list
+    ], return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"❌ Failed to create direct action: {result}")
+        else:
+            action_name, automation_status = result
+            logger.info(f"✅ Created Direct Action '{action_name}' with status '{automation_status}'")
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import os
+import sys
+
+from actp import broker
+from actp import brokerclient
+from actp.util import logutil
+from actp.util import util
+
+logger = logging.getLogger(__name__)
+script_name = os.path.basename(sys.argv[0])
+
+SAMPLE_USAGE = {
+    r'Run the broker on the default socket, then route scripts through it with --broker':
+        [
+            f"{script_name}",
+            f"dex_query.py --broker --scope_keys XCME.ES.F --fields bid,ask --snapshot --ip 192.168.45.117 --user Shared --password ' ",
+        ],
+    r'Stop a running broker':
+        [
+            f"{script_name} --shutdown",
+        ],
+}
+
+
+async def run(socket_path: str, default_timeout: float):
+    loop = asyncio.get_running_loop()
+    loop.set_exception_handler(handler=util.handle_asyncio_exceptions)
+
+    act_broker = broker.ActSessionBroker(loop=loop, socket_path=socket_path, appname=script_name, default_timeout=default_timeout)
+    try:
+        await act_broker.start()
+        await act_broker.wait_stopped()
+        logger.info(f'Broker stopped after {act_broker.num_commands} commands, {act_broker.num_failed_commands} failed')
+    except brokerclient.BrokerError as exc:
+        logger.error(f'Could not start the broker: {exc}')
+    finally:
+        act_broker.stop()
+        await util.cancel_pending_asyncio_tasks()
+
+
+async def shutdown(socket_path: str):
+    async with brokerclient.BrokerClient(act_address=brokerclient.ActAddress(ip='', port=0, user='', password=''), socket_path=socket_path) as client:
+        await client.shutdown()
+    logger.info(f'Broker on {socket_path} shut down')
+
+
+def main():
+    parser = util.get_arg_parser(desc="Keep logged on Act sessions warm for scripts run with --broker", examples=SAMPLE_USAGE)
+    parser.add_argument('-sock', '--socket_path', help='The Unix domain socket to listen on', default=brokerclient.DEFAULT_SOCKET_PATH)
+    parser.add_argument('-t', '--timeout', help='Seconds to wait for logons and responses, unless a command says otherwise', default=30.0, type=float)
+    parser.add_argument('-sd', '--shutdown', help='Stop the broker running on socket_path', action='store_true')
+    parser.add_argument('-ll', '--loglevel', help='Level at which to log (DEBUG, INFO, WARNING, ERROR, CRITICAL)', required=False, default='INFO')
+    parser.set_defaults(shutdown=False)
+    args = parser.parse_args()
+    logutil.configure_simple_console_logging(log_level=args.loglevel, timed=True)
+
+    try:
+        if args.shutdown:
+            asyncio.run(shutdown(socket_path=args.socket_path))
+        else:
+            asyncio.run(run(socket_path=args.socket_path, default_timeout=args.timeout))
+    except KeyboardInterrupt:
+        logger.info(f'Exiting on Ctrl-C')
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception:
+        logger.exception('Caught exception in main()')
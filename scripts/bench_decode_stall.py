@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import os
+import struct
+import sys
+import time
+import typing as ty
+
+from actp import connection
+from actp.proto import Act_pb2 as act_pb
+from actp.proto import DataExchangeAPI_pb2 as dex_pb
+from actp.util import logutil
+from actp.util import util
+
+logger = logging.getLogger(__name__)
+script_name = os.path.basename(sys.argv[0])
+
+SAMPLE_USAGE = {
+    r'Measure event loop stall while decoding a 50k row x 20 column table update, followed by 100 small acks':
+        [
+            f"{script_name} --rows 50000 --columns 20 --acks 100",
+        ]
+}
+
+
+def make_frame(response: act_pb.Response) -> bytes:
+    msg_data = response.SerializeToString()
+    return struct.pack('<L', len(msg_data)) + msg_data
+
+
+def make_table_update_frame(num_rows: int, num_columns: int) -> bytes:
+    response = act_pb.Response()
+    response.subProtocolType = act_pb.SUB_PROTO_DEX
+    response.dexResponse.responseType = dex_pb.UPDATE_TABLE
+    table_update = response.dexResponse.tableUpdate
+    for column_index in range(num_columns):
+        table_update.columnDescriptor.add(name=f'FIELD{column_index}', type=dex_pb.VAR_PRICE)
+    for row_index in range(num_rows):
+        row = table_update.row.add()
+        row.key = f'XCME.ES.{row_index}'
+        for column_index in range(num_columns):
+            cell = row.cell.add()
+            cell.columnNumber = column_index
+            cell.value.varPrice = row_index * column_index
+    return make_frame(response=response)
+
+
+def make_ack_frame(client_id: int) -> bytes:
+    response = act_pb.Response()
+    response.subProtocolType = act_pb.SUB_PROTO_ALGO
+    response.algoResponse.clientId = client_id
+    return make_frame(response=response)
+
+
+async def measure(data: bytes, num_responses: int, sliced_decode_threshold: ty.Optional[int]) -> ty.Tuple[float, float]:
+    """ Return (max event loop stall secs, secs until every response was delivered) """
+    loop = asyncio.get_running_loop()
+    act_connection = connection.ActConnection(ip='127.0.0.1', port=0, loop=loop, sliced_decode_threshold=sliced_decode_threshold)
+    all_delivered = loop.create_future()
+    num_delivered = 0
+
+    def on_response(response: act_pb.Response):
+        nonlocal num_delivered
+        num_delivered += 1
+        if num_delivered == num_responses:
+            all_delivered.set_result(time.perf_counter())
+
+    act_connection.set_response_handler(on_response=on_response)
+    max_stall = 0.0
+
+    async def watch_loop():
+        nonlocal max_stall
+        interval = 0.001
+        while not all_delivered.done():
+            before = time.perf_counter()
+            await asyncio.sleep(interval)
+            max_stall = max(max_stall, time.perf_counter() - before - interval)
+
+    watcher = asyncio.create_task(watch_loop())
+    await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    loop.call_soon(act_connection.data_received, data)
+    end = await all_delivered
+    await watcher
+    return max_stall, end - start
+
+
+def main():
+    parser = util.get_arg_parser(desc="Benchmark event loop stall while decoding large frames", examples=SAMPLE_USAGE)
+    parser.add_argument('-r', '--rows', help='Rows in the table update', default=50000, type=int)
+    parser.add_argument('-c', '--columns', help='Columns in the table update', default=20, type=int)
+    parser.add_argument('-a', '--acks', help='Small responses following the table update', default=100, type=int)
+    parser.add_argument('-t', '--threshold', help='Frame size from which decoding is sliced', default=64 * 1024, type=int)
+    parser.add_argument('-ll', '--loglevel', help='Level at which to log (DEBUG, INFO, WARNING, ERROR, CRITICAL)', required=False, default='INFO')
+    args = parser.parse_args()
+    logutil.configure_simple_console_logging(log_level=args.loglevel, log_severity=False)
+
+    data = make_table_update_frame(num_rows=args.rows, num_columns=args.columns)
+    logger.info(f'Table update frame: {len(data):,} bytes')
+    data += b''.join(make_ack_frame(client_id=client_id) for client_id in range(args.acks))
+    for name, threshold in [('Inline decode', None), ('Sliced decode', args.threshold)]:
+        max_stall, total = asyncio.run(measure(data=data, num_responses=1 + args.acks, sliced_decode_threshold=threshold))
+        logger.info(f'{name:>14}: max loop stall {max_stall * 1000:8.2f} ms, all responses delivered in {total * 1000:8.2f} ms')
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception:
+        logger.exception('Caught exception in main()')
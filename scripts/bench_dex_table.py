@@ -0,0 +1,157 @@
+import asyncio
+import gc
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+import typing as ty
+
+from actp import connection
+from actp import dex
+from actp import session
+from actp.proto import DataExchangeAPI_pb2 as dex_pb
+from actp.util import logutil
+from actp.util import util
+
+logger = logging.getLogger(__name__)
+script_name = os.path.basename(sys.argv[0])
+
+SAMPLE_USAGE = {
+    r'Memory held by a 50k rows x 40 fields GLOBAL query and the rate updates are applied at':
+        [
+            f"{script_name} --rows 50000 --columns 40",
+        ]
+}
+
+_COLUMN_TYPES = [dex_pb.VAR_PRICE, dex_pb.VAR_PRICE, dex_pb.VAR_DOUBLE, dex_pb.VAR_INT32, dex_pb.VAR_STRING]
+
+
+def set_value(value: dex_pb.VariantValue, col_type: dex_pb.VariantType, rnd: random.Random):
+    if col_type == dex_pb.VAR_PRICE:
+        value.varPrice = rnd.randint(0, 10 ** 10)
+    elif col_type == dex_pb.VAR_DOUBLE:
+        value.varDouble = rnd.random()
+    elif col_type == dex_pb.VAR_INT32:
+        value.varInt = rnd.randint(0, 10 ** 6)
+    else:
+        value.varString = rnd.choice(['Enabled', 'Disabled', 'Paused'])
+
+
+def make_snapshot(num_rows: int, col_types: ty.List[dex_pb.VariantType], rnd: random.Random) -> bytes:
+    table_update = dex_pb.TableUpdate()
+    for column_index, col_type in enumerate(col_types):
+        table_update.columnDescriptor.add(name=f'FIELD{column_index}', type=col_type)
+    for row_index in range(num_rows):
+        row = table_update.row.add()
+        row.key = f'XCME.ES.{row_index}'
+        for column_index, col_type in enumerate(col_types):
+            cell = row.cell.add()
+            cell.columnNumber = column_index
+            set_value(value=cell.value, col_type=col_type, rnd=rnd)
+    return table_update.SerializeToString()
+
+
+def make_updates(num_updates: int, num_rows: int, rows_per_update: int, cells_per_row: int, col_types: ty.List[dex_pb.VariantType],
+                 rnd: random.Random) -> ty.List[bytes]:
+    updates = []
+    for _ in range(num_updates):
+        table_update = dex_pb.TableUpdate()
+        for row_index in rnd.sample(range(num_rows), rows_per_update):
+            row = table_update.row.add()
+            row.key = f'XCME.ES.{row_index}'
+            for column_index in rnd.sample(range(len(col_types)), cells_per_row):
+                cell = row.cell.add()
+                cell.columnNumber = column_index
+                set_value(value=cell.value, col_type=col_types[column_index], rnd=rnd)
+        updates.append(table_update.SerializeToString())
+    return updates
+
+
+def apply(dex_query: dex.DexQuery, data: bytes, wire_decode: bool):
+    if wire_decode:
+        dex_query.on_table_update_wire(client_id=0, err_msg='', buffer=memoryview(data), start=0, end=len(data))
+        return
+    table_update = dex_pb.TableUpdate()
+    table_update.ParseFromString(data)
+    dex_query.on_table_update(client_id=0, err_msg='', update=table_update)
+
+
+def make_query(act_session: session.ActSession) -> dex.DexQuery:
+    return dex.DexQuery(query_data=dex.DexQueryData(scope_keys=['GLOBAL'], fields=['BID'], is_snapshot=False), act_session=act_session)
+
+
+def get_rss_bytes() -> int:
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def run(act_session: session.ActSession, snapshot: bytes, updates: ty.List[bytes], num_cells: int, num_update_cells: int, wire_decode: bool):
+    name = 'wire' if wire_decode else 'protobuf'
+    dex_query = make_query(act_session=act_session)
+    start = time.perf_counter()
+    apply(dex_query=dex_query, data=snapshot, wire_decode=wire_decode)
+    snapshot_secs = time.perf_counter() - start
+    logger.info(f'{name} snapshot: {snapshot_secs:.2f}s ({num_cells / snapshot_secs:,.0f} cells/sec)')
+
+    start = time.perf_counter()
+    for data in updates:
+        apply(dex_query=dex_query, data=data, wire_decode=wire_decode)
+    update_secs = time.perf_counter() - start
+    logger.info(f'{name} updates: {len(updates)} in {update_secs:.2f}s ({num_update_cells / update_secs:,.0f} cells/sec)')
+
+    start = time.perf_counter()
+    num_values = sum(1 for row in dex_query.rows for cell in row.cells if cell.value is not None)
+    logger.info(f'{name} reading every cell value through rows and cells: {time.perf_counter() - start:.2f}s for {num_values:,} values')
+    del dex_query
+
+    # again to measure memory, tracemalloc slows allocation down too much to time anything while it runs
+    gc.collect()
+    rss_before = get_rss_bytes()
+    tracemalloc.start()
+    dex_query = make_query(act_session=act_session)
+    apply(dex_query=dex_query, data=snapshot, wire_decode=wire_decode)
+    gc.collect()
+    traced_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    rss_bytes = get_rss_bytes() - rss_before
+    logger.info(f'{name} memory after the snapshot: python objects {traced_bytes / 2 ** 20:,.1f} MiB ({traced_bytes / num_cells:.0f} bytes/cell), '
+                f'rss +{rss_bytes / 2 ** 20:,.1f} MiB')
+
+
+def main():
+    parser = util.get_arg_parser(desc="Benchmark the memory and update throughput of DexQuery tables", examples=SAMPLE_USAGE)
+    parser.add_argument('-r', '--rows', help='Rows in the snapshot', default=50000, type=int)
+    parser.add_argument('-c', '--columns', help='Columns in the snapshot, a mix of price, double, int and string', default=40, type=int)
+    parser.add_argument('-u', '--updates', help='Updates applied after the snapshot', default=200, type=int)
+    parser.add_argument('-ur', '--update_rows', help='Rows per update', default=500, type=int)
+    parser.add_argument('-uc', '--update_cells', help='Cells per updated row', default=4, type=int)
+    parser.add_argument('-w', '--wire_decode', help='Only time the wire decoder, not protobuf', action='store_true')
+    parser.add_argument('-ll', '--loglevel', help='Level at which to log (DEBUG, INFO, WARNING, ERROR, CRITICAL)', required=False, default='INFO')
+    parser.set_defaults(wire_decode=False)
+    args = parser.parse_args()
+    logutil.configure_simple_console_logging(log_level=args.loglevel, log_severity=False)
+
+    rnd = random.Random(1)
+    col_types = [_COLUMN_TYPES[column_index % len(_COLUMN_TYPES)] for column_index in range(args.columns)]
+    snapshot = make_snapshot(num_rows=args.rows, col_types=col_types, rnd=rnd)
+    updates = make_updates(num_updates=args.updates, num_rows=args.rows, rows_per_update=min(args.update_rows, args.rows),
+                           cells_per_row=min(args.update_cells, args.columns), col_types=col_types, rnd=rnd)
+    num_update_cells = args.updates * min(args.update_rows, args.rows) * min(args.update_cells, args.columns)
+
+    loop = asyncio.new_event_loop()
+    act_session = session.ActSession(act_connection=connection.ActConnection(ip='127.0.0.1', port=0, loop=loop), user='', password='', appname=script_name)
+    try:
+        for wire_decode in ([True] if args.wire_decode else [True, False]):
+            run(act_session=act_session, snapshot=snapshot, updates=updates, num_cells=args.rows * args.columns, num_update_cells=num_update_cells,
+                wire_decode=wire_decode)
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception:
+        logger.exception('Caught exception in main()')
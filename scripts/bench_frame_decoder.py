@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import os
+import struct
+import sys
+import time
+import typing as ty
+
+from actp import connection
+from actp.proto import Act_pb2 as act_pb
+from actp.proto import DataExchangeAPI_pb2 as dex_pb
+from actp.util import logutil
+from actp.util import util
+
+logger = logging.getLogger(__name__)
+script_name = os.path.basename(sys.argv[0])
+
+SAMPLE_USAGE = {
+    r'Measure incoming frame decode throughput for bursts of 100, 1000 and 10000 frames':
+        [
+            f"{script_name} --burst_sizes 100,1000,10000",
+        ]
+}
+
+
+def make_frame(client_id: int) -> bytes:
+    response = act_pb.Response()
+    response.subProtocolType = act_pb.SUB_PROTO_DEX
+    response.dexResponse.responseType = dex_pb.UPDATE_TABLE
+    response.dexResponse.clientId = client_id
+    row = response.dexResponse.tableUpdate.row.add()
+    row.key = f'XCME.ES.F.{client_id}'
+    cell = row.cell.add()
+    cell.columnNumber = 0
+    cell.value.varPrice = 45000000000
+    msg_data = response.SerializeToString()
+    return struct.pack('<L', len(msg_data)) + msg_data
+
+
+def run_burst(loop: asyncio.AbstractEventLoop, num_frames: int, repeats: int) -> ty.Tuple[float, int]:
+    """ Feed a burst of num_frames frames in a single data_received call, return (secs per burst, frames decoded) """
+    act_connection = connection.ActConnection(ip='127.0.0.1', port=0, loop=loop)
+    num_decoded = 0
+
+    def on_response(response: act_pb.Response):
+        nonlocal num_decoded
+        num_decoded += 1
+
+    act_connection.set_response_handler(on_response=on_response)
+    burst = b''.join(make_frame(client_id=i) for i in range(num_frames))
+    start = time.perf_counter()
+    for _ in range(repeats):
+        act_connection.data_received(burst)
+    return (time.perf_counter() - start) / repeats, num_decoded
+
+
+def main():
+    parser = util.get_arg_parser(desc="Benchmark ActConnection incoming frame decoding", examples=SAMPLE_USAGE)
+    parser.add_argument('-b', '--burst_sizes', help='Comma separated number of frames per burst', default='100,1000,10000')
+    parser.add_argument('-r', '--repeats', help='Number of bursts to time per burst size', default=5, type=int)
+    parser.add_argument('-ll', '--loglevel', help='Level at which to log (DEBUG, INFO, WARNING, ERROR, CRITICAL)', required=False, default='INFO')
+    args = parser.parse_args()
+    logutil.configure_simple_console_logging(log_level=args.loglevel, log_severity=False)
+
+    loop = asyncio.new_event_loop()
+    try:
+        for burst_size in [int(burst_size) for burst_size in args.burst_sizes.split(',')]:
+            secs, num_decoded = run_burst(loop=loop, num_frames=burst_size, repeats=args.repeats)
+            logger.info(f'Frames/burst:{burst_size:>8}, Decoded:{num_decoded:>8}, Secs/burst:{secs:.6f}, Frames/sec:{burst_size / secs:,.0f}')
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception:
+        logger.exception('Caught exception in main()')
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import sys
+import time
+import typing as ty
+
+from actp import connection
+from actp import session
+from actp.proto import ActAlgo_pb2 as algo_pb
+from actp.proto import Act_pb2 as act_pb
+from actp.proto import DataExchangeAPI_pb2 as dex_pb
+from actp.util import logutil
+from actp.util import util
+
+logger = logging.getLogger(__name__)
+script_name = os.path.basename(sys.argv[0])
+
+SAMPLE_USAGE = {
+    r'Measure the CPU per request of building and sending 20000 create direct action requests and table updates of 10 rows':
+        [
+            f"{script_name} --requests 20000 --rows 10",
+        ]
+}
+
+
+class _NullTransport(object):
+    """ Takes the bytes and drops them, so only the client side cost is measured """
+
+    def write(self, data: bytes):
+        pass
+
+    def writelines(self, data: ty.List[bytes]):
+        pass
+
+    def get_write_buffer_size(self) -> int:
+        return 0
+
+
+def make_session(loop: asyncio.AbstractEventLoop) -> session.ActSession:
+    act_connection = connection.ActConnection(ip='127.0.0.1', port=0, loop=loop)
+    act_session = session.ActSession(act_connection=act_connection, user='user', password='password', appname=script_name)
+    act_connection.transport = _NullTransport()
+    return act_session
+
+
+def make_direct_action(index: int) -> session.DirectActionData:
+    return session.DirectActionData(name='Quoter', base_instrument=f'XCME.ES.{index}',
+                                    additional_instruments=[session.NamedInstrument(name='Hedge', instrument='XCME.ES.F')],
+                                    input_parameters=[session.StrProperty(name='Width', value='2'), session.StrProperty(name='Size', value='10')])
+
+
+def make_table_update(num_rows: int) -> dex_pb.TableUpdate:
+    table_update = dex_pb.TableUpdate()
+    table_update.columnDescriptor.add(name='theo', type=dex_pb.VAR_PRICE)
+    table_update.columnDescriptor.add(name='comment', type=dex_pb.VAR_STRING)
+    for row_index in range(num_rows):
+        row = table_update.row.add()
+        row.key = f'XCME.ES.{row_index}'
+        cell = row.cell.add()
+        cell.columnNumber = 0
+        cell.value.varPrice = row_index * 1000
+        cell = row.cell.add()
+        cell.columnNumber = 1
+        cell.value.varString = f'row {row_index}'
+    return table_update
+
+
+def send_direct_actions_copied(act_session: session.ActSession, direct_actions: ty.List[session.DirectActionData]):
+    """ How requests used to be built: inner messages first, then copied into their envelope """
+    session_logger = logging.getLogger(session.__name__)
+    for direct_action in direct_actions:
+        client_id = act_session.requests.add(sub_protocol_type=act_pb.SUB_PROTO_ALGO, handler=lambda *args: None, on_fail=lambda *args: None).client_id
+        create_direct_action_request = direct_action.to_proto()
+        algo_request = algo_pb.Request()
+        algo_request.requestType = algo_pb.RequestType.REQ_CREATE_DIRECT_ACTION
+        algo_request.clientId = client_id
+        algo_request.createDirectActionRequest.CopyFrom(create_direct_action_request)
+        request = act_pb.Request()
+        request.subProtocolType = act_pb.SUB_PROTO_ALGO
+        request.algoRequest.CopyFrom(algo_request)
+        session_logger.info(f'Sending create direct action request')
+        act_session.send_request(request=request)
+
+
+def send_direct_actions(act_session: session.ActSession, direct_actions: ty.List[session.DirectActionData]):
+    for direct_action in direct_actions:
+        act_session.algo_sub_session.create_direct_action(direct_action=direct_action, callback=lambda *args: None)
+
+
+def send_table_updates(act_session: session.ActSession, table_update: dex_pb.TableUpdate, num_requests: int):
+    for _ in range(num_requests):
+        act_session.dex_sub_session.update_table(table_update=table_update, ack_handler=lambda *args: None)
+
+
+def send_prepared_table_updates(act_session: session.ActSession, table_update: dex_pb.TableUpdate, num_requests: int):
+    prepared_request = act_session.dex_sub_session.prepare_table_update(table_update=table_update)
+    for _ in range(num_requests):
+        act_session.dex_sub_session.update_table_prepared(prepared_request=prepared_request, ack_handler=lambda *args: None)
+
+
+def measure(loop: asyncio.AbstractEventLoop, send: ty.Callable[[session.ActSession], None]) -> float:
+    """ Return the secs send took on a fresh session """
+    act_session = make_session(loop=loop)
+    start = time.process_time()
+    send(act_session)
+    return time.process_time() - start
+
+
+def main():
+    parser = util.get_arg_parser(desc="Benchmark building and sending requests", examples=SAMPLE_USAGE)
+    parser.add_argument('-n', '--requests', help='Number of requests per run', default=20000, type=int)
+    parser.add_argument('-r', '--rows', help='Rows in each table update', default=10, type=int)
+    parser.add_argument('-ll', '--loglevel', help='Level at which to log (DEBUG, INFO, WARNING, ERROR, CRITICAL)', required=False, default='INFO')
+    args = parser.parse_args()
+    logutil.configure_simple_console_logging(log_level=args.loglevel, log_severity=False)
+    logging.getLogger(session.__name__).setLevel(logging.WARNING)
+
+    direct_actions = [make_direct_action(index=index) for index in range(args.requests)]
+    table_update = make_table_update(num_rows=args.rows)
+    runs = [
+        ('Direct action, copied into envelope', lambda act_session: send_direct_actions_copied(act_session=act_session, direct_actions=direct_actions)),
+        ('Direct action, built in place', lambda act_session: send_direct_actions(act_session=act_session, direct_actions=direct_actions)),
+        ('Table update, serialized per request', lambda act_session: send_table_updates(act_session=act_session, table_update=table_update, num_requests=args.requests)),
+        ('Table update, prepared once', lambda act_session: send_prepared_table_updates(act_session=act_session, table_update=table_update, num_requests=args.requests)),
+    ]
+    loop = asyncio.new_event_loop()
+    try:
+        for name, send in runs:
+            secs = measure(loop=loop, send=send)
+            logger.info(f'{name:>38}: {secs / args.requests * 1e6:8.2f} us/request, {args.requests / secs:12,.0f} requests/sec')
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception:
+        logger.exception('Caught exception in main()')
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+import typing as ty
+
+from actp import connection
+from actp import dex
+from actp import session
+from actp.proto import DataExchangeAPI_pb2 as dex_pb
+from actp.util import logutil
+from actp.util import util
+
+logger = logging.getLogger(__name__)
+script_name = os.path.basename(sys.argv[0])
+
+SAMPLE_USAGE = {
+    r'Check the wire TableUpdate decoder against DataExchangeAPI_pb2 and time both on 20k rows x 20 columns':
+        [
+            f"{script_name} --rows 20000 --columns 20",
+        ]
+}
+
+_VARIANT_FIELDS = ['varInt', 'varPrice', 'varDouble', 'varString', 'varQuantity']
+
+
+def random_variant_value(rnd: random.Random, value: dex_pb.VariantValue):
+    """ No field, one field or, 1 in 10, several of them, the fields of VariantValue aren't a oneof """
+    value.SetInParent()
+    if rnd.random() < 0.1:
+        field_names = rnd.sample(_VARIANT_FIELDS, rnd.randint(2, len(_VARIANT_FIELDS)))
+    else:
+        field_names = [rnd.choice(_VARIANT_FIELDS + [None])]
+    for field_name in field_names:
+        set_random_field(rnd=rnd, value=value, field_name=field_name)
+
+
+def set_random_field(rnd: random.Random, value: dex_pb.VariantValue, field_name: ty.Optional[str]):
+    if field_name == 'varInt':
+        value.varInt = rnd.randint(-2 ** 31, 2 ** 31 - 1)
+    elif field_name == 'varPrice':
+        value.varPrice = rnd.randint(-2 ** 63, 2 ** 63 - 1)
+    elif field_name == 'varDouble':
+        value.varDouble = rnd.uniform(-1e9, 1e9)
+    elif field_name == 'varString':
+        value.varString = ''.join(rnd.choice('abcXYZ.é€ ') for _ in range(rnd.randint(0, 12)))
+    elif field_name == 'varQuantity':
+        value.varQuantity = rnd.randint(-2 ** 63, 2 ** 63 - 1)
+
+
+def make_random_table_update(rnd: random.Random, num_rows: int, num_columns: int, with_columns: bool) -> dex_pb.TableUpdate:
+    table_update = dex_pb.TableUpdate()
+    if with_columns:
+        for column_index in range(num_columns):
+            table_update.columnDescriptor.add(name=f'FIELD{column_index}', type=rnd.randint(0, 4), isVector=rnd.random() < 0.1, canWrite=rnd.random() < 0.5)
+    for row_index in range(num_rows):
+        row = table_update.row.add()
+        row.key = f'XCME.ES.{rnd.randint(0, num_rows)}'
+        if rnd.random() < 0.2:
+            row.contexts = rnd.choice(['A', 'B', 'A,B'])
+        for _ in range(rnd.randint(0, num_columns + 1)):
+            cell = row.cell.add()
+            cell.columnNumber = rnd.randint(-1, num_columns + 1)  # includes out of range columns
+            if rnd.random() < 0.8:
+                random_variant_value(rnd=rnd, value=cell.value)
+            else:
+                for _ in range(rnd.randint(0, 3)):
+                    random_variant_value(rnd=rnd, value=cell.valueVector.add())
+    return table_update
+
+
+def make_price_table_update(num_rows: int, num_columns: int) -> dex_pb.TableUpdate:
+    table_update = dex_pb.TableUpdate()
+    for column_index in range(num_columns):
+        table_update.columnDescriptor.add(name=f'FIELD{column_index}', type=dex_pb.VAR_PRICE)
+    for row_index in range(num_rows):
+        row = table_update.row.add()
+        row.key = f'XCME.ES.{row_index}'
+        for column_index in range(num_columns):
+            cell = row.cell.add()
+            cell.columnNumber = column_index
+            cell.value.varPrice = row_index * column_index * 1000
+    return table_update
+
+
+def make_query(act_session: session.ActSession) -> dex.DexQuery:
+    return dex.DexQuery(query_data=dex.DexQueryData(scope_keys=['GLOBAL'], fields=['BID'], is_snapshot=False), act_session=act_session)
+
+
+def query_contents(dex_query: dex.DexQuery) -> ty.List[ty.Any]:
+    contents: ty.List[ty.Any] = [(column.name, column.col_type, column.is_vector, column.can_write) for column in dex_query.columns]
+    for row in dex_query.rows:
+        cells = []
+        for cell in row.cells:
+            value = None if cell.value is None else [(field_name, cell.value.HasField(field_name), getattr(cell.value, field_name)) for field_name in _VARIANT_FIELDS]
+            vector = None if cell.vector is None else [dex.variant_value_to_proto(v).SerializeToString() for v in cell.vector]
+            value_str = cell.value_str() if cell.value is not None else None
+            cells.append((cell.update_count, value, vector, value_str))
+        contents.append((str(row.row_key), row.row_index, cells))
+    return contents
+
+
+def check_conformance(act_session: session.ActSession, num_updates: int, seed: int) -> bool:
+    rnd = random.Random(seed)
+    pb_query = make_query(act_session=act_session)
+    wire_query = make_query(act_session=act_session)
+    for update_index in range(num_updates):
+        table_update = make_random_table_update(rnd=rnd, num_rows=rnd.randint(0, 50), num_columns=rnd.randint(1, 8), with_columns=update_index % 5 == 0)
+        data = table_update.SerializeToString()
+        parsed = dex_pb.TableUpdate()
+        parsed.ParseFromString(data)
+        pb_query.on_table_update(client_id=0, err_msg='', update=parsed)
+        wire_query.on_table_update_wire(client_id=0, err_msg='', buffer=memoryview(data), start=0, end=len(data))
+        if query_contents(pb_query) != query_contents(wire_query):
+            logger.error(f'Mismatch after update {update_index}')
+            return False
+    return True
+
+
+def main():
+    parser = util.get_arg_parser(desc="Check and benchmark the hand-written TableUpdate wire decoder", examples=SAMPLE_USAGE)
+    parser.add_argument('-r', '--rows', help='Rows in the timed table update', default=20000, type=int)
+    parser.add_argument('-c', '--columns', help='Columns in the timed table update', default=20, type=int)
+    parser.add_argument('-u', '--updates', help='Random table updates to check conformance on', default=500, type=int)
+    parser.add_argument('-ll', '--loglevel', help='Level at which to log (DEBUG, INFO, WARNING, ERROR, CRITICAL)', required=False, default='INFO')
+    args = parser.parse_args()
+    logutil.configure_simple_console_logging(log_level=args.loglevel, log_severity=False)
+
+    loop = asyncio.new_event_loop()
+    act_session = session.ActSession(act_connection=connection.ActConnection(ip='127.0.0.1', port=0, loop=loop), user='', password='', appname=script_name)
+    try:
+        conforms = check_conformance(act_session=act_session, num_updates=args.updates, seed=1)
+        logger.info(f'Conformance with DataExchangeAPI_pb2 over {args.updates} random updates: {"OK" if conforms else "FAILED"}')
+        if not conforms:
+            sys.exit(1)
+
+        data = make_price_table_update(num_rows=args.rows, num_columns=args.columns).SerializeToString()
+        pb_query = make_query(act_session=act_session)
+        start = time.perf_counter()
+        table_update = dex_pb.TableUpdate()
+        table_update.ParseFromString(data)
+        pb_query.on_table_update(client_id=0, err_msg='', update=table_update)
+        pb_secs = time.perf_counter() - start
+
+        wire_query = make_query(act_session=act_session)
+        start = time.perf_counter()
+        wire_query.on_table_update_wire(client_id=0, err_msg='', buffer=memoryview(data), start=0, end=len(data))
+        wire_secs = time.perf_counter() - start
+        num_cells = args.rows * args.columns
+        logger.info(f'protobuf parse + on_table_update: {pb_secs:.3f}s ({num_cells / pb_secs:,.0f} cells/sec)')
+        logger.info(f'on_table_update_wire:             {wire_secs:.3f}s ({num_cells / wire_secs:,.0f} cells/sec)')
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception:
+        logger.exception('Caught exception in main()')
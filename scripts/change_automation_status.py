@@ -4,9 +4,7 @@ import os
 import sys
 import typing as ty
 
-from actp import connection
-from actp import dex
-from actp import session
+from actp import brokerclient
 from actp.util import logutil
 from actp.util import util
 
@@ -18,7 +16,11 @@ SAMPLE_USAGE = {
         [
             f'{script_name} --product XBIT.BTC.O --automation_type QUOTES --new_status Enabled',
             f'{script_name} -prod XBIT.BTC.O -auto QUOTES -status Enabled',
-        ]
+        ],
+    r'Enable quotes on XBIT.BTC.O through a running act_broker.py':
+        [
+            f'{script_name} --product XBIT.BTC.O --automation_type QUOTES --new_status Enabled --broker',
+        ],
 }
 
 
@@ -31,6 +33,11 @@ async def run(
         automation_type: str,
         new_status: str
 ):
+    # imported here, a --broker run doesn't load protobuf
+    from actp import connection
+    from actp import dex
+    from actp import session
+
     loop = asyncio.get_running_loop()
     loop.set_exception_handler(handler=util.handle_asyncio_exceptions)
 
@@ -92,18 +99,34 @@ async def run(
         await util.cancel_pending_asyncio_tasks()
 
 
+async def run_through_broker(broker_socket_path: str, act_address: brokerclient.ActAddress, product: str, automation_type: str, new_status: str):
+    try:
+        async with brokerclient.BrokerClient(act_address=act_address, socket_path=broker_socket_path) as client:
+            iid = await client.change_automation_status(product=product, automation_type=automation_type, new_status=new_status)
+    except brokerclient.BrokerError as exc:
+        logger.info(f'Error applying automation update: {exc}')
+        return
+    logger.info(f'Successfully applied automation update on product {product} with iid "{iid}"')
+
+
 def main():
     parser = util.get_arg_parser(desc="Change a product automation type's automation status", examples=SAMPLE_USAGE)
     util.add_act_connection_args(parser=parser)
     parser.add_argument('-prod', '--product', help='The product to change automation', required=True)
     parser.add_argument('-auto', '--automation_type', help='The automation type to change', required=True)
     parser.add_argument('-status', '--new_status', help='The automation status to set', required=True)
+    brokerclient.add_broker_args(parser=parser)
     parser.add_argument('-ll', '--loglevel', help='Level at which to log (DEBUG, INFO, WARNING, ERROR, CRITICAL)', required=False, default='INFO')
     args = parser.parse_args()
     logutil.configure_simple_console_logging(log_level=args.loglevel)
 
     try:
         with util.LogCompletionTiming(logger_func=logger.info):
+            if args.broker is not None:
+                asyncio.run(run_through_broker(broker_socket_path=args.broker,
+                                               act_address=brokerclient.ActAddress(ip=args.ip, port=args.port, user=args.user, password=args.password),
+                                               product=args.product, automation_type=args.automation_type, new_status=args.new_status))
+                return
             asyncio.run(run(user=args.user, password=args.password, ip=args.ip, port=args.port,
                             product=args.product, automation_type=args.automation_type, new_status=args.new_status))
     except KeyboardInterrupt:
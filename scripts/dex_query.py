@@ -4,9 +4,7 @@ import os
 import sys
 import typing as ty
 
-from actp import connection
-from actp import dex
-from actp import session
+from actp import brokerclient
 from actp.util import logutil
 from actp.util import util
 
@@ -18,6 +16,14 @@ SAMPLE_USAGE = {
         [
             f"{script_name}  --scope_keys XCME.ES.F --fields bid,ask --snapshot --ip 192.168.45.117 --user Shared --password ' ",
         ],
+    r'Get BID,ASK snapshot on XCME.ES.F through a running act_broker.py, without connecting and logging on first':
+        [
+            f"{script_name}  --scope_keys XCME.ES.F --fields bid,ask --snapshot --broker --ip 192.168.45.117 --user Shared --password ' ",
+        ],
+    r'Stream BID,ASK on XCME.ES.F, reconnecting and restarting the query if Actant restarts':
+        [
+            f"{script_name}  --scope_keys XCME.ES.F --fields bid,ask --reconnect --ip 192.168.45.117 --user Shared --password ' ",
+        ],
     r'Get XBIT.BTC.O PEs into a csv file (to update and write back using dex_table_update.py)':
         [
             f"{script_name} --scope_keys XBIT.BTC.O --fields pe1,pe2,pe3 --snapshot --output_csv_path C:\dev\BTC_PEs.csv --user Shared --password ' --ip 192.168.45.117 --port 4724",
@@ -49,7 +55,14 @@ async def run(
         no_triggers: ty.Optional[ty.List[str]] = None,
         contexts: ty.Optional[ty.List[str]] = None,
         output_csv_path: ty.Optional[str] = None,
+        auto_reconnect: bool = False,
 ):
+    # imported here, a --broker run doesn't load protobuf
+    from actp import connection
+    from actp import dex
+    from actp import reconnect
+    from actp import session
+
     loop = asyncio.get_running_loop()
     loop.set_exception_handler(handler=util.handle_asyncio_exceptions)
 
@@ -101,13 +114,42 @@ async def run(
         dex_query.add_handlers(state_change_handler=on_query_state_change, columns_received_handler=on_columns_received, update_handler=on_update)
         dex_query.start()
 
-        await act_connection.wait_on_disconnect()
+        if auto_reconnect and not is_snapshot:
+            session_keeper = reconnect.ActSessionKeeper(act_session=act_session)
+            session_keeper.add_query(dex_query=dex_query)
+            session_keeper.start()
+            await session_keeper.wait_stopped()
+        else:
+            await act_connection.wait_on_disconnect()
     finally:
         if act_connection is not None:
             act_connection.disconnect()
         await util.cancel_pending_asyncio_tasks()
 
 
+async def run_through_broker(
+        broker_socket_path: str,
+        act_address: brokerclient.ActAddress,
+        scope_keys: ty.List[str],
+        fields: ty.List[str],
+        no_triggers: ty.Optional[ty.List[str]] = None,
+        contexts: ty.Optional[ty.List[str]] = None,
+        output_csv_path: ty.Optional[str] = None,
+):
+    try:
+        async with brokerclient.BrokerClient(act_address=act_address, socket_path=broker_socket_path) as client:
+            csv = await client.snapshot(scope_keys=scope_keys, fields=fields, no_triggers=no_triggers, contexts=contexts)
+    except brokerclient.BrokerError as exc:
+        logger.error(f'Snapshot failed: {exc}')
+        return
+    if output_csv_path is None:
+        logger.info(f'Snapshot:\n{csv}')
+        return
+    with open(file=output_csv_path, mode='w', newline='', encoding='utf-8') as out_csv_file:
+        out_csv_file.write(csv)
+    logger.info(f'Snapshot written to {output_csv_path}')
+
+
 def main():
     parser = util.get_arg_parser(desc="Run a DEX query", examples=SAMPLE_USAGE)
     util.add_act_connection_args(parser=parser)
@@ -117,10 +159,14 @@ def main():
     parser.add_argument('-c', '--context', help='Context for the query')
     parser.add_argument('-sn', '--snapshot', help='Is snapshot query', action='store_true')
     parser.add_argument('-fr', '--frequency', help='Frequency for non-snapshot queries', default=1000, type=int)
+    parser.add_argument('-rc', '--reconnect', help='Reconnect and restart a non-snapshot query when the connection drops', action='store_true')
     parser.add_argument('-out_csv', '--output_csv_path', help='Path to csv file to create or overwrite with dex query output')
+    brokerclient.add_broker_args(parser=parser)
     parser.add_argument('-ll', '--loglevel', help='Level at which to log (DEBUG, INFO, WARNING, ERROR, CRITICAL)', required=False, default='INFO')
-    parser.set_defaults(snapshot=False)
+    parser.set_defaults(snapshot=False, reconnect=False)
     args = parser.parse_args()
+    if args.broker is not None and not args.snapshot:
+        parser.error('--broker only runs snapshot queries')
     logutil.configure_simple_console_logging(log_level=args.loglevel, timed=True)
 
     scope_keys = args.scope_keys.split(',')
@@ -133,13 +179,23 @@ def main():
     if args.context is not None:
         context = args.context.split(',')
     try:
+        if args.broker is not None:
+            asyncio.run(run_through_broker(
+                broker_socket_path=args.broker,
+                act_address=brokerclient.ActAddress(ip=args.ip, port=args.port, user=args.user, password=args.password),
+                scope_keys=scope_keys, fields=fields,
+                no_triggers=non_triggering_fields, contexts=context,
+                output_csv_path=args.output_csv_path,
+            ))
+            return
         asyncio.run(run(
             ip=args.ip, port=args.port,
             user=args.user, password=args.password,
             scope_keys=scope_keys, fields=fields,
             frequency=args.frequency, is_snapshot=args.snapshot,
             no_triggers=non_triggering_fields, contexts=context,
-            output_csv_path=args.output_csv_path
+            output_csv_path=args.output_csv_path,
+            auto_reconnect=args.reconnect,
         ))
     except KeyboardInterrupt:
         logger.info(f'Exiting on Ctrl-C')
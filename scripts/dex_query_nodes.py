@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import os
+import sys
+import time
+import typing as ty
+
+from actp import dex
+from actp import multinode
+from actp.util import logutil
+from actp.util import util
+
+logger = logging.getLogger(__name__)
+script_name = os.path.basename(sys.argv[0])
+
+SAMPLE_USAGE = {
+    r'Get running algos on two nodes into one csv file, with a Node column':
+        [
+            f"{script_name} --nodes 192.168.45.117:4722,192.168.45.118:4722 --scope_keys GLOBAL --fields action.name,action.instrument,action.status --snapshot --output_csv_path C:\dev\algos.csv --user Shared --password ' ",
+        ],
+    r'Stream BID,ASK on XCME.ES.F from two nodes':
+        [
+            f"{script_name} --nodes 192.168.45.117,192.168.45.118 --scope_keys XCME.ES.F --fields bid,ask --user Shared --password ' ",
+        ],
+}
+
+
+async def run(
+        nodes: ty.List[multinode.ActNodeAddress],
+        user: str,
+        password: str,
+        scope_keys: ty.List[str],
+        fields: ty.List[str],
+        frequency: int,
+        is_snapshot: bool,
+        output_csv_path: ty.Optional[str] = None,
+):
+    loop = asyncio.get_running_loop()
+    loop.set_exception_handler(handler=util.handle_asyncio_exceptions)
+
+    client = multinode.MultiNodeClient(addresses=nodes, loop=loop, user=user, password=password, appname=script_name)
+    try:
+        start = time.perf_counter()
+        await client.logon()
+        logger.info(f'Logged on to {len(client.node_sessions)} of {len(nodes)} nodes in {time.perf_counter() - start:.3f}s')
+        if not client.node_sessions:
+            logger.info(f'Failed to log on to any node')
+            return
+
+        def on_update(mq: multinode.MultiNodeQuery, node: multinode.NodeName, update_count: int,
+                      new_rows: multinode.NodeRows, new_updated_rows: multinode.NodeRows):
+            logger.info(f'Query update from {node}. UpdateCount:{update_count}, NumRows:{len(mq.rows)}, NumNewRows:{len(new_rows)}, NumNewUpdatedRows: {len(new_updated_rows)}')
+            if is_snapshot:
+                return
+            for node_row in new_updated_rows:
+                updated_values = [f'{cell.column.name}:{cell.value_str()}' for cell in node_row.row.get_updated_cells(update_count=update_count)]
+                logger.info(f'[{node}][{node_row.row}]: {", ".join(updated_values)}')
+
+        query_data = dex.DexQueryData(scope_keys=scope_keys, fields=fields, frequency=frequency, is_snapshot=is_snapshot)
+        multi_node_query = client.create_query(query_data=query_data)
+        multi_node_query.add_handlers(update_handler=on_update)
+        start = time.perf_counter()
+        multi_node_query.start()
+        await multi_node_query.wait_all_updated()
+        logger.info(f'First update from all nodes in {time.perf_counter() - start:.3f}s')
+
+        if output_csv_path is not None:
+            with open(file=output_csv_path, mode='w', newline='', encoding='utf-8') as out_csv_file:
+                out_csv_file.write(multi_node_query.as_csv())
+        if is_snapshot:
+            client.logout()
+            return
+        await client.wait_on_disconnect()
+    finally:
+        client.logout()
+        await util.cancel_pending_asyncio_tasks()
+
+
+def main():
+    parser = util.get_arg_parser(desc="Run a DEX query on several Actant nodes", examples=SAMPLE_USAGE)
+    parser.add_argument('-user', '--user', help='The user', required=True)
+    parser.add_argument('-pass', '--password', help='The password', required=True)
+    parser.add_argument('-n', '--nodes', help='Comma separated Act addresses, ip:port or ip', required=True)
+    parser.add_argument('-p', '--port', help='The Act port for addresses without one', default=4722, type=int)
+    parser.add_argument('-s', '--scope_keys', help='The DEX scope keys', required=True)
+    parser.add_argument('-f', '--fields', help='The DEX fields', required=True)
+    parser.add_argument('-sn', '--snapshot', help='Is snapshot query', action='store_true')
+    parser.add_argument('-fr', '--frequency', help='Frequency for non-snapshot queries', default=1000, type=int)
+    parser.add_argument('-out_csv', '--output_csv_path', help='Path to csv file to create or overwrite with the merged first update of all nodes')
+    parser.add_argument('-ll', '--loglevel', help='Level at which to log (DEBUG, INFO, WARNING, ERROR, CRITICAL)', required=False, default='INFO')
+    parser.set_defaults(snapshot=False)
+    args = parser.parse_args()
+    logutil.configure_simple_console_logging(log_level=args.loglevel, timed=True)
+
+    try:
+        asyncio.run(run(
+            nodes=multinode.parse_node_addresses(addresses=args.nodes, default_port=args.port),
+            user=args.user, password=args.password,
+            scope_keys=args.scope_keys.split(','), fields=args.fields.split(','),
+            frequency=args.frequency, is_snapshot=args.snapshot,
+            output_csv_path=args.output_csv_path,
+        ))
+    except KeyboardInterrupt:
+        logger.info(f'Exiting on Ctrl-C')
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception:
+        logger.exception('Caught exception in main()')
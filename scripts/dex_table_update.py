@@ -4,9 +4,7 @@ import os
 import sys
 import typing as ty
 
-from actp import connection
-from actp import dex
-from actp import session
+from actp import brokerclient
 from actp.util import logutil
 from actp.util import util
 
@@ -17,7 +15,11 @@ SAMPLE_USAGE = {
     r'Push updated PEs from csv file into Actant (See dex_query.py help for how to generate the csv file)':
         [
             fr"{script_name}  --user Shared --password ' --input_csv_path C:\dev\BTC_PEs.csv",
-        ]
+        ],
+    r'The same through a running act_broker.py':
+        [
+            fr"{script_name}  --user Shared --password ' --input_csv_path /data/BTC_PEs.csv --broker",
+        ],
 }
 
 
@@ -27,7 +29,13 @@ async def run(
         user: str,
         password: str,
         input_csv_path: ty.Optional[str] = None,
+        timeout: ty.Optional[float] = None,
 ):
+    # imported here, a --broker run doesn't load protobuf
+    from actp import connection
+    from actp import dex
+    from actp import session
+
     loop = asyncio.get_running_loop()
     loop.set_exception_handler(handler=util.handle_asyncio_exceptions)
 
@@ -48,44 +56,64 @@ async def run(
         if input_csv_path is None:
             logger.error(f'Nothing to do, exiting')
             act_session.logout()
-
-        def on_table_update_response(client_id: int, err_msg: str):
-            if err_msg is None or len(err_msg) == 0:
-                logger.info(f'Table update applied successfully')
-            else:
-                logger.info(f'Error applying table update: {err_msg}')
-            act_session.logout()
+            return
 
         with open(file=input_csv_path, mode='r', newline='', encoding='utf-8') as inp_csv_file:
             input_csv = inp_csv_file.read()
             dex_table_update = dex.from_csv(csv_str=input_csv)
             if dex_table_update is None:
                 logger.error(f'Failed to parse "{input_csv_path}" contents into csv')
+                act_session.logout()
+                return
             logger.info(f'Parsed "{input_csv_path}" contents into csv')
             table_update = dex_table_update.to_table_update()
-            act_session.dex_sub_session.update_table(table_update=table_update, ack_handler=on_table_update_response)
 
-        await act_connection.wait_on_disconnect()
+        result = await act_session.dex_sub_session.update_table_async(table_update=table_update, timeout=timeout)
+        if result.is_ok():
+            logger.info(f'Table update applied successfully')
+        else:
+            logger.info(f'Error applying table update: {result.err_msg}')
+        act_session.logout()
     finally:
         if act_connection is not None:
             act_connection.disconnect()
         await util.cancel_pending_asyncio_tasks()
 
 
+async def run_through_broker(broker_socket_path: str, act_address: brokerclient.ActAddress, input_csv_path: str, timeout: ty.Optional[float] = None):
+    with open(file=input_csv_path, mode='r', newline='', encoding='utf-8') as inp_csv_file:
+        input_csv = inp_csv_file.read()
+    try:
+        async with brokerclient.BrokerClient(act_address=act_address, socket_path=broker_socket_path) as client:
+            await client.update_table(csv=input_csv, timeout=timeout)
+    except brokerclient.BrokerError as exc:
+        logger.info(f'Error applying table update: {exc}')
+        return
+    logger.info(f'Table update applied successfully')
+
+
 def main():
     parser = util.get_arg_parser(desc="Run a dex tabel update", examples=SAMPLE_USAGE)
     util.add_act_connection_args(parser=parser)
     parser.add_argument('-inp_csv', '--input_csv_path', help='Path to csv file with updates to send to Actant', required=True)
+    parser.add_argument('-t', '--timeout', help='Seconds to wait for the table update to be acknowledged', default=30.0, type=float)
+    brokerclient.add_broker_args(parser=parser)
     parser.add_argument('-ll', '--loglevel', help='Level at which to log (DEBUG, INFO, WARNING, ERROR, CRITICAL)', required=False, default='INFO')
     parser.set_defaults(snapshot=False)
     args = parser.parse_args()
     logutil.configure_simple_console_logging(log_level=args.loglevel, timed=True)
 
     try:
+        if args.broker is not None:
+            asyncio.run(run_through_broker(broker_socket_path=args.broker,
+                                           act_address=brokerclient.ActAddress(ip=args.ip, port=args.port, user=args.user, password=args.password),
+                                           input_csv_path=args.input_csv_path, timeout=args.timeout))
+            return
         asyncio.run(run(
             ip=args.ip, port=args.port,
             user=args.user, password=args.password,
-            input_csv_path=args.input_csv_path
+            input_csv_path=args.input_csv_path,
+            timeout=args.timeout,
         ))
     except KeyboardInterrupt:
         logger.info(f'Exiting on Ctrl-C')
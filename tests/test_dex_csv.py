@@ -0,0 +1,39 @@
+import asyncio
+import typing as ty
+
+import pytest
+
+from actp import connection
+from actp import dex
+from actp import session
+from actp.proto import DataExchangeAPI_pb2 as dex_pb
+
+
+@pytest.fixture
+def act_session() -> ty.Iterator[session.ActSession]:
+    loop = asyncio.new_event_loop()
+    yield session.ActSession(act_connection=connection.ActConnection(ip='127.0.0.1', port=0, loop=loop), user='', password='', appname='test')
+    loop.close()
+
+
+def test_as_csv_matches_the_cell_by_cell_format(act_session):
+    dex_query = dex.DexQuery(query_data=dex.DexQueryData(scope_keys=['GLOBAL'], fields=['BID'], is_snapshot=False), act_session=act_session)
+    table_update = dex_pb.TableUpdate()
+    for name, col_type in (('BID', dex_pb.VAR_PRICE), ('QTY', dex_pb.VAR_INT32), ('THEO', dex_pb.VAR_DOUBLE), ('STATUS', dex_pb.VAR_STRING)):
+        table_update.columnDescriptor.add(name=name, type=col_type)
+    row = table_update.row.add()
+    row.key = 'A'
+    cell = row.cell.add()
+    cell.columnNumber = 3
+    cell.value.varString = 'x'  # no BID, QTY or THEO yet
+    row = table_update.row.add()
+    row.key = 'B'
+    for column_number, field_name, value in ((0, 'varPrice', 1234500000), (1, 'varInt', 7), (2, 'varDouble', 0.5), (3, 'varString', 'y')):
+        cell = row.cell.add()
+        cell.columnNumber = column_number
+        setattr(cell.value, field_name, value)
+    dex_query.on_table_update(client_id=0, err_msg='', update=table_update)
+
+    csv_str = dex_query.as_csv()
+    assert csv_str.splitlines() == ['Key,BID,QTY,THEO,STATUS', 'Type,VAR_PRICE,VAR_INT32,VAR_DOUBLE,VAR_STRING', 'A,INVALID,,,x', 'B,123.4500000,7,.5000000,y']
+    assert csv_str == dex.to_csv(columns=dex_query.columns, rows=list(dex_query.rows))
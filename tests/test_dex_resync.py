@@ -0,0 +1,77 @@
+import asyncio
+import typing as ty
+
+import pytest
+
+from actp import connection
+from actp import dex
+from actp import session
+from actp.proto import DataExchangeAPI_pb2 as dex_pb
+
+
+@pytest.fixture
+def act_session() -> ty.Iterator[session.ActSession]:
+    loop = asyncio.new_event_loop()
+    yield session.ActSession(act_connection=connection.ActConnection(ip='127.0.0.1', port=0, loop=loop), user='', password='', appname='test')
+    loop.close()
+
+
+def make_snapshot(keys: str) -> dex_pb.TableUpdate:
+    table_update = dex_pb.TableUpdate()
+    table_update.columnDescriptor.add(name='THEO', type=dex_pb.VAR_DOUBLE)
+    for key in keys:
+        row = table_update.row.add()
+        row.key = key
+        cell = row.cell.add()
+        cell.columnNumber = 0
+        cell.value.varDouble = ord(key)
+    return table_update
+
+
+def apply(dex_query: dex.DexQuery, table_update: dex_pb.TableUpdate, wire_decode: bool):
+    data = table_update.SerializeToString()
+    if wire_decode:
+        dex_query.on_table_update_wire(client_id=0, err_msg='', buffer=memoryview(data), start=0, end=len(data))
+    else:
+        dex_query.on_table_update(client_id=0, err_msg='', update=table_update)
+
+
+@pytest.mark.parametrize('wire_decode', [False, True])
+def test_resync_reports_changes_and_removes_missing_rows(act_session, wire_decode):
+    dex_query = dex.DexQuery(query_data=dex.DexQueryData(scope_keys=['GLOBAL'], fields=['THEO'], is_snapshot=False), act_session=act_session)
+    updates = []
+    dex_query.add_handlers(update_handler=lambda query, update_count, num_rows, new_rows, new_updated_rows:
+                           updates.append(([row.row_key.key for row in new_rows], [row.row_key.key for row in new_updated_rows])))
+    apply(dex_query=dex_query, table_update=make_snapshot(keys='ABCDE'), wire_decode=wire_decode)
+
+    dex_query._resync = True  # as restart() does, without a session to restart on
+    snapshot = make_snapshot(keys='BDF')
+    snapshot.row[0].cell[0].value.varDouble = 1.0
+    apply(dex_query=dex_query, table_update=snapshot, wire_decode=wire_decode)
+
+    assert updates[-1] == (['F'], ['B', 'F'])
+    assert [row_key.key for row_key in dex_query.get_change_set(update_count=2).deleted_row_keys] == ['A', 'C', 'E']
+    assert [row.row_key.key for row in dex_query.rows] == ['B', 'D', 'F']
+    assert dex_query.get_row_by_key(key='C') is None
+    assert [dex_query.get_float(key=key, column_name='THEO') for key in 'BDF'] == [1.0, ord('D'), ord('F')]
+    assert [row.row_key.key for row in dex_query.get_updated_rows(update_count=2)] == ['B', 'F']
+
+
+@pytest.mark.parametrize('wire_decode', [False, True])
+def test_rows_held_across_a_resync_keep_their_key(act_session, wire_decode):
+    dex_query = dex.DexQuery(query_data=dex.DexQueryData(scope_keys=['GLOBAL'], fields=['THEO'], is_snapshot=False), act_session=act_session)
+    new_rows = []
+    dex_query.add_handlers(update_handler=lambda query, update_count, num_rows, rows, updated_rows: new_rows.extend(rows))
+    apply(dex_query=dex_query, table_update=make_snapshot(keys='ABCD'), wire_decode=wire_decode)
+    held_row = new_rows[3]
+    held_cells = held_row.cells
+    row_by_key = dex_query.get_row_by_key(key='D')
+
+    dex_query._resync = True
+    apply(dex_query=dex_query, table_update=make_snapshot(keys='BCD'), wire_decode=wire_decode)
+
+    assert dex_query.get_row_by_key(key='D').row_index == 2
+    for row in (held_row, row_by_key):
+        assert row.row_key.key == 'D'
+        assert row.get_cell_by_name('THEO').get_float() == ord('D')
+    assert held_cells[0].get_float() == ord('D')
@@ -0,0 +1,158 @@
+import asyncio
+import random
+import typing as ty
+
+import pytest
+
+from actp import connection
+from actp import dex
+from actp import session
+from actp.proto import DataExchangeAPI_pb2 as dex_pb
+
+_VARIANT_FIELDS = ['varInt', 'varPrice', 'varDouble', 'varString', 'varQuantity']
+
+
+@pytest.fixture
+def act_session() -> ty.Iterator[session.ActSession]:
+    loop = asyncio.new_event_loop()
+    yield session.ActSession(act_connection=connection.ActConnection(ip='127.0.0.1', port=0, loop=loop), user='', password='', appname='test')
+    loop.close()
+
+
+def make_query(act_session: session.ActSession) -> dex.DexQuery:
+    return dex.DexQuery(query_data=dex.DexQueryData(scope_keys=['GLOBAL'], fields=['BID'], is_snapshot=False), act_session=act_session)
+
+
+def set_random_field(rnd: random.Random, value: dex_pb.VariantValue, field_name: str):
+    if field_name == 'varInt':
+        value.varInt = rnd.randint(-2 ** 31, 2 ** 31 - 1)
+    elif field_name == 'varPrice':
+        value.varPrice = rnd.randint(-2 ** 63, 2 ** 63 - 1)
+    elif field_name == 'varDouble':
+        value.varDouble = rnd.uniform(-1e9, 1e9)
+    elif field_name == 'varString':
+        value.varString = ''.join(rnd.choice('abcXYZ.é€ ') for _ in range(rnd.randint(0, 12)))
+    elif field_name == 'varQuantity':
+        value.varQuantity = rnd.randint(-2 ** 63, 2 ** 63 - 1)
+
+
+def random_variant_value(rnd: random.Random, value: dex_pb.VariantValue):
+    """ No field, one field or, 1 in 10, several of them, the fields of VariantValue aren't a oneof """
+    value.SetInParent()
+    if rnd.random() < 0.1:
+        field_names = rnd.sample(_VARIANT_FIELDS, rnd.randint(2, len(_VARIANT_FIELDS)))
+    else:
+        field_names = [rnd.choice(_VARIANT_FIELDS + [None])]
+    for field_name in field_names:
+        set_random_field(rnd=rnd, value=value, field_name=field_name)
+
+
+def make_random_table_update(rnd: random.Random, num_rows: int, num_columns: int, with_columns: bool) -> dex_pb.TableUpdate:
+    table_update = dex_pb.TableUpdate()
+    if with_columns:
+        for column_index in range(num_columns):
+            table_update.columnDescriptor.add(name=f'FIELD{column_index}', type=rnd.randint(0, 4), isVector=rnd.random() < 0.1, canWrite=rnd.random() < 0.5)
+    for _ in range(num_rows):
+        row = table_update.row.add()
+        row.key = f'XCME.ES.{rnd.randint(0, num_rows)}'
+        if rnd.random() < 0.2:
+            row.contexts = rnd.choice(['A', 'B', 'A,B'])
+        for _ in range(rnd.randint(0, num_columns + 1)):
+            cell = row.cell.add()
+            cell.columnNumber = rnd.randint(-1, num_columns + 1)  # includes out of range columns
+            if rnd.random() < 0.8:
+                random_variant_value(rnd=rnd, value=cell.value)
+            else:
+                for _ in range(rnd.randint(0, 3)):
+                    random_variant_value(rnd=rnd, value=cell.valueVector.add())
+    return table_update
+
+
+def apply(dex_query: dex.DexQuery, table_update: dex_pb.TableUpdate, wire_decode: bool):
+    data = table_update.SerializeToString()
+    if wire_decode:
+        dex_query.on_table_update_wire(client_id=0, err_msg='', buffer=memoryview(data), start=0, end=len(data))
+        return
+    parsed = dex_pb.TableUpdate()
+    parsed.ParseFromString(data)
+    dex_query.on_table_update(client_id=0, err_msg='', update=parsed)
+
+
+def query_contents(dex_query: dex.DexQuery) -> ty.List[ty.Any]:
+    contents: ty.List[ty.Any] = [(column.name, column.col_type, column.is_vector, column.can_write) for column in dex_query.columns]
+    for row in dex_query.rows:
+        cells = []
+        for cell in row.cells:
+            value = None if cell.value is None else dex.variant_value_to_proto(cell.value).SerializeToString()
+            has_fields = None if cell.value is None else [cell.value.HasField(field_name) for field_name in _VARIANT_FIELDS]
+            vector = None if cell.vector is None else [dex.variant_value_to_proto(v).SerializeToString() for v in cell.vector]
+            value_str = cell.value_str() if cell.value is not None else None
+            cells.append((cell.update_count, value, has_fields, vector, value_str))
+        contents.append((str(row.row_key), row.row_index, cells))
+    return contents
+
+
+def make_single_row_update(col_types: ty.List[dex_pb.VariantType]) -> dex_pb.TableUpdate:
+    table_update = dex_pb.TableUpdate()
+    for column_index, col_type in enumerate(col_types):
+        table_update.columnDescriptor.add(name=f'FIELD{column_index}', type=col_type)
+    row = table_update.row.add()
+    row.key = 'XCME.ES'
+    return table_update
+
+
+@pytest.mark.parametrize('wire_decode', [False, True])
+def test_multi_field_value_keeps_every_field(act_session, wire_decode):
+    table_update = make_single_row_update(col_types=[dex_pb.VAR_PRICE])
+    cell = table_update.row[0].cell.add()
+    cell.columnNumber = 0
+    cell.value.varInt = 7
+    cell.value.varString = 'x'
+    dex_query = make_query(act_session=act_session)
+    apply(dex_query=dex_query, table_update=table_update, wire_decode=wire_decode)
+
+    value = dex_query.get_value(key='XCME.ES', column_name='FIELD0')
+    assert value.HasField('varInt') and value.HasField('varString')
+    assert dex.variant_value_to_proto(value) == cell.value
+    assert dex_query.rows[0].cells[0].value_str() == dex.get_variant_value_to_str_func(variant_type=dex_pb.VAR_PRICE, is_vector=False)(cell.value, None)
+
+
+@pytest.mark.parametrize('wire_decode', [False, True])
+def test_vector_values_match_protobuf(act_session, wire_decode):
+    table_update = make_single_row_update(col_types=[dex_pb.VAR_DOUBLE])
+    cell = table_update.row[0].cell.add()
+    cell.columnNumber = 0
+    cell.valueVector.add().varDouble = 1.5
+    cell.valueVector.add().SetInParent()
+    multi_field_value = cell.valueVector.add()
+    multi_field_value.varDouble = 2.5
+    multi_field_value.varQuantity = 3
+    dex_query = make_query(act_session=act_session)
+    apply(dex_query=dex_query, table_update=table_update, wire_decode=wire_decode)
+
+    assert [dex.variant_value_to_proto(value) for value in dex_query.rows[0].cells[0].vector] == list(cell.valueVector)
+
+
+@pytest.mark.parametrize('wire_decode', [False, True])
+def test_out_of_range_columns_are_ignored(act_session, wire_decode):
+    table_update = make_single_row_update(col_types=[dex_pb.VAR_INT32, dex_pb.VAR_INT32])
+    for column_number in (-1, 0, 2, 1000):
+        cell = table_update.row[0].cell.add()
+        cell.columnNumber = column_number
+        cell.value.varInt = column_number
+    dex_query = make_query(act_session=act_session)
+    apply(dex_query=dex_query, table_update=table_update, wire_decode=wire_decode)
+
+    assert [cell.value for cell in dex_query.rows[0].cells] == [dex.WireVariantValue('varInt', 0), None]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_wire_decoder_conforms_to_protobuf(act_session, seed):
+    rnd = random.Random(seed)
+    pb_query = make_query(act_session=act_session)
+    wire_query = make_query(act_session=act_session)
+    for update_index in range(50):
+        table_update = make_random_table_update(rnd=rnd, num_rows=rnd.randint(0, 30), num_columns=rnd.randint(1, 8), with_columns=update_index % 5 == 0)
+        apply(dex_query=pb_query, table_update=table_update, wire_decode=False)
+        apply(dex_query=wire_query, table_update=table_update, wire_decode=True)
+        assert query_contents(wire_query) == query_contents(pb_query), f'update {update_index}'
@@ -0,0 +1,69 @@
+import asyncio
+import math
+import typing as ty
+
+import pytest
+
+from actp import connection
+from actp import dex
+from actp import dextable
+from actp import session
+from actp.proto import DataExchangeAPI_pb2 as dex_pb
+
+np = pytest.importorskip('numpy')
+
+
+@pytest.fixture
+def dex_query() -> ty.Iterator[dex.DexQuery]:
+    loop = asyncio.new_event_loop()
+    act_session = session.ActSession(act_connection=connection.ActConnection(ip='127.0.0.1', port=0, loop=loop), user='', password='', appname='test')
+    dex_query = dex.DexQuery(query_data=dex.DexQueryData(scope_keys=['GLOBAL'], fields=['BID'], is_snapshot=False), act_session=act_session)
+    table_update = dex_pb.TableUpdate()
+    table_update.columnDescriptor.add(name='BID', type=dex_pb.VAR_PRICE)
+    table_update.columnDescriptor.add(name='THEO', type=dex_pb.VAR_DOUBLE)
+    for key, price, theo in (('A', 1000, 1.5), ('B', None, 2.5)):
+        row = table_update.row.add()
+        row.key = key
+        if price is not None:
+            cell = row.cell.add()
+            cell.columnNumber = 0
+            cell.value.varPrice = price
+        cell = row.cell.add()
+        cell.columnNumber = 1
+        cell.value.varDouble = theo
+    dex_query.on_table_update(client_id=0, err_msg='', update=table_update)
+    yield dex_query
+    loop.close()
+
+
+def update_theo(dex_query: dex.DexQuery, key: str, theo: float):
+    table_update = dex_pb.TableUpdate()
+    row = table_update.row.add()
+    row.key = key
+    cell = row.cell.add()
+    cell.columnNumber = 1
+    cell.value.varDouble = theo
+    dex_query.on_table_update(client_id=0, err_msg='', update=table_update)
+
+
+def test_to_numpy_shares_read_only_buffers(dex_query):
+    arrays = dex_query.to_numpy()
+    assert arrays['BID'].tolist() == [1000, dextable.INVALID_PRICE]
+    theos = arrays['THEO']
+    with pytest.raises(ValueError):
+        theos[1] = -5.0
+    update_theo(dex_query=dex_query, key='B', theo=99.0)
+    assert theos.tolist() == [1.5, 99.0]
+
+    copied_theos = dex_query.to_numpy(column_names=['THEO'], copy=True)['THEO']
+    copied_theos[1] = -5.0
+    assert dex_query.get_float(key='B', column_name='THEO') == 99.0
+
+
+def test_to_dataframe_is_a_copy(dex_query):
+    pytest.importorskip('pandas')
+    data_frame = dex_query.to_dataframe()
+    update_theo(dex_query=dex_query, key='B', theo=99.0)
+    assert data_frame['THEO'].tolist() == [1.5, 2.5]
+    assert data_frame.loc['A', 'BID'] == 1000 / dextable.PRICE_SCALING_FACTOR
+    assert math.isnan(data_frame.loc['B', 'BID'])